@@ -0,0 +1,106 @@
+"""
+Benchmark the knowledge store ingestion writes: rows built as python dicts
+and converted by lancedb, against the record batches built column-wise by
+`knowledge_batch`.
+
+The vectors are pre-computed random vectors, so that only the cost of
+building and writing the rows is measured.
+
+Usage:
+    uv run python hack/benchmarks/knowledgestore_writes.py [--rows 50000] [--dims 1536]
+"""
+
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+import lancedb
+import numpy as np
+import pyarrow as pa
+
+from opsmate.knowledgestore.writer import KNOWLEDGE_SCHEMA, knowledge_batch, set_column
+
+CHUNK = "check the nginx error log and restart the pod if it is crashlooping. " * 8
+
+
+def build_dicts(contents, vectors):
+    return [
+        {
+            "uuid": str(uuid.uuid4()),
+            "id": idx,
+            "categories": [],
+            "data_source_provider": "fs",
+            "data_source": "/docs",
+            "metadata": json.dumps({"chunk": idx}),
+            "path": "README.md",
+            "content": content,
+            "created_at": datetime.now(),
+            "canonical_uuid": "",
+            "vector": vector,
+        }
+        for idx, (content, vector) in enumerate(zip(contents, vectors))
+    ]
+
+
+def build_batch(contents, vectors):
+    batch = knowledge_batch(
+        contents,
+        metadata=[json.dumps({"chunk": idx}) for idx in range(len(contents))],
+        data_source_provider="fs",
+        data_source="/docs",
+        path="README.md",
+    )
+    dims = vectors.shape[1]
+    return set_column(
+        batch,
+        "vector",
+        pa.FixedSizeListArray.from_arrays(pa.array(vectors.ravel()), dims),
+    )
+
+
+async def run(root, name, build, contents, vectors, dims):
+    db = await lancedb.connect_async(root)
+    schema = KNOWLEDGE_SCHEMA.append(pa.field("vector", pa.list_(pa.float32(), dims)))
+    table = await db.create_table(name, schema=schema)
+
+    start = time.perf_counter()
+    rows = build(contents, vectors)
+    built = time.perf_counter()
+    await table.add(rows)
+    done = time.perf_counter()
+    assert await table.count_rows() == len(contents)
+    return built - start, done - built
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--dims", type=int, default=1536)
+    args = parser.parse_args()
+
+    contents = [f"{idx} {CHUNK}" for idx in range(args.rows)]
+    vectors = np.random.default_rng(42).random((args.rows, args.dims), np.float32)
+    # the dict rows carry the vectors as python lists, as returned by the embedders
+    vector_lists = vectors.tolist()
+
+    print(f"{'writer':<14} {'build s':>8} {'add s':>8} {'rows/s':>10}")
+    with tempfile.TemporaryDirectory() as root:
+        for name, build, data in [
+            ("dicts", build_dicts, vector_lists),
+            ("record batch", build_batch, vectors),
+        ]:
+            build_time, add_time = await run(
+                root, name.replace(" ", "_"), build, contents, data, args.dims
+            )
+            print(
+                f"{name:<14} {build_time:>8.2f} {add_time:>8.2f} "
+                f"{args.rows / (build_time + add_time):>10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
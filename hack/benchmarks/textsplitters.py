@@ -0,0 +1,111 @@
+"""
+Benchmark the throughput of the text splitters in MB/s, and the overhead of
+measuring the chunks in tokens rather than characters.
+
+Usage:
+    uv run python hack/benchmarks/textsplitters.py [--size-mb 4] [--repeat 3]
+"""
+
+import argparse
+import random
+import time
+from opsmate.textsplitters import splitter_from_config
+from opsmate.textsplitters.tokens import token_counter
+
+CONFIGS = {
+    "recursive": {"splitter": "recursive", "chunk_size": 1000, "chunk_overlap": 0},
+    "recursive+overlap": {
+        "splitter": "recursive",
+        "chunk_size": 1000,
+        "chunk_overlap": 200,
+    },
+    "recursive-small": {
+        "splitter": "recursive",
+        "chunk_size": 200,
+        "chunk_overlap": 50,
+    },
+    "markdown": {
+        "splitter": "markdown_header",
+        "headers_to_split_on": [["#", "h1"]],
+    },
+    "recursive-tokens": {
+        "splitter": "recursive",
+        "chunk_size": 256,
+        "chunk_overlap": 0,
+        "tokenizer": "cl100k_base",
+    },
+    "markdown-tokens": {
+        "splitter": "markdown_header",
+        "headers_to_split_on": [["#", "h1"]],
+        "chunk_size": 256,
+        "tokenizer": "cl100k_base",
+    },
+}
+
+
+def corpus(size: int, seed: int = 42) -> str:
+    """
+    Generate a markdown-ish corpus of roughly `size` characters.
+    """
+    rng = random.Random(seed)
+    words = [
+        "kubectl",
+        "pod",
+        "deployment",
+        "the",
+        "node",
+        "is",
+        "restarting",
+        "OOMKilled",
+        "memory",
+        "limit",
+        "a",
+        "service",
+        "latency",
+        "p99",
+    ]
+    parts, total = [], 0
+    while total < size:
+        sentence = " ".join(rng.choices(words, k=rng.randint(4, 20)))
+        sentence += rng.choice([". ", "? ", "! ", "; ", ", "])
+        if rng.random() < 0.1:
+            sentence += "\n"
+        if rng.random() < 0.03:
+            sentence += f"\n# heading {len(parts)}\n\n"
+        parts.append(sentence)
+        total += len(sentence)
+    return "".join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    text = corpus(int(args.size_mb * 1024 * 1024))
+    mb = len(text.encode()) / 1024 / 1024
+
+    count = token_counter("cl100k_base")
+    start = time.perf_counter()
+    tokens = count(text)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{'tokenize (' + count.__name__ + ')':<20} {mb:.1f} MB  {tokens:>6} tokens  "
+        f"{elapsed:.3f}s  {elapsed / mb * 1000:.1f} ms/MB"
+    )
+    for name, config in CONFIGS.items():
+        splitter = splitter_from_config(config)
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            chunks = splitter.split_text(text)
+            best = min(best, time.perf_counter() - start)
+        print(
+            f"{name:<20} {mb:.1f} MB  {len(chunks):>6} chunks  "
+            f"{best:.3f}s  {mb / best:.2f} MB/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
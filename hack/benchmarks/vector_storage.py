@@ -0,0 +1,146 @@
+"""
+Benchmark the recall and latency of the knowledge store vector storage options:
+float32 / float16 precision, matryoshka truncation and the quantized indexes,
+with and without rescoring the candidates with the full vectors.
+
+The recall@k is measured against the exact float32 search.
+
+Usage:
+    uv run python hack/benchmarks/vector_storage.py [--rows 20000] [--dims 1536]
+"""
+
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import lancedb
+import numpy as np
+import pyarrow as pa
+
+from opsmate.knowledgestore.models import (
+    VECTOR_PRECISIONS,
+    create_vector_index,
+)
+
+# (name, precision, dimensions divisor, index, refine_factor)
+OPTIONS = [
+    ("float32 flat", "float32", None, "flat", None),
+    ("float16 flat", "float16", None, "flat", None),
+    ("float32 matryoshka/2", "float32", 2, "flat", None),
+    ("float32 ivf_pq", "float32", None, "ivf_pq", None),
+    ("float32 ivf_pq refine=4", "float32", None, "ivf_pq", 4),
+    ("float32 hnsw_sq", "float32", None, "hnsw_sq", None),
+    ("float32 hnsw_sq refine=4", "float32", None, "hnsw_sq", 4),
+    ("float16 ivf_pq refine=4", "float16", None, "ivf_pq", 4),
+]
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def dataset(rows: int, dims: int, queries: int, seed: int = 42):
+    """
+    Clustered unit vectors, with the leading dimensions carrying most of the
+    variance as in the matryoshka embeddings.
+    """
+    rng = np.random.default_rng(seed)
+    scale = 1.0 / np.sqrt(np.arange(1, dims + 1))
+    centers = rng.normal(size=(64, dims)) * scale
+    assignments = rng.integers(0, len(centers), size=rows + queries)
+    vectors = centers[assignments] + rng.normal(size=(rows + queries, dims)) * scale
+    vectors = normalize(vectors).astype(np.float32)
+    return vectors[:rows], vectors[rows:]
+
+
+def dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+async def run(
+    root: Path, name: str, precision, divisor, index, refine_factor, data, queries, k
+):
+    dims = data.shape[1] // (divisor or 1)
+    vectors = normalize(data[:, :dims])
+    query_vectors = normalize(queries[:, :dims])
+
+    path = root / name.replace(" ", "_").replace("/", "_")
+    db = await lancedb.connect_async(path)
+    schema = pa.schema(
+        [
+            pa.field("id", pa.int64()),
+            pa.field("vector", pa.list_(VECTOR_PRECISIONS[precision], dims)),
+        ]
+    )
+    table = await db.create_table("knowledge_store", schema=schema)
+    await table.add(
+        pa.table(
+            {
+                "id": pa.array(np.arange(len(vectors))),
+                "vector": pa.FixedSizeListArray.from_arrays(
+                    pa.array(vectors.ravel(), type=VECTOR_PRECISIONS[precision]), dims
+                ),
+            }
+        )
+    )
+    await create_vector_index(table, kind=index, min_rows=0)
+
+    results, latencies = [], []
+    for query in query_vectors:
+        q = table.query().nearest_to(query).select(["id"]).limit(k)
+        if refine_factor:
+            q = q.refine_factor(refine_factor)
+        start = time.perf_counter()
+        rows = await q.to_list()
+        latencies.append(time.perf_counter() - start)
+        results.append([row["id"] for row in rows])
+    return results, latencies, dir_size(path)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    data, queries = dataset(args.rows, args.dims, args.queries)
+    truth = np.argsort(-(queries @ data.T), axis=1)[:, : args.k]
+
+    print(
+        f"{'option':<28} {'size MB':>8} {'recall@' + str(args.k):>10} "
+        f"{'p50 ms':>8} {'p95 ms':>8}"
+    )
+    with tempfile.TemporaryDirectory() as root:
+        for name, precision, divisor, index, refine_factor in OPTIONS:
+            results, latencies, size = await run(
+                Path(root),
+                name,
+                precision,
+                divisor,
+                index,
+                refine_factor,
+                data,
+                queries,
+                args.k,
+            )
+            recall = np.mean(
+                [
+                    len(set(result) & set(expected)) / args.k
+                    for result, expected in zip(results, truth)
+                ]
+            )
+            latencies = sorted(latencies)
+            print(
+                f"{name:<28} {size / 1024 / 1024:>8.1f} {recall:>10.3f} "
+                f"{statistics.median(latencies) * 1000:>8.2f} "
+                f"{latencies[int(len(latencies) * 0.95)] * 1000:>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
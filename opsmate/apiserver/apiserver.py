@@ -21,7 +21,7 @@ if os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT"):
     StarletteInstrumentor().instrument_app(app)
 
 
-from opsmate.gui.app import app as fasthtml_app, startup
+from opsmate.gui.app import app as fasthtml_app, startup, shutdown
 
 
 class Health(BaseModel):
@@ -115,3 +115,4 @@ app.mount("/api", api_app)
 app.mount("/", fasthtml_app)
 
 app.add_event_handler("startup", startup)
+app.add_event_handler("shutdown", shutdown)
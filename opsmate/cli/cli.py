@@ -33,6 +33,7 @@ import structlog
 import sys
 import inspect
 import opsmate.tools  # noqa: F401
+from opsmate.tools.http_clients import close_http_clients
 import traceback
 import json
 
@@ -48,7 +49,13 @@ def addon_discovery():
 def coro(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        return asyncio.run(f(*args, **kwargs))
+        async def run():
+            try:
+                return await f(*args, **kwargs)
+            finally:
+                await close_http_clients()
+
+        return asyncio.run(run())
 
     return wrapper
 
@@ -915,11 +922,17 @@ Waiting for them to complete before scheduling the next one...
     hide_input=True,
     help="Prometheus api key. If not provided it uses $PROMETHEUS_API_KEY environment variable, or defaults to empty string",
 )
+@click.option(
+    "--full",
+    is_flag=True,
+    default=False,
+    help="Re-ingest all the metrics, rather than only the metrics that are new or changed since the last ingestion",
+)
 @config_params()
 @auto_migrate
 @coro
 async def ingest_prometheus_metrics_metadata(
-    prometheus_endpoint, prometheus_user_id, prometheus_api_key, config
+    prometheus_endpoint, prometheus_user_id, prometheus_api_key, full, config
 ):
     """
     Ingest prometheus metrics metadata into the knowledge base.
@@ -927,6 +940,7 @@ async def ingest_prometheus_metrics_metadata(
     The ingested metrics metadata will be used for providing context to the LLM when querying prometheus based metrics
     Note this only enqueues the tasks to ingest metrics. To execute the actual ingestion in the background, run `opsmate worker`.
     Please run: `opsmate worker -w 1 -q lancedb-batch-ingest`
+    Only the metrics that are new or changed since the last ingestion are enqueued, and the metrics gone from the server are removed, unless `--full` is given.
     """
     from opsmate.tools.prom import PromQL
     from opsmate.knowledgestore.models import init_table
@@ -942,7 +956,7 @@ async def ingest_prometheus_metrics_metadata(
 
     engine = config.db_engine()
     with Session(engine) as session:
-        await prom.ingest_metrics(session)
+        await prom.ingest_metrics(session, incremental=not full)
 
 
 @opsmate_cli.command()
@@ -1007,10 +1021,31 @@ def list_models(provider):
     show_default=True,
     help="Glob to use to find the knowledge base",
 )
+@click.option(
+    "--github-fetch-mode",
+    default="api",
+    show_default=True,
+    type=click.Choice(["api", "archive"]),
+    help="How to fetch the github files, archive downloads the tarball of the branch in one request",
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    default=False,
+    help="Keep watching the fs source for changes and ingest the touched files. Without --source the fs embeddings config is watched",
+)
+@click.option(
+    "--watch-debounce-ms",
+    default=1600,
+    show_default=True,
+    help="The debounce window of the file change events in milliseconds",
+)
 @config_params()
 @auto_migrate
 @coro
-async def ingest(source, path, glob, config):
+async def ingest(
+    source, path, glob, github_fetch_mode, watch, watch_debounce_ms, config
+):
     """
     Ingest a knowledge base.
     Notes the ingestion worker needs to be started separately with `opsmate worker`.
@@ -1025,6 +1060,32 @@ async def ingest(source, path, glob, config):
 
     engine = config.db_engine()
 
+    if watch:
+        from opsmate.ingestions.fs import FsIngestion
+        from opsmate.ingestions.watch import watch_ingestions
+
+        if source is None:
+            ingestions = FsIngestion.from_configmap(config.fs_embeddings_config)
+        elif source.startswith("fs:///"):
+            _, local_path = source.split(":///", 1)
+            ingestions = [FsIngestion(local_path=local_path, glob_pattern=glob)]
+        else:
+            console.print("Only fs:///path/to/kb sources can be watched")
+            exit(1)
+
+        if not ingestions:
+            console.print("Nothing to watch, no fs source is configured")
+            exit(1)
+
+        console.print("Watching the knowledge base for changes...")
+        await watch_ingestions(
+            engine,
+            ingestions,
+            splitter_config=config.splitter_config,
+            debounce_ms=watch_debounce_ms,
+        )
+        return
+
     splitted = source.split(":///")
     if len(splitted) != 2:
         console.print(
@@ -1061,6 +1122,7 @@ async def ingest(source, path, glob, config):
                         "branch": branch,
                         "path": path,
                         "glob": glob,
+                        "fetch_mode": github_fetch_mode,
                     },
                     splitter_config=splitter_config,
                 )
@@ -116,6 +116,33 @@ class Config(BaseSettings):
         description="The name of the embedding model",
         alias="OPSMATE_EMBEDDING_MODEL_NAME",
     )
+    embedding_dimensions: int = Field(
+        default=0,
+        description="Truncate the embeddings to this many dimensions, for the matryoshka models such as openai text-embedding-3-*. 0 keeps the native dimensions",
+        alias="OPSMATE_EMBEDDING_DIMENSIONS",
+    )
+    embedding_precision: str = Field(
+        default="float32",
+        choices=["float32", "float16"],
+        description="The precision the embeddings are stored in",
+        alias="OPSMATE_EMBEDDING_PRECISION",
+    )
+    embedding_index: str = Field(
+        default="flat",
+        choices=["flat", "ivf_pq", "hnsw_sq"],
+        description="The vector index of the knowledge store. flat searches without an index, ivf_pq uses product quantization and hnsw_sq int8 scalar quantization",
+        alias="OPSMATE_EMBEDDING_INDEX",
+    )
+    embedding_index_min_rows: int = Field(
+        default=10000,
+        description="The number of rows from which the vector index is trained",
+        alias="OPSMATE_EMBEDDING_INDEX_MIN_ROWS",
+    )
+    embedding_refine_factor: int = Field(
+        default=4,
+        description="Rescore refine_factor * top_n candidates of the quantized vector index with the full vectors. 0 disables the rescoring",
+        alias="OPSMATE_EMBEDDING_REFINE_FACTOR",
+    )
     reranker_name: str = Field(
         default="",
         description="The name of the reranker model",
@@ -130,11 +157,57 @@ class Config(BaseSettings):
         description=github_embedding_desc,
         alias="OPSMATE_GITHUB_EMBEDDINGS_CONFIG",
     )
+    embeddings_read_consistency_interval: float = Field(
+        default=5.0,
+        description="The maximum seconds the cached knowledge store tables can lag behind the writes of other processes. 0 checks for updates on every read, a negative value never checks",
+        alias="OPSMATE_EMBEDDINGS_READ_CONSISTENCY_INTERVAL",
+    )
+    embeddings_write_buffer_rows: int = Field(
+        default=1000,
+        description="The number of pending rows that triggers a flush of the knowledge store write buffer",
+        alias="OPSMATE_EMBEDDINGS_WRITE_BUFFER_ROWS",
+    )
+    embeddings_write_buffer_delay: float = Field(
+        default=0.5,
+        description="The maximum seconds a write waits in the knowledge store write buffer before being flushed",
+        alias="OPSMATE_EMBEDDINGS_WRITE_BUFFER_DELAY",
+    )
+    embeddings_sharding: str = Field(
+        default="none",
+        choices=["none", "provider"],
+        description="The layout of the knowledge store. none stores all the data sources in one table, provider stores each data source provider in a table of its own",
+        alias="OPSMATE_EMBEDDINGS_SHARDING",
+    )
+    reranker_timeout: float = Field(
+        default=5.0,
+        description="The latency budget of the reranker in seconds. The fused search order is used when the reranker does not respond in time",
+        alias="OPSMATE_RERANKER_TIMEOUT",
+    )
+    retrieval_cache_size: int = Field(
+        default=256,
+        description="The maximum number of knowledge retrieval results kept in the in-memory cache",
+        alias="OPSMATE_RETRIEVAL_CACHE_SIZE",
+    )
+    retrieval_cache_dir: str = Field(
+        default="",
+        description="The directory of the on-disk knowledge retrieval cache. The on-disk cache is disabled when empty",
+        alias="OPSMATE_RETRIEVAL_CACHE_DIR",
+    )
     categorise: bool = Field(
         default=True,
         description="Whether to categorise the embeddings",
         alias="OPSMATE_CATEGORISE",
     )
+    categorise_batch_size: int = Field(
+        default=20,
+        description="The number of chunks categorised in a single llm call",
+        alias="OPSMATE_CATEGORISE_BATCH_SIZE",
+    )
+    categorise_concurrency: int = Field(
+        default=4,
+        description="The maximum number of concurrent llm calls for the categorisation",
+        alias="OPSMATE_CATEGORISE_CONCURRENCY",
+    )
     splitter_config: Dict[str, Any] = Field(
         default={
             "splitter": "markdown_header",
@@ -147,6 +220,79 @@ class Config(BaseSettings):
         alias="OPSMATE_SPLITTER_CONFIG",
     )
 
+    dedup: bool = Field(
+        default=True,
+        description="Whether to store the near-duplicate chunks as references to their canonical chunk rather than embedding them again",
+        alias="OPSMATE_DEDUP",
+    )
+    dedup_threshold: float = Field(
+        default=0.9,
+        description="The estimated jaccard similarity from which a chunk is a near-duplicate of another",
+        alias="OPSMATE_DEDUP_THRESHOLD",
+    )
+
+    chunk_processes: int = Field(
+        default=2,
+        description="The number of processes splitting the large documents into chunks. 0 splits them on the event loop",
+        alias="OPSMATE_CHUNK_PROCESSES",
+    )
+    chunk_inline_threshold: int = Field(
+        default=64 * 1024,
+        description="The documents with fewer characters than this are split on the event loop rather than in the process pool",
+        alias="OPSMATE_CHUNK_INLINE_THRESHOLD",
+    )
+
+    http2: bool = Field(
+        default=True,
+        description="Whether the http clients of the tools negotiate HTTP/2, when the h2 package is installed",
+        alias="OPSMATE_HTTP2",
+    )
+    http_max_connections: int = Field(
+        default=100,
+        description="The maximum number of connections of the http client of an endpoint",
+        alias="OPSMATE_HTTP_MAX_CONNECTIONS",
+    )
+    http_max_keepalive_connections: int = Field(
+        default=20,
+        description="The maximum number of idle keep-alive connections of the http client of an endpoint",
+        alias="OPSMATE_HTTP_MAX_KEEPALIVE_CONNECTIONS",
+    )
+    http_keepalive_expiry: float = Field(
+        default=30.0,
+        description="The number of seconds an idle keep-alive connection is kept open",
+        alias="OPSMATE_HTTP_KEEPALIVE_EXPIRY",
+    )
+    http_max_clients: int = Field(
+        default=32,
+        description="The maximum number of pooled http clients, one per endpoint. The least recently used client is closed beyond that",
+        alias="OPSMATE_HTTP_MAX_CLIENTS",
+    )
+    http_timeout: float = Field(
+        default=5.0,
+        description="The read, write and pool timeout of the http requests in seconds",
+        alias="OPSMATE_HTTP_TIMEOUT",
+    )
+    http_connect_timeout: float = Field(
+        default=5.0,
+        description="The connect timeout of the http requests in seconds",
+        alias="OPSMATE_HTTP_CONNECT_TIMEOUT",
+    )
+    query_shard_duration: int = Field(
+        default=24 * 60 * 60,
+        description="The maximum time range in seconds of a shard of the prometheus range queries. Longer ranges are split into shards queried concurrently",
+        alias="OPSMATE_QUERY_SHARD_DURATION",
+    )
+    query_concurrency: int = Field(
+        default=4,
+        description="The maximum number of concurrent requests of a sharded range query",
+        alias="OPSMATE_QUERY_CONCURRENCY",
+    )
+    loki_page_size: int = Field(
+        default=1000,
+        description="The maximum number of log entries fetched per loki request. Larger limits are fetched page by page",
+        alias="OPSMATE_LOKI_PAGE_SIZE",
+    )
+
     loglevel: str = Field(default="INFO", alias="OPSMATE_LOGLEVEL")
 
     tools: List[str] = Field(
@@ -173,6 +319,20 @@ class Config(BaseSettings):
                 return DEFAULT_OPENAI_EMBEDDING_MODEL
         return v
 
+    @model_validator(mode="after")
+    def validate_embedding_storage(self):
+        # only the openai embedding function can truncate the stored embeddings
+        if self.embedding_dimensions and self.embedding_registry_name != "openai":
+            raise ValueError(
+                "embedding_dimensions is only supported by the openai embedding registry"
+            )
+        # lance has no hnsw graph over float16 vectors
+        if self.embedding_precision == "float16" and self.embedding_index == "hnsw_sq":
+            raise ValueError(
+                "the hnsw_sq embedding index does not support float16 embeddings"
+            )
+        return self
+
     @classmethod
     def transformers_available(cls):
         return importlib.util.find_spec("transformers") is not None
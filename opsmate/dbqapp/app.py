@@ -1,5 +1,8 @@
 from opsmate.dbq.dbq import Worker
 from opsmate.config import config
+from opsmate.knowledgestore.buffer import close_write_buffers
+from opsmate.textsplitters.parallel import shutdown_parallel_splitter
+from opsmate.tools.http_clients import close_http_clients
 import asyncio
 import structlog
 import signal
@@ -19,7 +22,12 @@ async def main(worker_count: int = 10, worker_queue: str = "default"):
     signal.signal(signal.SIGTERM, handle_signal)
     signal.signal(signal.SIGINT, handle_signal)
 
-    await worker.start()
+    try:
+        await worker.start()
+    finally:
+        await close_write_buffers()
+        await close_http_clients()
+        shutdown_parallel_splitter()
 
 
 if __name__ == "__main__":
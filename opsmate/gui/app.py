@@ -48,6 +48,7 @@ from opsmate.ingestions import ingest_from_config
 from opsmate.ingestions.models import IngestionRecord
 from opsmate.ingestions.jobs import ingest, delete_ingestion
 from opsmate.dbq.dbq import enqueue_task
+from opsmate.tools.http_clients import close_http_clients
 from uuid import uuid4
 
 
@@ -101,6 +102,11 @@ async def startup():
         await kb_ingest()
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await close_http_clients()
+
+
 @app.route("/polya")
 async def get():
     with sqlmodel.Session(engine) as session:
@@ -49,6 +49,7 @@ async def ingest_from_config(
                         "branch": ingestion.branch,
                         "path": ingestion.path,
                         "glob": ingestion.glob,
+                        "fetch_mode": ingestion.fetch_mode,
                     },
                     splitter_config=cfg.splitter_config,
                 )
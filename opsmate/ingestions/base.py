@@ -12,6 +12,9 @@ class Document(BaseModel):
     data_provider: str = Field(default="unknown")
     data_source: str = Field(default="unknown")
     content: str
+    deleted: bool = Field(
+        default=False, description="Whether the document is deleted from the source"
+    )
 
 
 PostChunkHook = Callable[[Chunk], Awaitable[Chunk]]
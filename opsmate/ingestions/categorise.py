@@ -0,0 +1,129 @@
+from opsmate.knowledgestore.models import Category
+from opsmate.ingestions.models import ChunkCategoryRecord
+from opsmate.config import config
+from opsmate.dino import dino
+from pydantic import BaseModel, Field
+from sqlmodel import Session
+from typing import Dict, List
+import asyncio
+import hashlib
+import weakref
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+
+class ChunkCategories(BaseModel):
+    id: int = Field(description="The id of the chunk")
+    categories: List[Category] = Field(description="The categories of the chunk")
+
+
+class BatchCategories(BaseModel):
+    chunks: List[ChunkCategories] = Field(
+        description="The categories of every chunk in the batch"
+    )
+
+
+@dino(
+    model="gpt-4o-mini",
+    response_model=BatchCategories,
+)
+async def categorize_batch(chunks: Dict[int, str]) -> str:
+    """
+    You are a world class expert in categorizing text.
+    You are given a batch of text chunks, each wrapped in a <chunk id="..."> tag.
+    Please categorise every chunk into one or more unique categories,
+    and return the categories of each chunk along with its id.
+    """
+    return "\n".join(
+        f'<chunk id="{id}">\n{content}\n</chunk>' for id, content in chunks.items()
+    )
+
+
+def content_sha(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+# semaphores are bound to the event loop they are used in
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _semaphore() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(config.categorise_concurrency)
+    return _semaphores[loop]
+
+
+async def _categorise(contents: Dict[str, str]) -> Dict[str, List[str]]:
+    """
+    Categorise one batch of contents keyed by their sha.
+    """
+    shas = list(contents.keys())
+    async with _semaphore():
+        result = await categorize_batch(
+            {idx: contents[sha] for idx, sha in enumerate(shas)}
+        )
+
+    categories = {}
+    for chunk in result.chunks:
+        if 0 <= chunk.id < len(shas):
+            categories[shas[chunk.id]] = [cat.value for cat in chunk.categories]
+
+    if len(categories) < len(shas):
+        logger.warning(
+            "chunks missing from the categorisation result",
+            expected=len(shas),
+            categorised=len(categories),
+        )
+    return categories
+
+
+async def categorise_contents(
+    contents: List[str],
+    session: Session | None = None,
+    batch_size: int | None = None,
+) -> List[List[str]]:
+    """
+    Categorise the chunk contents, returning the categories of each content.
+
+    The chunks are categorised in batches of `batch_size` per llm call, with the
+    llm calls bounded by `config.categorise_concurrency` across all the tasks
+    of the event loop. When a session is given, the categories are cached by
+    the content sha, so that re-ingested chunks are not categorised again.
+    """
+    batch_size = batch_size or config.categorise_batch_size
+
+    shas = [content_sha(content) for content in contents]
+    categories = (
+        await ChunkCategoryRecord.find_by_shas(session, list(set(shas)))
+        if session is not None
+        else {}
+    )
+
+    missing = {}
+    for sha, content in zip(shas, contents):
+        if sha not in categories:
+            missing[sha] = content
+
+    logger.info(
+        "categorising chunks",
+        chunks=len(contents),
+        cached=len(contents) - sum(1 for sha in shas if sha in missing),
+        missing=len(missing),
+    )
+
+    missing_shas = list(missing.keys())
+    batches = [
+        {sha: missing[sha] for sha in missing_shas[i : i + batch_size]}
+        for i in range(0, len(missing_shas), batch_size)
+    ]
+    categorised = {}
+    for result in await asyncio.gather(*[_categorise(batch) for batch in batches]):
+        categorised.update(result)
+
+    if session is not None and categorised:
+        await ChunkCategoryRecord.save_all(session, categorised)
+
+    categories.update(categorised)
+    return [categories.get(sha, []) for sha in shas]
@@ -1,5 +1,7 @@
 from opsmate.ingestions.base import Document
 from opsmate.textsplitters import TextSplitter
+from opsmate.textsplitters.parallel import parallel_splitter
+from typing import Dict, Any, List, Tuple
 import structlog
 
 logger = structlog.get_logger(__name__)
@@ -21,3 +23,30 @@ async def chunk_document(splitter: TextSplitter, document: Document):
         ch.metadata["data_source_provider"] = document.data_provider
 
         yield ch
+
+
+async def split_document(
+    splitter_config: Dict[str, Any], document: Document
+) -> List[Tuple[int, str, Dict[str, Any]]]:
+    """
+    Chunk the individual document into (id, content, metadata) tuples.
+
+    Large documents are split in the process pool rather than on the event loop.
+    """
+    pieces = await parallel_splitter().split(splitter_config, document.content)
+    logger.info(
+        "chunked document", document=document.metadata["path"], chunks=len(pieces)
+    )
+    return [
+        (
+            chunk_idx,
+            content,
+            {
+                **metadata,
+                **document.metadata,
+                "data_source": document.data_source,
+                "data_source_provider": document.data_provider,
+            },
+        )
+        for chunk_idx, (content, metadata) in enumerate(pieces)
+    ]
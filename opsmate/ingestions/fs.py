@@ -1,40 +1,241 @@
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Any, Tuple, Iterable
 from .base import BaseIngestion, Document
 from pydantic import Field
 from glob import glob
+from fnmatch import fnmatch
 from os import path
 from pathlib import Path
 from typing import Dict, List
 from hashlib import sha256
+from collections import deque
+import asyncio
+import os
+from stat import S_ISDIR
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+# the size of the header read to tell the binary files apart
+HEADER_SIZE = 8192
+
+
+def file_stat(st: os.stat_result) -> Dict[str, int]:
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino}
+
+
+def glob_match(names: List[str], patterns: List[str]) -> bool:
+    """
+    Whether the path components match the components of a recursive glob
+    pattern. Unlike fnmatch a `*` never matches across a path separator, `**`
+    matches any number of directories, and the hidden files and directories
+    are only matched by a pattern starting with a dot, as in `glob`.
+    """
+    if not patterns:
+        return not names
+    pattern, rest = patterns[0], patterns[1:]
+    if pattern == "**":
+        for i in range(len(names) + 1):
+            if glob_match(names[i:], rest):
+                return True
+            if i < len(names) and names[i].startswith("."):
+                return False
+        return False
+    if not names or (names[0].startswith(".") and not pattern.startswith(".")):
+        return False
+    return fnmatch(names[0], pattern) and glob_match(names[1:], rest)
 
 
 class FsIngestion(BaseIngestion):
     local_path: str = Field(..., description="The local path to the files")
     glob_pattern: str = Field("**/*", description="The glob pattern to match the files")
+    manifest: Dict[str, Dict[str, Any]] = Field(
+        default_factory=dict,
+        description="The size, mtime_ns, inode and sha of the already ingested files keyed by path. Files with an unchanged stat are not read, and the files no longer found are yielded as deleted",
+    )
+    max_file_size: int = Field(
+        10 * 1024 * 1024, description="The files larger than this are skipped"
+    )
+    concurrency: int = Field(8, description="The number of files read concurrently")
 
     async def load(self) -> AsyncGenerator[Document, None]:
-        glob_pattern = path.join(self.local_path, self.glob_pattern)
-        files = glob(glob_pattern, recursive=True)
-        for filename in files:
-            # skip if filename is a directory
-            if path.isdir(filename):
+        files = await asyncio.to_thread(self.scan)
+
+        changed = deque()
+        unchanged = 0
+        deleted = set(self.manifest.keys()) - {full_path for full_path, _ in files}
+        for full_path, stat in files:
+            known = self.manifest.get(full_path)
+            if known is not None and all(
+                known.get(key) == value for key, value in stat.items()
+            ):
+                unchanged += 1
+                continue
+            # oversized files are told apart from the stat without reading them
+            if stat["size"] > self.max_file_size:
+                logger.info(
+                    "skipping oversized file",
+                    path=full_path,
+                    max_size=self.max_file_size,
+                )
+                if known is not None:
+                    deleted.add(full_path)
+                continue
+            changed.append((full_path, stat))
+
+        logger.info(
+            "fs ingestion scanned",
+            data_source=self.data_source(),
+            changed=len(changed),
+            unchanged=unchanged,
+            deleted=len(deleted),
+        )
+
+        # read and hash the changed files in a thread pool, yielding them in the glob order
+        reads = deque()
+        try:
+            while changed or reads:
+                while changed and len(reads) < self.concurrency:
+                    full_path, stat = changed.popleft()
+                    reads.append(
+                        (full_path, stat, asyncio.create_task(self.read(full_path)))
+                    )
+
+                full_path, stat, task = reads.popleft()
+                result = await task
+                if result is None:
+                    # no longer ingestible, e.g. it has become binary or too large
+                    if full_path in self.manifest:
+                        deleted.add(full_path)
+                    continue
+
+                content, sha = result
+                yield Document(
+                    data_provider=self.data_source_provider(),
+                    data_source=self.data_source(),
+                    content=content,
+                    metadata={
+                        "name": path.basename(full_path),
+                        "path": full_path,
+                        "sha": sha,
+                        "stat": stat,
+                    },
+                )
+        finally:
+            for _, _, task in reads:
+                task.cancel()
+
+        for full_path in sorted(deleted):
+            yield Document(
+                data_provider=self.data_source_provider(),
+                data_source=self.data_source(),
+                content="",
+                deleted=True,
+                metadata={"name": path.basename(full_path), "path": full_path},
+            )
+
+    async def load_paths(self, paths: Iterable[str]) -> AsyncGenerator[Document, None]:
+        """
+        Load the documents of the given paths, e.g. the ones reported by a file
+        watcher. The paths not matching the glob pattern are ignored, and the
+        paths no longer found or no longer ingestible are yielded as deleted.
+        """
+        for full_path in sorted({path.abspath(p) for p in paths if self.match(p)}):
+            try:
+                st = await asyncio.to_thread(os.stat, full_path)
+            except FileNotFoundError:
+                st = None
+            if st is not None and S_ISDIR(st.st_mode):
                 continue
-            with open(filename, "r") as f:
-                content = f.read()
-            base_name = path.basename(filename)
-            full_path = path.abspath(filename)
-            sha = sha256(content.encode("utf-8")).hexdigest()
+
+            result = None
+            if st is not None and st.st_size <= self.max_file_size:
+                result = await self.read(full_path)
+            if result is None:
+                # removed, or no longer ingestible e.g. it has become binary or too large
+                yield Document(
+                    data_provider=self.data_source_provider(),
+                    data_source=self.data_source(),
+                    content="",
+                    deleted=True,
+                    metadata={"name": path.basename(full_path), "path": full_path},
+                )
+                continue
+
+            content, sha = result
             yield Document(
                 data_provider=self.data_source_provider(),
                 data_source=self.data_source(),
                 content=content,
                 metadata={
-                    "name": base_name,
+                    "name": path.basename(full_path),
                     "path": full_path,
                     "sha": sha,
+                    "stat": file_stat(st),
                 },
             )
 
+    def match(self, filename: str) -> bool:
+        """
+        Whether the file matches the glob pattern of the ingestion, with the
+        semantics of the `glob` of `scan`.
+        """
+        pattern = path.normpath(
+            path.join(path.abspath(self.local_path), self.glob_pattern)
+        )
+        return glob_match(path.abspath(filename).split(os.sep), pattern.split(os.sep))
+
+    def scan(self) -> List[Tuple[str, Dict[str, int]]]:
+        """
+        Glob the files and stat them.
+        """
+        glob_pattern = path.join(self.local_path, self.glob_pattern)
+        files = []
+        for filename in sorted(glob(glob_pattern, recursive=True)):
+            try:
+                st = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            # skip if filename is a directory
+            if path.isdir(filename):
+                continue
+            files.append((path.abspath(filename), file_stat(st)))
+        return files
+
+    async def read(self, filename: str) -> Tuple[str, str] | None:
+        """
+        Read and hash the text file off the event loop.
+        Returns None for the binary, oversized, unreadable or non utf-8 files.
+        """
+        return await asyncio.to_thread(self._read, filename)
+
+    def _read(self, filename: str) -> Tuple[str, str] | None:
+        try:
+            with open(filename, "rb") as f:
+                header = f.read(HEADER_SIZE)
+                if b"\0" in header:
+                    logger.info("skipping binary file", path=filename)
+                    return None
+                # read one byte past the limit to tell the oversized files apart
+                data = header + f.read(max(0, self.max_file_size + 1 - len(header)))
+        except OSError as e:
+            logger.warning("failed to read file", path=filename, error=str(e))
+            return None
+
+        if len(data) > self.max_file_size:
+            logger.info(
+                "skipping oversized file", path=filename, max_size=self.max_file_size
+            )
+            return None
+        try:
+            content = data.decode("utf-8")
+        except UnicodeDecodeError:
+            logger.info("skipping non utf-8 file", path=filename)
+            return None
+        # normalise the newlines as the text mode reads do, the sha is that of
+        # the text so that it matches the sha of the already ingested documents
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+        return content, sha256(content.encode("utf-8")).hexdigest()
+
     def data_source(self) -> str:
         return str(Path(self.local_path) / self.glob_pattern)
 
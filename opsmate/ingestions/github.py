@@ -1,13 +1,114 @@
-from typing import AsyncGenerator, Optional
+from typing import AsyncGenerator, Optional, Any, Tuple, Literal
 from .base import BaseIngestion, Document
-from pydantic import Field, model_validator
+from pydantic import Field, PrivateAttr, model_validator
+from collections import OrderedDict
+from contextlib import aclosing, suppress
 import os
+import time
 import httpx
 import asyncio
 import base64
 import fnmatch
+import hashlib
+import tarfile
+import threading
+import structlog
+from opsmate.tools.http_clients import http_client
 from typing import Dict, List
 
+logger = structlog.get_logger(__name__)
+
+
+class ETagCache:
+    """
+    LRU cache of the GitHub tree listings keyed by url, used for conditional requests.
+
+    A `304 Not Modified` response to a conditional request does not count
+    against the GitHub rate limit. The cache is bounded by the size of the
+    response payloads. The file contents are not cached, the unchanged blobs
+    are skipped by their sha in the tree rather than fetched again.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[str, Tuple[str, Any, int]] = OrderedDict()
+
+    def get(self, url: str) -> Tuple[str, Any] | None:
+        entry = self._entries.get(url)
+        if entry is None:
+            return None
+        self._entries.move_to_end(url)
+        return entry[0], entry[1]
+
+    def set(self, url: str, etag: str, body: Any, size: int):
+        if size > self.max_bytes:
+            return
+        previous = self._entries.pop(url, None)
+        if previous is not None:
+            self.size -= previous[2]
+        self._entries[url] = (etag, body, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.size -= evicted
+
+
+etag_cache = ETagCache()
+
+
+def _int_header(response: httpx.Response, name: str) -> int | None:
+    try:
+        return int(response.headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def github_client(api_url: str = "https://api.github.com") -> httpx.AsyncClient:
+    """
+    The pooled keep-alive client shared by the github ingestions of the current
+    event loop, closed along with the other http clients at shutdown.
+    """
+    return http_client(api_url)
+
+
+def _blob_sha(data: bytes) -> str:
+    """
+    The git blob sha1 of the data, same as the sha in the GitHub tree.
+    """
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+class _QueueReader:
+    """
+    A blocking file-like reader over the byte chunks put in the asyncio queue,
+    to be read from a thread other than the event loop one.
+    """
+
+    def __init__(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+        self.queue = queue
+        self.loop = loop
+        self.buffer = bytearray()
+        self.eof = False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            chunk = asyncio.run_coroutine_threadsafe(
+                self.queue.get(), self.loop
+            ).result()
+            if chunk is None:
+                self.eof = True
+            elif isinstance(chunk, BaseException):
+                raise OSError("failed to download the archive") from chunk
+            else:
+                self.buffer.extend(chunk)
+
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
 
 class GithubIngestion(BaseIngestion):
     repo: str = Field(..., description="The repository in the format of owner/repo")
@@ -20,10 +121,24 @@ class GithubIngestion(BaseIngestion):
     branch: str = Field("main", description="The branch to ingest")
     path: str = Field("", description="The path to ingest")
     client: Optional[httpx.AsyncClient] = Field(
-        description="The HTTP client to use", default_factory=httpx.AsyncClient
+        description="The HTTP client to use, defaults to the pooled client shared by the github ingestions",
+        default=None,
     )
     concurrency: int = Field(10, description="The concurrency to use")
     glob: str = Field("", description="The glob patternto use")
+    known_shas: Dict[str, str] = Field(
+        default_factory=dict,
+        description="The blob shas of the already ingested files keyed by path, unchanged files are not fetched",
+    )
+    max_rate_limit_wait: float = Field(
+        900, description="The maximum seconds to wait for the rate limit to reset"
+    )
+    fetch_mode: Literal["api", "archive"] = Field(
+        "api",
+        description="api fetches the files one by one via the contents API, archive streams the tarball of the branch",
+    )
+
+    _rate_limit_reset: float | None = PrivateAttr(default=None)
 
     @model_validator(mode="before")
     @classmethod
@@ -36,6 +151,10 @@ class GithubIngestion(BaseIngestion):
         v["github_token"] = token
         return v
 
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        return self.client or github_client(self.github_api_url)
+
     @property
     def headers(self):
         return {
@@ -45,29 +164,101 @@ class GithubIngestion(BaseIngestion):
             "X-GitHub-Api-Version": "2022-11-28",
         }
 
-    async def get_files(self) -> AsyncGenerator[str, None]:
+    async def get(self, url: str, max_retries: int = 3, cache: bool = False) -> Any:
+        """
+        GET the GitHub API url and return the json body.
+
+        With `cache`, the request is conditional when the url has been fetched
+        before. The request waits for the rate limit to reset once it is
+        exhausted.
+        """
+        for attempt in range(max_retries + 1):
+            await self._wait_for_rate_limit()
+
+            headers = self.headers
+            cached = etag_cache.get(url) if cache else None
+            if cached is not None:
+                headers = {**headers, "If-None-Match": cached[0]}
+
+            response = await self.http_client.get(url, headers=headers)
+            self._record_rate_limit(response)
+
+            try:
+                response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                status_code = e.response.status_code
+                if status_code == 304 and cached is not None:
+                    return cached[1]
+                if status_code in (403, 429) and attempt < max_retries:
+                    retry_after = _int_header(response, "retry-after")
+                    if retry_after is not None or self._rate_limit_reset is not None:
+                        logger.warning(
+                            "github rate limit exceeded, retrying",
+                            url=url,
+                            retry_after=retry_after,
+                        )
+                        if retry_after is not None:
+                            await asyncio.sleep(
+                                min(retry_after, self.max_rate_limit_wait)
+                            )
+                        continue
+                raise
+
+            body = response.json()
+            etag = response.headers.get("etag")
+            if cache and isinstance(etag, str):
+                etag_cache.set(url, etag, body, len(response.content))
+            return body
+
+    def _record_rate_limit(self, response: httpx.Response):
+        remaining = _int_header(response, "x-ratelimit-remaining")
+        reset = _int_header(response, "x-ratelimit-reset")
+        if remaining == 0 and reset is not None:
+            self._rate_limit_reset = reset
+        else:
+            self._rate_limit_reset = None
+
+    async def _wait_for_rate_limit(self):
+        if self._rate_limit_reset is None:
+            return
+        wait = self._rate_limit_reset - time.time()
+        if wait > 0:
+            logger.warning("github rate limit exhausted, waiting for reset", wait=wait)
+            await asyncio.sleep(min(wait, self.max_rate_limit_wait))
+        self._rate_limit_reset = None
+
+    async def get_blobs(self) -> AsyncGenerator[Tuple[str, str], None]:
+        """
+        Yield the path and the blob sha of the files in the tree.
+        """
         # https://api.github.com/repos/OWNER/REPO/git/trees/TREE_SHA
         url = f"{self.github_api_url}/repos/{self.repo}/git/trees/{self.branch}?recursive=1"
-        response = await self.client.get(url, headers=self.headers)
-        response.raise_for_status()
+        body = await self.get(url, cache=True)
 
-        tree = response.json().get("tree")
+        tree = body.get("tree")
         for item in tree:
             if item.get("type") == "blob":
                 path = item.get("path")
-                if self.path != "" and not path.startswith(self.path):
-                    continue
-                if self.glob and not fnmatch.fnmatch(f"./{path}", self.glob):
+                if not self.match(path):
                     continue
-                yield path
+                yield path, item.get("sha")
+
+    def match(self, path: str) -> bool:
+        if self.path != "" and not path.startswith(self.path):
+            return False
+        if self.glob and not fnmatch.fnmatch(f"./{path}", self.glob):
+            return False
+        return True
+
+    async def get_files(self) -> AsyncGenerator[str, None]:
+        async for path, _ in self.get_blobs():
+            yield path
 
     async def get_file_with_metadata(self, file_path: str) -> Dict[str, str]:
         # https://docs.github.com/en/rest/repos/contents?apiVersion=2022-11-28
         url = f"{self.github_api_url}/repos/{self.repo}/contents/{file_path}"
 
-        response = await self.client.get(url, headers=self.headers)
-        response.raise_for_status()
-        body = response.json()
+        body = await self.get(url)
         content_encoded = body.get("content")
         return {
             "content": base64.b64decode(content_encoded).decode("utf-8"),
@@ -76,32 +267,196 @@ class GithubIngestion(BaseIngestion):
         }
 
     async def load(self) -> AsyncGenerator[Document, None]:
-        # semaphore to limit the number of concurrent requests
-        semaphore = asyncio.Semaphore(self.concurrency)
+        if self.fetch_mode == "archive":
+            async with aclosing(self.load_archive()) as docs:
+                async for doc in docs:
+                    yield doc
+            return
+
+        # bounded pipeline: the tree listing feeds `concurrency` fetchers, and the
+        # fetchers block once `concurrency` documents are waiting for the consumer
+        files: asyncio.Queue[str | None] = asyncio.Queue(maxsize=self.concurrency)
+        docs: asyncio.Queue[Document | Exception | None] = asyncio.Queue(
+            maxsize=self.concurrency
+        )
+
+        async def list_files():
+            changed, unchanged = 0, 0
+            async for file, sha in self.get_blobs():
+                # the tree already carries the blob sha, only fetch the changed blobs
+                if sha is not None and self.known_shas.get(file) == sha:
+                    unchanged += 1
+                    continue
+                changed += 1
+                await files.put(file)
+
+            logger.info(
+                "github tree diffed",
+                repo=self.repo,
+                branch=self.branch,
+                changed=changed,
+                unchanged=unchanged,
+            )
+            for _ in range(self.concurrency):
+                await files.put(None)
+
+        async def fetch_files():
+            while (file := await files.get()) is not None:
+                await docs.put(await self.fetch_document(file))
+
+        async def pipeline():
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    tg.create_task(list_files())
+                    for _ in range(self.concurrency):
+                        tg.create_task(fetch_files())
+                await docs.put(None)
+            except ExceptionGroup as e:
+                await docs.put(e.exceptions[0])
+
+        task = asyncio.create_task(pipeline())
+        try:
+            while (doc := await docs.get()) is not None:
+                if isinstance(doc, Exception):
+                    raise doc
+                yield doc
+        finally:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+
+    async def fetch_document(self, file: str) -> Document:
+        content_with_metadata = await self.get_file_with_metadata(file)
+        return Document(
+            data_provider=self.data_source_provider(),
+            data_source=self.data_source(),
+            content=content_with_metadata.get("content"),
+            metadata={
+                "path": file,
+                "repo": self.repo,
+                "branch": self.branch,
+                "source": content_with_metadata.get("html_url"),
+                "sha": content_with_metadata.get("sha"),
+            },
+        )
+
+    async def load_archive(self) -> AsyncGenerator[Document, None]:
+        """
+        Load the documents from the tarball of the branch.
+
+        The tarball is streamed into the extraction, which runs in a thread,
+        and the documents are yielded while the extraction is still running.
+        """
+        # https://docs.github.com/en/rest/repos/contents#download-a-repository-archive-tar
+        url = f"{self.github_api_url}/repos/{self.repo}/tarball/{self.branch}"
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue[bytes | Exception | None] = asyncio.Queue(maxsize=16)
+        files: asyncio.Queue[Tuple[str, str, str] | None] = asyncio.Queue(
+            maxsize=self.concurrency
+        )
+        stopped = threading.Event()
+
+        async def download():
+            try:
+                await self._wait_for_rate_limit()
+                async with self.http_client.stream(
+                    "GET", url, headers=self.headers, follow_redirects=True
+                ) as response:
+                    self._record_rate_limit(response)
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes():
+                        await chunks.put(chunk)
+                await chunks.put(None)
+            except Exception as e:
+                await chunks.put(e)
+                raise
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(files.put(item), loop).result()
+
+        def extract():
+            try:
+                reader = _QueueReader(chunks, loop)
+                with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+                    for member in tar:
+                        if stopped.is_set():
+                            return
+                        if not member.isfile():
+                            continue
+                        # strip the owner-repo-sha/ top directory of the archive
+                        _, _, path = member.name.partition("/")
+                        if not path or not self.match(path):
+                            continue
+                        data = tar.extractfile(member).read()
+                        sha = _blob_sha(data)
+                        if self.known_shas.get(path) == sha:
+                            continue
+                        try:
+                            content = data.decode("utf-8")
+                        except UnicodeDecodeError:
+                            logger.warning("skipping non utf-8 file", path=path)
+                            continue
+                        put((path, sha, content))
+            finally:
+                if not stopped.is_set():
+                    put(None)
 
-        async def process_file(file: str) -> Document:
-            async with semaphore:
-                content_with_metadata = await self.get_file_with_metadata(file)
-                return Document(
+        download_task = asyncio.create_task(download())
+        extract_task = asyncio.ensure_future(asyncio.to_thread(extract))
+        count = 0
+        try:
+            while (item := await files.get()) is not None:
+                path, sha, content = item
+                count += 1
+                yield Document(
                     data_provider=self.data_source_provider(),
                     data_source=self.data_source(),
-                    content=content_with_metadata.get("content"),
+                    content=content,
                     metadata={
-                        "path": file,
+                        "path": path,
                         "repo": self.repo,
                         "branch": self.branch,
-                        "source": content_with_metadata.get("html_url"),
-                        "sha": content_with_metadata.get("sha"),
+                        "source": self.html_url(path),
+                        "sha": sha,
                     },
                 )
+            try:
+                await extract_task
+            except Exception:
+                # the download error is more telling than the truncated archive
+                if download_task.done() and download_task.exception():
+                    raise download_task.exception()
+                raise
+            await download_task
+        finally:
+            stopped.set()
+            if not download_task.done():
+                download_task.cancel()
+            # unblock the extraction thread when the consumer stops early
+            while not extract_task.done():
+                while not files.empty():
+                    files.get_nowait()
+                if chunks.empty():
+                    chunks.put_nowait(None)
+                await asyncio.sleep(0.01)
+            if not extract_task.cancelled():
+                # mark the error of an abandoned extraction as retrieved
+                extract_task.exception()
 
-        tasks = [
-            asyncio.create_task(process_file(file)) async for file in self.get_files()
-        ]
+        logger.info(
+            "github archive extracted",
+            repo=self.repo,
+            branch=self.branch,
+            documents=count,
+        )
 
-        # Process completed tasks
-        for task in asyncio.as_completed(tasks):
-            yield await task
+    def html_url(self, path: str) -> str:
+        if self.github_api_url == "https://api.github.com":
+            base = "https://github.com"
+        else:
+            # GitHub Enterprise serves the API under /api/v3
+            base = self.github_api_url.removesuffix("/api/v3")
+        return f"{base}/{self.repo}/blob/{self.branch}/{path}"
 
     def data_source(self) -> str:
         return self.repo
@@ -1,42 +1,31 @@
-from opsmate.knowledgestore.models import aconn, Category
+from opsmate.knowledgestore.models import scope_filter
+from opsmate.knowledgestore.router import shard_buffer, shard_table, shard_tables
+from opsmate.knowledgestore.writer import chunk_uuids, knowledge_batch
+from opsmate.knowledgestore.dedup import (
+    dedup_batch,
+    open_signatures_table,
+    release_duplicates,
+    rewritten_chunks,
+    signatures_buffer,
+)
 from opsmate.ingestions.base import Document
-from opsmate.ingestions.chunk import chunk_document
+from opsmate.ingestions.chunk import split_document
+from opsmate.ingestions.categorise import categorise_contents
 from opsmate.ingestions.fs import FsIngestion
 from opsmate.ingestions.github import GithubIngestion
 from opsmate.ingestions.models import IngestionRecord, DocumentRecord
 from opsmate.config import config
 from opsmate.dbq.dbq import enqueue_task, dbq_task
-from opsmate.dino import dino
-from opsmate.textsplitters import splitter_from_config
-from typing import Dict, Any, List
+from typing import Dict, Any
 from datetime import datetime, UTC, timedelta
-import asyncio
-import uuid
 import json
+import asyncio
 import random
 import structlog
 
 logger = structlog.get_logger()
 
 
-@dino(
-    model="gpt-4o-mini",
-    response_model=List[Category],
-)
-async def categorize(text: str) -> str:
-    f"""
-    You are a world class expert in categorizing text.
-    Please categorise the text into one or more unique categories:
-    """
-    return text
-
-
-async def categorize_kb(kb: Dict[str, Any]):
-    categories = await categorize(kb["content"])
-    kb["categories"] = [cat.value for cat in categories]
-    return kb
-
-
 def backoff_func(retry_count: int):
     return datetime.now(UTC) + timedelta(
         milliseconds=2 ** (retry_count - 1) + random.uniform(0, 10)
@@ -66,6 +55,8 @@ async def chunk_and_store(
 
     doc = Document(**doc)
     path = doc.metadata["path"]
+    # the file stat is tracked on the document record rather than in the chunks
+    stat = doc.metadata.pop("stat", None)
 
     doc_record = await DocumentRecord.find_by_ingestion_id_and_path(
         session, ingestion_record.id, path
@@ -80,63 +71,87 @@ async def chunk_and_store(
                 ingestion_record_id=ingestion_record.id,
                 path=path,
             )
+            if stat is not None:
+                # the file is touched but unchanged, skip reading it next time
+                doc_record.update_stat(session, stat)
             return
-    else:
-        doc_record = await DocumentRecord.find_or_create(
-            session,
-            ingestion_record.id,
-            path,
-            doc.metadata.get("sha", ""),
-            splitter_config,
-        )
-
-    splitter = splitter_from_config(splitter_config)
-    db_conn = await aconn()
-    table = await db_conn.open_table("knowledge_store")
-
-    kbs = []
-    async for chunk in chunk_document(splitter=splitter, document=doc):
-        kbs.append(
-            {
-                "uuid": str(uuid.uuid4()),
-                "id": chunk.id,
-                # "summary": chunk.metadata["summary"],
-                "categories": [],
-                "data_source_provider": doc.data_provider,
-                "data_source": doc.data_source,
-                "metadata": json.dumps(chunk.metadata),
-                "path": path,
-                "content": chunk.content,
-                "created_at": datetime.now(),
-            }
-        )
 
+    chunks = await split_document(splitter_config, doc)
+    contents = [content for _, content, _ in chunks]
+    categories = None
     if config.categorise:
-        tasks = [categorize_kb(kb) for kb in kbs]
-        await asyncio.gather(*tasks)
+        categories = await categorise_contents(contents, session=session)
 
-    logger.info(
-        "deleting chunks from data source",
+    # the chunks are built column-wise straight into an arrow record batch
+    ids = [chunk_id for chunk_id, _, _ in chunks]
+    kbs = knowledge_batch(
+        contents,
+        ids=ids,
+        # stable across re-ingestions, the near-duplicates may point at them
+        uuids=chunk_uuids(ingestion_record.id, path, ids),
+        metadata=[json.dumps(metadata) for _, _, metadata in chunks],
+        categories=categories,
         data_source_provider=doc.data_provider,
         data_source=doc.data_source,
         path=path,
     )
-    await table.delete(
-        f"data_source_provider = '{doc.data_provider}'"
-        f"AND data_source = '{doc.data_source}'"
-        f"AND path = '{path}'"
+
+    scope = scope_filter(
+        data_source_provider=doc.data_provider,
+        data_source=doc.data_source,
+        path=path,
     )
+    signatures = None
+    rewritten = set()
+    if config.dedup:
+        signatures_table = await open_signatures_table()
+        knowledge_store = await shard_table(doc.data_provider)
+        # near-duplicates reuse the vector of their canonical chunk
+        kbs, signatures = await dedup_batch(
+            kbs,
+            scope,
+            config.dedup_threshold,
+            signatures=signatures_table,
+            knowledge_store=knowledge_store,
+        )
+        rewritten = await rewritten_chunks(
+            signatures_table, scope, signatures, config.dedup_threshold
+        )
 
-    await table.add(kbs)
+    # the write is coalesced with the other chunk_and_store tasks of the worker
+    # and only returns once the chunks are flushed into the knowledge store
+    writes = [shard_buffer(doc.data_provider).replace(scope, kbs)]
+    if signatures is not None:
+        writes.append(signatures_buffer().replace(scope, signatures))
 
-    doc_record.update_chunk_count(session, len(kbs))
+    logger.info(
+        "replacing chunks from data source",
+        data_source_provider=doc.data_provider,
+        data_source=doc.data_source,
+        path=path,
+    )
+    await asyncio.gather(*writes)
+    if rewritten:
+        # the chunks pointing at the old content are no longer its duplicates
+        await release_duplicates(rewritten, knowledge_store, signatures_table)
+
+    # only recorded once the chunks are stored, so that a retry is not skipped
+    doc_record = await DocumentRecord.find_or_create(
+        session,
+        ingestion_record.id,
+        path,
+        doc.metadata.get("sha", ""),
+        splitter_config,
+        stat=stat,
+    )
+    doc_record.update_chunk_count(session, kbs.num_rows)
 
     logger.info(
         "chunks stored",
         data_provider=doc.data_provider,
         data_source=doc.data_source,
         path=path,
-        num_kbs=len(kbs),
+        num_kbs=kbs.num_rows,
     )
 
 
@@ -159,7 +174,33 @@ async def ingest(
         session, ingestor_type, ingestor_config
     )
 
+    if isinstance(ingestion, GithubIngestion):
+        # skip fetching the blobs that are unchanged since the last ingestion
+        ingestion.known_shas = await DocumentRecord.find_shas_by_ingestion_id(
+            session, ingestion_record.id, splitter_config
+        )
+    elif isinstance(ingestion, FsIngestion):
+        # skip reading the files whose stat is unchanged since the last ingestion
+        ingestion.manifest = await DocumentRecord.find_manifest_by_ingestion_id(
+            session, ingestion_record.id, splitter_config
+        )
+
     async for doc in ingestion.load():
+        if doc.deleted:
+            logger.info(
+                "deleting document",
+                ingestor_type=ingestor_type,
+                ingestor_config=ingestor_config,
+                doc_path=doc.metadata["path"],
+            )
+            enqueue_task(
+                session,
+                delete_document,
+                ingestion_record.id,
+                doc=doc.model_dump(),
+            )
+            continue
+
         logger.info(
             "ingesting document",
             ingestor_type=ingestor_type,
@@ -176,6 +217,58 @@ async def ingest(
         )
 
 
+@dbq_task(
+    retry_on=(Exception,),
+    max_retries=10,
+    back_off_func=backoff_func,
+)
+async def delete_document(
+    ingestion_record_id: int,
+    doc: Dict[str, Any] = {},
+    ctx: Dict[str, Any] = {},
+):
+    session = ctx["session"]
+
+    doc = Document(**doc)
+    path = doc.metadata["path"]
+
+    scope = scope_filter(
+        data_source_provider=doc.data_provider,
+        data_source=doc.data_source,
+        path=path,
+    )
+    rewritten = set()
+    if config.dedup:
+        signatures_table = await open_signatures_table()
+        rewritten = await rewritten_chunks(
+            signatures_table, scope, None, config.dedup_threshold
+        )
+
+    # replacing the chunks with nothing removes them from the knowledge store
+    writes = [shard_buffer(doc.data_provider).replace(scope, [])]
+    if config.dedup:
+        writes.append(signatures_buffer().replace(scope, []))
+    await asyncio.gather(*writes)
+    if rewritten:
+        await release_duplicates(
+            rewritten, await shard_table(doc.data_provider), signatures_table
+        )
+
+    doc_record = await DocumentRecord.find_by_ingestion_id_and_path(
+        session, ingestion_record_id, path
+    )
+    if doc_record is not None:
+        session.delete(doc_record)
+        session.commit()
+
+    logger.info(
+        "document deleted",
+        ingestion_record_id=ingestion_record_id,
+        data_source=doc.data_source,
+        path=path,
+    )
+
+
 @dbq_task(
     retry_on=(Exception,),
     max_retries=10,
@@ -195,13 +288,22 @@ async def delete_ingestion(ingestion_record_id: int, ctx: Dict[str, Any] = {}):
     session.delete(ingestion_record)
     session.commit()
 
-    # remove all documents from lancedb
-    db_conn = await aconn()
-    table = await db_conn.open_table("knowledge_store")
-    await table.delete(
-        f"data_source_provider = '{ingestion_record.data_source_provider}'"
-        f"AND data_source = '{ingestion_record.data_source}'"
+    provider = ingestion_record.data_source_provider
+    # flush the buffered writes first so they don't resurrect the deleted chunks
+    await shard_buffer(provider).flush()
+
+    scope = scope_filter(
+        data_source_provider=provider,
+        data_source=ingestion_record.data_source,
     )
+    # remove all documents from lancedb, only the shard of the provider is touched
+    for table in await shard_tables([provider]):
+        await table.delete(scope)
+
+    if config.dedup:
+        await signatures_buffer().flush()
+        signatures = await open_signatures_table()
+        await signatures.delete(scope)
 
 
 def ingestor_from_config(name: str, config: Dict[str, Any]):
@@ -9,8 +9,8 @@ from sqlmodel import (
 )
 from sqlalchemy.orm import registry
 from datetime import datetime, UTC
-from sqlalchemy import MetaData
-from typing import List, Dict, Any
+from sqlalchemy import MetaData, BigInteger
+from typing import List, Dict, Any, Optional
 import structlog
 
 logger = structlog.get_logger(__name__)
@@ -108,6 +108,11 @@ class DocumentRecord(SQLModel, table=True):
     sha: str = Field(nullable=False)
     chunk_config: Dict[str, Any] = Field(sa_column=Column(JSON))
 
+    # the stat of the file when it was ingested, used by FsIngestion
+    size: Optional[int] = Field(default=None, sa_column=Column(BigInteger))
+    mtime_ns: Optional[int] = Field(default=None, sa_column=Column(BigInteger))
+    inode: Optional[int] = Field(default=None, sa_column=Column(BigInteger))
+
     created_at: datetime = Field(default=datetime.now(UTC))
     updated_at: datetime = Field(default=datetime.now(UTC))
 
@@ -119,6 +124,38 @@ class DocumentRecord(SQLModel, table=True):
             select(cls).where(cls.ingestion_id == ingestion_id, cls.path == path)
         ).first()
 
+    @classmethod
+    async def find_shas_by_ingestion_id(
+        cls, session: Session, ingestion_id: int, chunk_config: Dict[str, Any]
+    ) -> Dict[str, str]:
+        """
+        The shas of the documents of the ingestion keyed by path,
+        for the documents that were chunked with the same chunk config.
+        """
+        documents = session.exec(select(cls).where(cls.ingestion_id == ingestion_id))
+        return {
+            document.path: document.sha
+            for document in documents
+            if document.chunk_config == chunk_config
+        }
+
+    @classmethod
+    async def find_manifest_by_ingestion_id(
+        cls, session: Session, ingestion_id: int, chunk_config: Dict[str, Any]
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        The stat and the sha of all the documents of the ingestion keyed by path.
+        The stat is omitted for the documents chunked with another chunk config,
+        so that they are read and chunked again.
+        """
+        documents = session.exec(select(cls).where(cls.ingestion_id == ingestion_id))
+        manifest = {}
+        for document in documents:
+            manifest[document.path] = {"sha": document.sha}
+            if document.chunk_config == chunk_config:
+                manifest[document.path].update(document.stat())
+        return manifest
+
     @classmethod
     async def find_or_create(
         cls,
@@ -127,6 +164,7 @@ class DocumentRecord(SQLModel, table=True):
         path: str,
         sha: str,
         chunk_config: Dict[str, Any],
+        stat: Optional[Dict[str, int]] = None,
     ):
         document = session.exec(
             select(cls).where(cls.ingestion_id == ingestion_id, cls.path == path)
@@ -141,14 +179,118 @@ class DocumentRecord(SQLModel, table=True):
         else:
             document.sha = sha
             document.chunk_config = chunk_config
+        if stat is not None:
+            document.size = stat.get("size")
+            document.mtime_ns = stat.get("mtime_ns")
+            document.inode = stat.get("inode")
 
         session.add(document)
         session.commit()
         session.refresh(document)
         return document
 
+    def stat(self) -> Dict[str, int]:
+        return {
+            key: value
+            for key, value in {
+                "size": self.size,
+                "mtime_ns": self.mtime_ns,
+                "inode": self.inode,
+            }.items()
+            if value is not None
+        }
+
+    def update_stat(self, session: Session, stat: Dict[str, int]):
+        self.size = stat.get("size")
+        self.mtime_ns = stat.get("mtime_ns")
+        self.inode = stat.get("inode")
+        session.add(self)
+        session.commit()
+
     def update_chunk_count(self, session: Session, chunk_count: int):
         self.chunk_count = chunk_count
         self.updated_at = datetime.now(UTC)
         session.add(self)
         session.commit()
+
+
+class ChunkCategoryRecord(SQLModel, table=True):
+    """
+    The categories of a chunk keyed by the sha256 of its content, so that
+    unchanged chunks are not categorised again when they are re-ingested.
+    """
+
+    __tablename__ = "chunk_categories"
+    content_sha: str = Field(primary_key=True)
+    categories: List[str] = Field(sa_column=Column(JSON))
+    created_at: datetime = Field(default=datetime.now(UTC))
+
+    @classmethod
+    async def find_by_shas(
+        cls, session: Session, shas: List[str]
+    ) -> Dict[str, List[str]]:
+        if not shas:
+            return {}
+        records = session.exec(select(cls).where(cls.content_sha.in_(shas))).all()
+        return {record.content_sha: record.categories for record in records}
+
+    @classmethod
+    async def save_all(cls, session: Session, categories: Dict[str, List[str]]):
+        for sha, cats in categories.items():
+            session.merge(cls(content_sha=sha, categories=cats))
+        session.commit()
+
+
+class MetricRecord(SQLModel, table=True):
+    """
+    The fingerprint of a prometheus metric as of its last ingestion, so that
+    the unchanged metrics are not written and embedded again. The metrics
+    gone from the prometheus server are tombstoned with `deleted_at`.
+    """
+
+    __tablename__ = "prometheus_metrics"
+    endpoint: str = Field(primary_key=True)
+    metric_name: str = Field(primary_key=True)
+    fingerprint: str = Field(nullable=False)
+    deleted_at: Optional[datetime] = Field(default=None)
+    updated_at: datetime = Field(default=datetime.now(UTC))
+
+    @classmethod
+    async def find_by_endpoint(
+        cls, session: Session, endpoint: str
+    ) -> Dict[str, "MetricRecord"]:
+        records = session.exec(select(cls).where(cls.endpoint == endpoint)).all()
+        return {record.metric_name: record for record in records}
+
+    @classmethod
+    async def save_fingerprints(
+        cls, session: Session, endpoint: str, fingerprints: Dict[str, str]
+    ):
+        now = datetime.now(UTC)
+        for metric_name, fingerprint in fingerprints.items():
+            session.merge(
+                cls(
+                    endpoint=endpoint,
+                    metric_name=metric_name,
+                    fingerprint=fingerprint,
+                    deleted_at=None,
+                    updated_at=now,
+                )
+            )
+        session.commit()
+
+    @classmethod
+    async def tombstone(cls, session: Session, endpoint: str, metric_names: List[str]):
+        if not metric_names:
+            return
+        now = datetime.now(UTC)
+        records = session.exec(
+            select(cls).where(
+                cls.endpoint == endpoint, cls.metric_name.in_(metric_names)
+            )
+        ).all()
+        for record in records:
+            record.deleted_at = now
+            record.updated_at = now
+            session.add(record)
+        session.commit()
@@ -0,0 +1,99 @@
+from opsmate.ingestions.fs import FsIngestion
+from opsmate.ingestions.jobs import chunk_and_store, delete_document, ingest
+from opsmate.ingestions.models import IngestionRecord
+from opsmate.dbq.dbq import enqueue_task
+from sqlalchemy import Engine
+from sqlmodel import Session
+from typing import Dict, Any, List, Set
+from watchfiles import awatch
+from os import path
+import asyncio
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+
+async def watch_ingestions(
+    engine: Engine,
+    ingestions: List[FsIngestion],
+    splitter_config: Dict[str, Any] = {},
+    debounce_ms: int = 1600,
+    stop_event: asyncio.Event | None = None,
+    initial_ingest: bool = True,
+):
+    """
+    Watch the local paths of the fs ingestions, and enqueue the ingestion of
+    the touched files and the deletion of the removed ones.
+
+    Bursts of file events are debounced by `debounce_ms` milliseconds, and
+    each touched file is enqueued at most once per burst. When `initial_ingest`
+    is set, an incremental ingestion is enqueued first to catch up with the
+    changes made while not watching.
+    """
+    with Session(engine) as session:
+        records = {}
+        for ingestion in ingestions:
+            ingestor_config = {
+                "local_path": ingestion.local_path,
+                "glob_pattern": ingestion.glob_pattern,
+            }
+            record = await IngestionRecord.find_or_create(
+                session, "fs", ingestor_config
+            )
+            records[id(ingestion)] = record.id
+            if initial_ingest:
+                enqueue_task(
+                    session,
+                    ingest,
+                    ingestor_type="fs",
+                    ingestor_config=ingestor_config,
+                    splitter_config=splitter_config,
+                )
+
+    local_paths = {path.abspath(ingestion.local_path) for ingestion in ingestions}
+    logger.info("watching for file changes", paths=sorted(local_paths))
+
+    async for changes in awatch(
+        *local_paths, debounce=debounce_ms, stop_event=stop_event
+    ):
+        changed_paths = {changed_path for _, changed_path in changes}
+        with Session(engine) as session:
+            for ingestion in ingestions:
+                await enqueue_changes(
+                    session,
+                    ingestion,
+                    records[id(ingestion)],
+                    changed_paths,
+                    splitter_config,
+                )
+
+
+async def enqueue_changes(
+    session: Session,
+    ingestion: FsIngestion,
+    ingestion_record_id: int,
+    changed_paths: Set[str],
+    splitter_config: Dict[str, Any] = {},
+) -> int:
+    """
+    Enqueue the ingestion of the changed paths that match the fs ingestion.
+    Returns the number of enqueued tasks.
+    """
+    count = 0
+    async for doc in ingestion.load_paths(changed_paths):
+        count += 1
+        if doc.deleted:
+            logger.info("file removed", path=doc.metadata["path"])
+            enqueue_task(
+                session, delete_document, ingestion_record_id, doc=doc.model_dump()
+            )
+        else:
+            logger.info("file changed", path=doc.metadata["path"])
+            enqueue_task(
+                session,
+                chunk_and_store,
+                ingestion_record_id,
+                splitter_config=splitter_config,
+                doc=doc.model_dump(),
+            )
+    return count
@@ -0,0 +1,194 @@
+from typing import List, Dict, Any, Callable, Awaitable
+from dataclasses import dataclass, field
+from opsmate.config import config
+from opsmate.knowledgestore.models import open_table
+from opsmate.knowledgestore.writer import concat_batches, embed_batch
+from opentelemetry import trace
+import pyarrow as pa
+import asyncio
+import weakref
+import structlog
+
+logger = structlog.get_logger(__name__)
+tracer = trace.get_tracer(__name__)
+
+OpenTable = Callable[[], Awaitable[Any]]
+Rows = List[Dict[str, Any]] | pa.RecordBatch
+
+
+@dataclass
+class _PendingWrite:
+    rows: Rows = field(default_factory=list)
+    waiters: List[asyncio.Future] = field(default_factory=list)
+
+
+class WriteBehindBuffer:
+    """
+    WriteBehindBuffer coalesces the knowledge store writes issued by many
+    concurrent tasks into a single `delete` + `add` per flush.
+
+    Every write is a "replace" of a scope - a SQL predicate such as
+    `path = 'README.md'` - with a new set of rows, given either as dicts or
+    as a record batch. When the same scope is replaced more than once before
+    a flush, only the latest rows are written.
+
+    A flush is triggered once `max_rows` rows are pending, or `max_delay`
+    seconds after the first pending write. Writers are only acknowledged once
+    the flush that carries their rows has been committed, so a successful
+    `replace` still means the rows are durable.
+    """
+
+    def __init__(
+        self,
+        open_table: OpenTable,
+        max_rows: int = 1000,
+        max_delay: float = 0.5,
+    ):
+        self.open_table = open_table
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+
+        self._pending: Dict[str, _PendingWrite] = {}
+        self._pending_rows = 0
+        self._timer: asyncio.TimerHandle | None = None
+        self._lock = asyncio.Lock()
+        self._flush_tasks: set[asyncio.Task] = set()
+
+    @property
+    def pending_rows(self) -> int:
+        return self._pending_rows
+
+    async def replace(self, scope: str, rows: Rows):
+        """
+        Replace all the rows matching the `scope` predicate with `rows`.
+
+        Returns once the rows have been flushed into the table, raises if the flush failed.
+        """
+        waiter = asyncio.get_running_loop().create_future()
+
+        pending = self._pending.get(scope)
+        if pending is None:
+            pending = self._pending[scope] = _PendingWrite()
+        self._pending_rows += len(rows) - len(pending.rows)
+        pending.rows = rows
+        pending.waiters.append(waiter)
+
+        if self._pending_rows >= self.max_rows:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.max_delay, self._schedule_flush
+            )
+
+        await waiter
+
+    async def flush(self):
+        """
+        Flush all the pending writes into the table.
+        """
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            pending, self._pending = self._pending, {}
+            self._pending_rows = 0
+            if not pending:
+                return
+
+            waiters = [waiter for p in pending.values() for waiter in p.waiters]
+            batches = [
+                p.rows
+                for p in pending.values()
+                if isinstance(p.rows, pa.RecordBatch) and p.rows.num_rows
+            ]
+            rows = [
+                row
+                for p in pending.values()
+                if not isinstance(p.rows, pa.RecordBatch)
+                for row in p.rows
+            ]
+            num_rows = len(rows) + sum(batch.num_rows for batch in batches)
+
+            with tracer.start_as_current_span("knowledgestore.buffer.flush") as span:
+                span.set_attributes(
+                    {"buffer.scopes": len(pending), "buffer.rows": num_rows}
+                )
+                try:
+                    table = await self.open_table()
+                    await table.delete(" OR ".join(f"({scope})" for scope in pending))
+                    # the record batches are embedded together and added at once
+                    if batches:
+                        data = await embed_batch(
+                            concat_batches(batches), await table.schema()
+                        )
+                        await table.add(data)
+                    # the embedding function skips any batch that carries vectors,
+                    # so the rows with and without vectors are added separately
+                    with_vectors = [row for row in rows if "vector" in row]
+                    without_vectors = [row for row in rows if "vector" not in row]
+                    for batch in (with_vectors, without_vectors):
+                        if batch:
+                            await table.add(batch)
+                except Exception as e:
+                    logger.error(
+                        "failed to flush knowledge store writes",
+                        scopes=len(pending),
+                        rows=num_rows,
+                        error=str(e),
+                    )
+                    span.record_exception(e)
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                    return
+
+            logger.info(
+                "flushed knowledge store writes", scopes=len(pending), rows=num_rows
+            )
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def close(self):
+        """
+        Flush the pending writes and wait for the in-flight flushes to finish.
+        """
+        await self.flush()
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
+    def _schedule_flush(self):
+        task = asyncio.create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+
+# buffers are bound to the event loop they were created in
+_buffers = weakref.WeakKeyDictionary()
+
+
+def write_buffer(
+    table_name: str = "knowledge_store", opener: OpenTable | None = None
+) -> WriteBehindBuffer:
+    """
+    Get the write-behind buffer of the table for the current event loop.
+    The table is opened with `opener` if given, `open_table` otherwise.
+    """
+    buffers = _buffers.setdefault(asyncio.get_running_loop(), {})
+    if table_name not in buffers:
+        buffers[table_name] = WriteBehindBuffer(
+            opener or (lambda: open_table(table_name)),
+            max_rows=config.embeddings_write_buffer_rows,
+            max_delay=config.embeddings_write_buffer_delay,
+        )
+    return buffers[table_name]
+
+
+async def close_write_buffers():
+    """
+    Flush and close all the write-behind buffers of the current event loop.
+    """
+    buffers = _buffers.pop(asyncio.get_running_loop(), {})
+    for buffer in buffers.values():
+        await buffer.close()
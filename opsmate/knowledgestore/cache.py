@@ -0,0 +1,163 @@
+from typing import Any, Tuple
+from collections import OrderedDict
+from functools import cache
+from pathlib import Path
+from opsmate.config import config
+import hashlib
+import json
+import os
+import tempfile
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize the query so that trivially different queries share the cache entry.
+    """
+    return " ".join(query.lower().split())
+
+
+def cache_key(
+    query: str,
+    filter: str | None = None,
+    top_n: int = 10,
+    reranker: str | None = None,
+) -> str:
+    """
+    The digest of the retrieval parameters, of the knowledge store and of its
+    embedding model, so that the processes sharing the cache directory but not
+    the store never serve each other's entries. The table version is tracked
+    separately.
+    """
+    payload = json.dumps(
+        {
+            "query": normalize_query(query),
+            "filter": filter,
+            "top_n": top_n,
+            "reranker": reranker,
+            "db": config.embeddings_db_path,
+            "embedding": [
+                config.embedding_registry_name,
+                config.embedding_model_name,
+                config.embedding_dimensions,
+            ],
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class RetrievalCache:
+    """
+    RetrievalCache caches the knowledge retrieval results, i.e. the search hits
+    and the llm summaries, keyed by the retrieval parameters and the version
+    of the knowledge store table.
+
+    It has an in-memory LRU tier, and an optional on-disk tier shared across
+    processes when `cache_dir` is provided. Entries are invalidated once the
+    table version advances, as any write to the table bumps the version.
+    """
+
+    def __init__(self, max_entries: int = 256, cache_dir: str | None = None):
+        self.max_entries = max_entries
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self._entries: OrderedDict[Tuple[str, str], Tuple[int, Any]] = OrderedDict()
+        self._version: int | None = None
+
+    def get(self, key: str, kind: str, version: int) -> Any | None:
+        """
+        Get the cached `kind` ("hits" or "summary") of the key at the table version.
+        """
+        self._advance(version)
+
+        entry = self._entries.get((key, kind))
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end((key, kind))
+            return entry[1]
+
+        value = self._read(key, kind, version)
+        if value is not None:
+            self._put(key, kind, version, value)
+        return value
+
+    def set(self, key: str, kind: str, version: int, value: Any):
+        self._advance(version)
+        self._put(key, kind, version, value)
+        self._write(key, kind, version, value)
+
+    def clear(self):
+        self._entries.clear()
+        self._version = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _put(self, key: str, kind: str, version: int, value: Any):
+        self._entries[(key, kind)] = (version, value)
+        self._entries.move_to_end((key, kind))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _advance(self, version: int):
+        if self._version is not None and version <= self._version:
+            return
+
+        if self._version is not None:
+            logger.info(
+                "knowledge store version advanced, invalidating retrieval cache",
+                old_version=self._version,
+                new_version=version,
+            )
+            self._entries = OrderedDict(
+                (k, v) for k, v in self._entries.items() if v[0] >= version
+            )
+            self._purge_disk(version)
+        self._version = version
+
+    def _path(self, key: str, kind: str, version: int) -> Path:
+        return self.cache_dir / f"{version}-{key}-{kind}.json"
+
+    def _read(self, key: str, kind: str, version: int) -> Any | None:
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key, kind, version)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("failed to read retrieval cache entry", error=str(e))
+            return None
+
+    def _write(self, key: str, kind: str, version: int, value: Any):
+        if not self.cache_dir:
+            return
+        try:
+            # write then rename so that concurrent readers never see partial entries
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(value, f, default=str)
+            os.replace(tmp, self._path(key, kind, version))
+        except (OSError, TypeError) as e:
+            logger.warning("failed to write retrieval cache entry", error=str(e))
+
+    def _purge_disk(self, version: int):
+        if not self.cache_dir:
+            return
+        for path in self.cache_dir.glob("*.json"):
+            entry_version, _, _ = path.name.partition("-")
+            if entry_version.isdigit() and int(entry_version) < version:
+                path.unlink(missing_ok=True)
+
+
+@cache
+def retrieval_cache() -> RetrievalCache:
+    return RetrievalCache(
+        max_entries=config.retrieval_cache_size,
+        cache_dir=config.retrieval_cache_dir or None,
+    )
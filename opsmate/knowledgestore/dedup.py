@@ -0,0 +1,321 @@
+from typing import List, Dict, Any, Iterable, Set, Tuple
+from lancedb.index import LabelList, BTree, Bitmap
+from lancedb.table import AsyncTable
+from opentelemetry import trace
+from opsmate.knowledgestore.models import handles, sql_literal
+from opsmate.knowledgestore.buffer import write_buffer, WriteBehindBuffer
+from opsmate.knowledgestore.writer import set_column, vector_array
+from hashlib import blake2b
+import numpy as np
+import pyarrow as pa
+import asyncio
+import zlib
+import structlog
+
+logger = structlog.get_logger(__name__)
+tracer = trace.get_tracer(__name__)
+
+SIGNATURES_TABLE = "chunk_signatures"
+
+# 64 minhash permutations in 16 bands of 4 rows: chunks with a jaccard
+# similarity of 0.9 share a band with a probability of ~1
+NUM_PERM = 64
+BANDS = 16
+SHINGLE_SIZE = 5
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_rng = np.random.default_rng(42)
+_A = _rng.integers(1, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+
+SIGNATURES_SCHEMA = pa.schema(
+    [
+        pa.field("uuid", pa.string()),
+        pa.field("canonical_uuid", pa.string()),
+        pa.field("data_source_provider", pa.string()),
+        pa.field("data_source", pa.string()),
+        pa.field("path", pa.string()),
+        pa.field("bands", pa.list_(pa.string())),
+        pa.field("signature", pa.list_(pa.uint32())),
+    ]
+)
+
+# the lsh lookups go through `bands`, the deletes through the scope columns
+SIGNATURES_INDEXES = {
+    "bands": LabelList,
+    "data_source_provider": Bitmap,
+    "data_source": Bitmap,
+    "path": BTree,
+}
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> Set[str]:
+    """
+    The word shingles of the text, case and whitespace insensitive.
+    """
+    words = text.lower().split()
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+def minhash(text: str) -> np.ndarray:
+    """
+    The minhash signature of the text word shingles, NUM_PERM uint32 values.
+    """
+    hashes = np.fromiter(
+        (zlib.crc32(shingle.encode()) for shingle in shingles(text)),
+        dtype=np.uint64,
+    )
+    # (a * x + b) mod p fits in uint64 as a and x are below 2^32
+    permuted = (np.outer(hashes, _A) + _B) % _MERSENNE_PRIME & _MAX_HASH
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def lsh_bands(signature: np.ndarray) -> List[str]:
+    """
+    The lsh band keys of the signature. Signatures sharing a band key are
+    candidate near-duplicates.
+    """
+    return [
+        f"{idx}:{blake2b(band.tobytes(), digest_size=8).hexdigest()}"
+        for idx, band in enumerate(np.split(signature, BANDS))
+    ]
+
+
+def similarity(signature: np.ndarray, other: np.ndarray) -> float:
+    """
+    The jaccard similarity estimated from the minhash signatures.
+    """
+    return float(np.mean(signature == other))
+
+
+async def open_signatures_table(name: str = SIGNATURES_TABLE) -> AsyncTable:
+    """
+    Open the lsh index of the chunk signatures, stored next to the knowledge
+    store table. The table and its indexes are created if they don't exist.
+    """
+    try:
+        return await handles.table(name)
+    except ValueError:
+        # the table is not found
+        pass
+
+    db = await handles.connection()
+    table = handles.register_table(
+        await db.create_table(name, schema=SIGNATURES_SCHEMA, exist_ok=True)
+    )
+    await create_signatures_indexes(table)
+    logger.info("chunk signatures table created", table=name)
+    return table
+
+
+async def create_signatures_indexes(table: AsyncTable):
+    """
+    Create the missing indexes of the signatures table.
+    """
+    indexed = {
+        column for index in await table.list_indices() for column in index.columns
+    }
+    for column, index_type in SIGNATURES_INDEXES.items():
+        if column not in indexed:
+            await table.create_index(column, config=index_type())
+
+
+# the signatures table version as of its last optimization in this process
+_optimized_version: int | None = None
+
+
+async def optimize_signatures():
+    """
+    Compact the signatures table, which every ingestion rewrites a scope of,
+    and index the signatures added since its indexes were built, unless it is
+    unchanged since its last optimization. The missing indexes are recreated.
+    """
+    global _optimized_version
+    table = await open_signatures_table()
+    if _optimized_version == await table.version():
+        return
+
+    with tracer.start_as_current_span("knowledgestore.optimize_signatures"):
+        # a delete on the empty table drops its indexes
+        await create_signatures_indexes(table)
+        await table.optimize()
+    _optimized_version = await table.version()
+
+
+async def dedup_batch(
+    batch: pa.RecordBatch,
+    scope: str,
+    threshold: float,
+    signatures: AsyncTable,
+    knowledge_store: AsyncTable,
+) -> Tuple[pa.RecordBatch, pa.RecordBatch]:
+    """
+    Find the near-duplicates of the knowledge store chunks about to replace `scope`.
+
+    A chunk whose estimated jaccard similarity with an already stored chunk
+    outside of the scope is at least `threshold` is marked as a reference to
+    that chunk via `canonical_uuid`, and reuses its stored vector rather than
+    being embedded again. The vectors of the other chunks are left null.
+
+    Returns the chunks with their `canonical_uuid` and `vector` columns set, and
+    the signature rows of the chunks to replace the scope of the signatures
+    table with.
+    """
+    contents = batch.column("content").to_pylist()
+    with tracer.start_as_current_span("knowledgestore.dedup") as span:
+        span.set_attribute("dedup.chunks", len(contents))
+        computed = await asyncio.to_thread(
+            lambda: [minhash(content) for content in contents]
+        )
+        bands = [lsh_bands(signature) for signature in computed]
+
+        candidates = await _candidates(
+            signatures, {band for kb_bands in bands for band in kb_bands}, scope
+        )
+
+        canonicals: Dict[int, str] = {}
+        for idx, kb_bands in enumerate(bands):
+            best, best_similarity = None, threshold
+            for band in kb_bands:
+                for candidate in candidates.get(band, ()):
+                    score = similarity(computed[idx], candidate["signature"])
+                    if score >= best_similarity:
+                        best, best_similarity = candidate, score
+            # the matched chunk rather than its own canonical, the content of
+            # which may have changed since
+            if best is not None:
+                canonicals[idx] = best["uuid"]
+
+        stored = await _vectors(knowledge_store, set(canonicals.values()))
+        canonical_uuids, vectors = [], []
+        for idx in range(len(contents)):
+            canonical = canonicals.get(idx)
+            # the canonical chunk is gone if its vector is not found
+            if canonical is not None and canonical in stored:
+                canonical_uuids.append(canonical)
+                vectors.append(stored[canonical])
+            else:
+                canonical_uuids.append("")
+                vectors.append(None)
+
+        duplicates = sum(1 for canonical in canonical_uuids if canonical)
+        span.set_attribute("dedup.duplicates", duplicates)
+        logger.info("deduplicated chunks", chunks=len(contents), duplicates=duplicates)
+
+    canonical_uuids = pa.array(canonical_uuids, type=pa.string())
+    vector_type = (await knowledge_store.schema()).field("vector").type
+    batch = set_column(batch, "canonical_uuid", canonical_uuids)
+    batch = set_column(batch, "vector", vector_array(vectors, vector_type))
+
+    signature_batch = pa.RecordBatch.from_arrays(
+        [
+            batch.column("uuid"),
+            canonical_uuids,
+            batch.column("data_source_provider"),
+            batch.column("data_source"),
+            batch.column("path"),
+            pa.array(bands, type=pa.list_(pa.string())),
+            pa.array(computed, type=pa.list_(pa.uint32())),
+        ],
+        schema=SIGNATURES_SCHEMA,
+    )
+    return batch, signature_batch
+
+
+async def rewritten_chunks(
+    signatures: AsyncTable,
+    scope: str,
+    rows: pa.RecordBatch | None,
+    threshold: float,
+) -> Set[str]:
+    """
+    The uuids of the stored chunks of `scope` that the signature `rows` about
+    to replace the scope remove, or rewrite into a content that is no longer a
+    near-duplicate of the stored one.
+    """
+    stored = (
+        await signatures.query().where(scope).select(["uuid", "signature"]).to_list()
+    )
+    replacing = {}
+    if rows is not None:
+        replacing = dict(
+            zip(rows.column("uuid").to_pylist(), rows.column("signature").to_pylist())
+        )
+    return {
+        row["uuid"]
+        for row in stored
+        if row["uuid"] not in replacing
+        or similarity(
+            np.asarray(row["signature"], dtype=np.uint32),
+            np.asarray(replacing[row["uuid"]], dtype=np.uint32),
+        )
+        < threshold
+    }
+
+
+async def release_duplicates(uuids: Set[str], *tables: AsyncTable):
+    """
+    Clear the `canonical_uuid` of the chunks pointing at the rewritten or
+    removed chunks, so that they are no longer collapsed with them. They keep
+    their vector, which was computed for a near-duplicate of their content.
+    """
+    if not uuids:
+        return
+    values = ", ".join(sql_literal(uuid) for uuid in sorted(uuids))
+    for table in tables:
+        await table.update(
+            updates_sql={"canonical_uuid": "''"}, where=f"canonical_uuid IN ({values})"
+        )
+    logger.info("released near-duplicates", canonicals=len(uuids))
+
+
+async def _candidates(
+    signatures: AsyncTable, bands: Iterable[str], scope: str
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    The stored signatures sharing a band with the chunks, keyed by band.
+    The chunks of the scope are excluded as they are about to be replaced.
+    """
+    bands = sorted(bands)
+    if not bands:
+        return {}
+
+    values = ", ".join(sql_literal(band) for band in bands)
+    rows = (
+        await signatures.query()
+        .where(f"array_has_any(bands, [{values}]) AND NOT ({scope})")
+        .select(["uuid", "canonical_uuid", "bands", "signature"])
+        .to_list()
+    )
+
+    wanted = set(bands)
+    candidates: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        row["signature"] = np.asarray(row["signature"], dtype=np.uint32)
+        for band in row["bands"]:
+            if band in wanted:
+                candidates.setdefault(band, []).append(row)
+    return candidates
+
+
+async def _vectors(knowledge_store: AsyncTable, uuids: Set[str]) -> Dict[str, Any]:
+    if not uuids:
+        return {}
+    values = ", ".join(sql_literal(uuid) for uuid in sorted(uuids))
+    rows = (
+        await knowledge_store.query()
+        .where(f"uuid IN ({values})")
+        .select(["uuid", "vector"])
+        .to_list()
+    )
+    return {row["uuid"]: row["vector"] for row in rows}
+
+
+def signatures_buffer() -> WriteBehindBuffer:
+    """
+    Get the write-behind buffer of the signatures table for the current event loop.
+    """
+    return write_buffer(SIGNATURES_TABLE, opener=open_signatures_table)
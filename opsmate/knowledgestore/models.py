@@ -1,10 +1,11 @@
 import lancedb
 from lancedb.pydantic import LanceModel, Vector
 from lancedb.embeddings import get_registry
-from lancedb.index import FTS
+from lancedb.index import FTS, BTree, Bitmap, LabelList, IvfPq, HnswSq
 from pydantic import Field
 from opsmate.config import config
-from typing import List, Any, Dict
+from lancedb.table import AsyncTable
+from typing import List, Any, Dict, Iterable, Tuple
 import uuid
 from enum import Enum
 from datetime import datetime
@@ -22,6 +23,10 @@ from opentelemetry import trace
 from functools import cache
 from datetime import timedelta, UTC
 from sqlmodel import Session
+import asyncio
+import re
+import weakref
+import pyarrow as pa
 import structlog
 
 logger = structlog.get_logger(__name__)
@@ -50,8 +55,12 @@ class OpenAIEmbeddingClient(EmbeddingClient):
         self.model_name = model_name
 
     async def embed(self, query: str) -> List[float]:
+        kwargs = {}
+        if config.embedding_dimensions:
+            # matryoshka truncation, same as the stored embeddings
+            kwargs["dimensions"] = config.embedding_dimensions
         response = await self.embed_client().embeddings.create(
-            input=query, model=self.model_name
+            input=query, model=self.model_name, **kwargs
         )
         return response.data[0].embedding
 
@@ -65,7 +74,8 @@ class SentenceTransformersEmbeddingClient(EmbeddingClient):
         self.model_name = model_name
 
     async def embed(self, query: str) -> List[float]:
-        return self.model().encode(query)
+        # encoding is cpu bound, run it off the event loop
+        return await asyncio.to_thread(self.model().encode, query)
 
     @cache
     def model(self):
@@ -118,11 +128,313 @@ def get_reranker():
             return None
 
 
+def sql_literal(value: Any) -> str:
+    """
+    Render a python value as a SQL literal for the lancedb filters
+    """
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def scope_filter(**columns: Any) -> str:
+    """
+    Build the filter that scopes the knowledge store rows by the column values, e.g.
+
+    scope_filter(data_source_provider="fs", path="/tmp/README.md")
+    => "data_source_provider = 'fs' AND path = '/tmp/README.md'"
+    """
+    return " AND ".join(
+        f"{column} = {sql_literal(value)}" for column, value in columns.items()
+    )
+
+
+def _timestamp_literal(dt: datetime) -> str:
+    # created_at is stored as naive local time
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return f"timestamp '{dt.strftime('%Y-%m-%d %H:%M:%S.%f')}'"
+
+
+def knowledge_filter(
+    categories: Iterable[str] = (),
+    data_sources: Iterable[str] = (),
+    data_source_providers: Iterable[str] = (),
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+) -> str | None:
+    """
+    Build the pre-filter of the knowledge store queries.
+
+    The filter is pushed down before the vector and full text search, and is
+    served by the scalar indexes created by `create_scalar_indexes`.
+    Returns None if there is nothing to filter on.
+    """
+    conditions = []
+    if categories:
+        values = ", ".join(
+            sql_literal(c.value if isinstance(c, Category) else c) for c in categories
+        )
+        conditions.append(f"array_has_any(categories, [{values}])")
+    if data_sources:
+        values = ", ".join(sql_literal(s) for s in data_sources)
+        conditions.append(f"data_source IN ({values})")
+    if data_source_providers:
+        values = ", ".join(sql_literal(p) for p in data_source_providers)
+        conditions.append(f"data_source_provider IN ({values})")
+    if created_after:
+        conditions.append(f"created_at >= {_timestamp_literal(created_after)}")
+    if created_before:
+        conditions.append(f"created_at < {_timestamp_literal(created_before)}")
+
+    if not conditions:
+        return None
+    return " AND ".join(conditions)
+
+
+# scalar indexes for the columns used by the deletes and the retrieval filters
+SCALAR_INDEXES = {
+    "data_source_provider": Bitmap,
+    "data_source": Bitmap,
+    "path": BTree,
+    "categories": LabelList,
+    "created_at": BTree,
+}
+
+
+async def create_scalar_indexes(table):
+    """
+    Create the scalar indexes of the knowledge store table that do not exist yet.
+    Existing indexes are kept up to date by `table.optimize()`.
+    """
+    indexed = {
+        column for index in await table.list_indices() for column in index.columns
+    }
+    for column, index_type in SCALAR_INDEXES.items():
+        if column in indexed:
+            continue
+        with tracer.start_as_current_span("create_scalar_index") as span:
+            span.set_attributes({"column": column, "index_type": index_type.__name__})
+            await table.create_index(column, config=index_type())
+            logger.info(
+                "scalar index created", column=column, index_type=index_type.__name__
+            )
+
+
+# the lancedb index types of the vector index kinds
+VECTOR_INDEXES = {
+    "ivf_pq": IvfPq,
+    "hnsw_sq": HnswSq,
+}
+
+VECTOR_PRECISIONS = {
+    "float32": pa.float32(),
+    "float16": pa.float16(),
+}
+
+
+async def create_vector_index(
+    table, kind: str | None = None, min_rows: int | None = None
+) -> bool:
+    """
+    Create the quantized vector index of the knowledge store table if it does
+    not exist yet, or is of another kind. The index is only trained once the
+    table holds `min_rows` rows. Returns whether the index has been created.
+    """
+    kind = kind or config.embedding_index
+    min_rows = config.embedding_index_min_rows if min_rows is None else min_rows
+    if kind == "flat":
+        return False
+
+    index_type = VECTOR_INDEXES[kind]
+    for index in await table.list_indices():
+        if "vector" in index.columns and index.index_type == index_type.__name__:
+            return False
+    if await table.count_rows() < min_rows:
+        return False
+
+    with tracer.start_as_current_span("create_vector_index") as span:
+        span.set_attributes({"index_type": index_type.__name__})
+        await table.create_index("vector", config=index_type(), replace=True)
+        logger.info("vector index created", index_type=index_type.__name__)
+    return True
+
+
+# the columns added after the knowledge store tables were first created, with
+# the SQL expression filling them in for the existing rows
+ADDED_COLUMNS = {
+    "canonical_uuid": "''",
+}
+
+
+def check_vector_field(table_schema: pa.Schema, vector_type: pa.DataType, ndims: int):
+    """
+    Warn when the stored vectors do not match the configured precision and
+    dimensions. The table has to be re-created for them to take effect.
+    """
+    expected = pa.list_(vector_type, ndims)
+    actual = table_schema.field("vector").type
+    if actual != expected:
+        logger.warning(
+            "the knowledge store vectors do not match the embedding config, "
+            "re-create the table for the config to take effect",
+            stored=str(actual),
+            configured=str(expected),
+        )
+
+
+async def add_missing_columns(table):
+    """
+    Add the columns missing from a knowledge store table created by an older version.
+    """
+    names = (await table.schema()).names
+    missing = {
+        column: value for column, value in ADDED_COLUMNS.items() if column not in names
+    }
+    if missing:
+        await table.add_columns(missing)
+        logger.info("knowledge store columns added", columns=list(missing))
+
+
+class KnowledgeStoreHandles:
+    """
+    KnowledgeStoreHandles is the process-wide cache of the lancedb connections
+    and opened tables, keyed by the db uri.
+
+    Opening a table reads its manifest, which is costly on object storage, so
+    the opened tables are reused across tasks and coroutines. The tables are
+    refreshed from the storage with a bounded staleness, controlled by
+    `config.embeddings_read_consistency_interval`. Writes made through the
+    cached handles are always visible to them straight away.
+    """
+
+    def __init__(self):
+        self._connections: Dict[str, lancedb.AsyncConnection] = {}
+        self._tables: Dict[Tuple[str, str], AsyncTable] = {}
+        # asyncio locks are bound to the event loop they are used in
+        self._locks: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, Dict[Tuple[str, ...], asyncio.Lock]
+        ] = weakref.WeakKeyDictionary()
+
+    def _lock(self, *key: str) -> asyncio.Lock:
+        locks = self._locks.setdefault(asyncio.get_running_loop(), {})
+        if key not in locks:
+            locks[key] = asyncio.Lock()
+        return locks[key]
+
+    async def connection(self, uri: str | None = None) -> lancedb.AsyncConnection:
+        uri = uri or config.embeddings_db_path
+        if uri in self._connections:
+            return self._connections[uri]
+
+        async with self._lock("connection", uri):
+            if uri not in self._connections:
+                interval = config.embeddings_read_consistency_interval
+                logger.info(
+                    "connecting to knowledge store",
+                    uri=uri,
+                    read_consistency_interval=interval,
+                )
+                self._connections[uri] = await lancedb.connect_async(
+                    uri,
+                    read_consistency_interval=(
+                        timedelta(seconds=interval) if interval >= 0 else None
+                    ),
+                )
+        return self._connections[uri]
+
+    async def table(
+        self, name: str = "knowledge_store", uri: str | None = None
+    ) -> AsyncTable:
+        uri = uri or config.embeddings_db_path
+        key = (uri, name)
+        if key in self._tables:
+            return self._tables[key]
+
+        async with self._lock("table", uri, name):
+            if key not in self._tables:
+                db = await self.connection(uri)
+                self._tables[key] = await db.open_table(name)
+        return self._tables[key]
+
+    def register_table(self, table: AsyncTable, uri: str | None = None) -> AsyncTable:
+        """
+        Cache a table that has just been created, returns the cached handle
+        if the table has already been opened.
+        """
+        uri = uri or config.embeddings_db_path
+        cached = self._tables.setdefault((uri, table.name), table)
+        if cached is not table:
+            table.close()
+        return cached
+
+    def evict(self, name: str, uri: str | None = None):
+        """
+        Evict the cached table, e.g. after it has been dropped.
+        """
+        uri = uri or config.embeddings_db_path
+        table = self._tables.pop((uri, name), None)
+        if table is not None:
+            table.close()
+
+    def close(self):
+        """
+        Close all the cached tables and connections.
+        """
+        for table in self._tables.values():
+            table.close()
+        for connection in self._connections.values():
+            connection.close()
+        self._tables.clear()
+        self._connections.clear()
+
+
+handles = KnowledgeStoreHandles()
+
+
 async def aconn():
     """
-    Create an async connection to the lancedb based on the config.embeddings_db_path
+    Get the async connection to the lancedb based on the config.embeddings_db_path.
+    The connection is shared across the process.
     """
-    return await lancedb.connect_async(config.embeddings_db_path)
+    return await handles.connection()
+
+
+async def open_table(name: str = "knowledge_store"):
+    """
+    Get the opened knowledge store table. The table handle is shared across the process.
+    """
+    return await handles.table(name)
+
+
+KNOWLEDGE_STORE_TABLE = "knowledge_store"
+# the shards of the knowledge store are named knowledge_store__<provider>
+SHARD_SEPARATOR = "__"
+
+
+def sharded() -> bool:
+    return config.embeddings_sharding == "provider"
+
+
+def shard_name(data_source_provider: str) -> str:
+    """
+    The name of the knowledge store table holding the data source provider.
+    """
+    if not sharded():
+        return KNOWLEDGE_STORE_TABLE
+    suffix = re.sub(r"[^a-z0-9_]", "_", data_source_provider.lower())
+    return f"{KNOWLEDGE_STORE_TABLE}{SHARD_SEPARATOR}{suffix}"
+
+
+async def list_shards() -> List[str]:
+    """
+    The names of the existing knowledge store tables.
+    """
+    if not sharded():
+        return [KNOWLEDGE_STORE_TABLE]
+    db = await handles.connection()
+    prefix = f"{KNOWLEDGE_STORE_TABLE}{SHARD_SEPARATOR}"
+    return sorted(name for name in await db.table_names() if name.startswith(prefix))
 
 
 def conn():
@@ -132,13 +444,23 @@ def conn():
     return lancedb.connect(config.embeddings_db_path)
 
 
-async def init_table():
+async def init_table(name: str | None = None):
     """
     init the knowledge store table based on the config.embeddings_db_path
+
+    With the provider sharding, the shards are created on their first write,
+    and only the existing shards are migrated and indexed unless `name` is given.
     """
+    if name is None and sharded():
+        for shard in await list_shards():
+            await init_table(shard)
+        return None
+    name = name or KNOWLEDGE_STORE_TABLE
+
     with tracer.start_as_current_span("init_table") as span:
         span.set_attributes(
             {
+                "table": name,
                 "embedding_registry_name": config.embedding_registry_name,
                 "embedding_model_name": config.embedding_model_name,
             }
@@ -146,10 +468,15 @@ async def init_table():
 
         registry = get_registry()
 
+        kwargs = {}
+        if config.embedding_dimensions:
+            # matryoshka truncation of the stored embeddings
+            kwargs["dim"] = config.embedding_dimensions
         # embeddings is the embedding function used to embed the knowledge store
         embeddings = registry.get(config.embedding_registry_name).create(
-            name=config.embedding_model_name
+            name=config.embedding_model_name, **kwargs
         )
+        vector_type = VECTOR_PRECISIONS[config.embedding_precision]
 
         class KnowledgeStore(LanceModel):
             uuid: str = Field(
@@ -166,7 +493,9 @@ async def init_table():
                 description="The metadata of the knowledge json encoded"
             )
             path: str = Field(description="The path of the knowledge", default="")
-            vector: Vector(embeddings.ndims()) = embeddings.VectorField()
+            vector: Vector(embeddings.ndims(), value_type=vector_type) = (
+                embeddings.VectorField()
+            )
             content: str = (
                 embeddings.SourceField()
             )  # source field indicates the field will be embed
@@ -174,16 +503,26 @@ async def init_table():
                 description="The created at date of the knowledge",
                 default_factory=datetime.now,
             )
+            canonical_uuid: str = Field(
+                description="The uuid of the chunk this one is a near-duplicate of, empty if it is canonical",
+                default="",
+            )
 
         db = await aconn()
 
         with tracer.start_as_current_span("create_table"):
-            table = await db.create_table(
-                "knowledge_store", schema=KnowledgeStore, exist_ok=True
+            table = await db.create_table(name, schema=KnowledgeStore, exist_ok=True)
+            table = handles.register_table(table)
+            await add_missing_columns(table)
+            check_vector_field(
+                table_schema=await table.schema(),
+                vector_type=vector_type,
+                ndims=embeddings.ndims(),
             )
         with tracer.start_as_current_span("create_index"):
             await table.create_index("content", config=FTS())
-            logger.info("knowledge store indexed", table=table)
+            await create_scalar_indexes(table)
+            logger.info("knowledge store indexed", table=name)
         return table
 
 
@@ -200,16 +539,42 @@ class ReindexTableTask(DbqTask):
         )
 
 
+# the table versions as of their last reindex in this process
+_reindexed_versions: Dict[str, int] = {}
+
+
+async def reindex_shard(name: str):
+    """
+    Reindex and optimize the knowledge store table, unless it is unchanged
+    since its last reindex.
+    """
+    table = await open_table(name)
+    if _reindexed_versions.get(name) == await table.version():
+        return
+
+    with tracer.start_as_current_span("reindex_shard") as span:
+        span.set_attribute("table", name)
+        await table.create_index("content", config=FTS())
+        await create_scalar_indexes(table)
+        await create_vector_index(table)
+        await table.optimize()
+    _reindexed_versions[name] = await table.version()
+
+
 @dbq_task(task_type=ReindexTableTask)
 async def reindex_table(interval_seconds: int = 30, ctx: Dict[str, Any] = {}):
     """
-    Reindex the knowledge store table
+    Reindex the knowledge store table, or its shards concurrently, and
+    optimize the chunk signatures table when the deduplication is enabled
     """
     with tracer.start_as_current_span("reindex_table") as span:
-        db = await aconn()
-        table = await db.open_table("knowledge_store")
-        await table.create_index("content", config=FTS())
-        await table.optimize()
+        reindexes = [reindex_shard(name) for name in await list_shards()]
+        if config.dedup:
+            # imported here as the dedup module depends on this one
+            from opsmate.knowledgestore.dedup import optimize_signatures
+
+            reindexes.append(optimize_signatures())
+        await asyncio.gather(*reindexes)
 
         next_run_at = datetime.now(UTC) + timedelta(seconds=interval_seconds)
         span.add_event("dbq.task.wait_until", {"wait_until": next_run_at.isoformat()})
@@ -0,0 +1,72 @@
+from typing import Iterable, List
+from lancedb.table import AsyncTable
+from opsmate.knowledgestore.models import (
+    handles,
+    init_table,
+    list_shards,
+    shard_name,
+)
+from opsmate.knowledgestore.buffer import write_buffer, WriteBehindBuffer
+import asyncio
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+
+async def shard_table(data_source_provider: str) -> AsyncTable:
+    """
+    Get the knowledge store table of the data source provider, the shard is
+    created on first use.
+    """
+    name = shard_name(data_source_provider)
+    try:
+        return await handles.table(name)
+    except ValueError:
+        # the table is not found
+        pass
+
+    logger.info("creating knowledge store shard", table=name)
+    return await init_table(name)
+
+
+async def shard_tables(data_source_providers: Iterable[str] = ()) -> List[AsyncTable]:
+    """
+    Get the existing knowledge store tables holding the data source providers,
+    all of them if no provider is given.
+    """
+    tables = await asyncio.gather(
+        *[handles.table(name) for name in await list_shards()]
+    )
+    return route_tables(tables, data_source_providers)
+
+
+def route_tables(
+    tables: List[AsyncTable], data_source_providers: Iterable[str] = ()
+) -> List[AsyncTable]:
+    """
+    Route a query to the knowledge store tables that can hold the data source
+    providers, all of them if no provider is given.
+    """
+    if not data_source_providers:
+        return tables
+    wanted = {shard_name(provider) for provider in data_source_providers}
+    return [table for table in tables if table.name in wanted]
+
+
+async def shards_version(tables: List[AsyncTable]) -> int:
+    """
+    The version of the knowledge store across the shards. It advances with
+    any write to any of the shards, as the table versions only go up.
+    """
+    return sum(await asyncio.gather(*[table.version() for table in tables]))
+
+
+def shard_buffer(data_source_provider: str) -> WriteBehindBuffer:
+    """
+    Get the write-behind buffer of the data source provider shard for the
+    current event loop.
+    """
+    return write_buffer(
+        shard_name(data_source_provider),
+        opener=lambda: shard_table(data_source_provider),
+    )
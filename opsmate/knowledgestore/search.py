@@ -0,0 +1,228 @@
+from typing import List, Dict, Any, Callable, Awaitable, Sequence
+from lancedb.rerankers import Reranker, RRFReranker
+from lancedb.table import AsyncTable
+from opentelemetry import trace
+import pyarrow as pa
+import asyncio
+import structlog
+
+logger = structlog.get_logger(__name__)
+tracer = trace.get_tracer(__name__)
+
+RRF_K = 60
+DEFAULT_COLUMNS = ["uuid", "content", "data_source", "path", "metadata"]
+
+
+def reciprocal_rank_fusion(
+    *legs: List[Dict[str, Any]], k: int = RRF_K, key: str = "uuid"
+) -> List[Dict[str, Any]]:
+    """
+    Fuse the ranked results of the search legs with reciprocal rank fusion.
+
+    The score of a row is the sum of `1 / (k + rank)` across the legs it appears in,
+    and is returned as the `_relevance_score` of the row.
+    """
+    scores: Dict[Any, float] = {}
+    rows: Dict[Any, Dict[str, Any]] = {}
+    for leg in legs:
+        for rank, row in enumerate(leg, start=1):
+            id = row[key]
+            scores[id] = scores.get(id, 0.0) + 1.0 / (k + rank)
+            # drop the leg specific scores such as _distance and _score
+            rows.setdefault(
+                id, {col: val for col, val in row.items() if not col.startswith("_")}
+            )
+
+    return [
+        {**rows[id], "_relevance_score": scores[id]}
+        for id in sorted(scores, key=scores.get, reverse=True)
+    ]
+
+
+def collapse_duplicates(
+    rows: List[Dict[str, Any]], key: str = "canonical_uuid"
+) -> List[Dict[str, Any]]:
+    """
+    Keep the best ranked row of each group of near-duplicates. A row belongs
+    to the group of its `key` column if set, otherwise to its own uuid group.
+    """
+    seen = set()
+    collapsed = []
+    for row in rows:
+        group = row.get(key) or row["uuid"]
+        if group in seen:
+            continue
+        seen.add(group)
+        collapsed.append(row)
+    return collapsed
+
+
+def merge_ranked(
+    results: Sequence[List[Dict[str, Any]]],
+    score: str,
+    descending: bool,
+    limit: int,
+) -> List[Dict[str, Any]]:
+    """
+    Merge the ranked results of a search leg across the shards by their `score`
+    column, keeping the `limit` best rows. The bm25 scores are computed per
+    shard, so the merged full text order is approximate.
+    """
+    if len(results) == 1:
+        return results[0][:limit]
+    rows = [row for result in results for row in result]
+    rows.sort(key=lambda row: row[score], reverse=descending)
+    return rows[:limit]
+
+
+async def rerank(
+    reranker: Reranker | None,
+    query: str,
+    candidates: List[Dict[str, Any]],
+    timeout: float | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Rerank the fused candidates. Falls back to the fused order when the reranker
+    fails or does not respond within `timeout` seconds.
+    """
+    # rrf reranking is what the fusion already did
+    if not candidates or reranker is None or isinstance(reranker, RRFReranker):
+        return candidates
+
+    results = pa.Table.from_pylist(
+        [
+            {
+                **{col: val for col, val in c.items() if col != "_relevance_score"},
+                "_score": c["_relevance_score"],
+            }
+            for c in candidates
+        ]
+    )
+    with tracer.start_as_current_span("knowledgestore.search.rerank") as span:
+        span.set_attributes(
+            {
+                "rerank.candidates": len(candidates),
+                "rerank.reranker": type(reranker).__name__,
+            }
+        )
+        try:
+            # the rerankers are blocking, and the api backed ones are network bound
+            reranked = await asyncio.wait_for(
+                asyncio.to_thread(reranker.rerank_fts, query, results),
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError:
+            logger.warning(
+                "reranker exceeded the latency budget, using the fused order",
+                reranker=type(reranker).__name__,
+                timeout=timeout,
+            )
+            span.set_attribute("rerank.fallback", "timeout")
+            return candidates
+        except Exception as e:
+            logger.warning(
+                "reranker failed, using the fused order",
+                reranker=type(reranker).__name__,
+                error=str(e),
+            )
+            span.record_exception(e)
+            span.set_attribute("rerank.fallback", "error")
+            return candidates
+
+    return reranked.sort_by([("_relevance_score", "descending")]).to_pylist()
+
+
+async def gather_tasks(*aws: Awaitable[Any]) -> List[Any]:
+    """
+    Run the awaitables as tasks of a task group, so that when one of them
+    fails the others are cancelled rather than left running. The first error
+    is raised as is, rather than as an exception group.
+    """
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(aw) for aw in aws]
+    except BaseExceptionGroup as e:
+        raise e.exceptions[0]
+    return [task.result() for task in tasks]
+
+
+async def hybrid_search(
+    table: AsyncTable | Sequence[AsyncTable],
+    query: str,
+    embed: Callable[[str], Awaitable[List[float]]],
+    filter: str | None = None,
+    top_n: int = 10,
+    reranker: Reranker | None = None,
+    columns: List[str] = DEFAULT_COLUMNS,
+    overfetch: int = 3,
+    rerank_candidates: int | None = None,
+    rerank_timeout: float | None = None,
+    refine_factor: int | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Run the vector and full text search legs concurrently and fuse them locally.
+
+    The full text search starts while the query embedding is still in flight.
+    Each leg over-fetches `top_n * overfetch` rows, and the fused results are
+    reranked from at most `rerank_candidates` (by default `2 * top_n`) candidates,
+    within the `rerank_timeout` latency budget. With a quantized vector index,
+    `refine_factor * limit` candidates are rescored with the full vectors.
+
+    Given the shards of the knowledge store, each leg queries the shards
+    concurrently and merges their results before the fusion.
+    """
+    tables = list(table) if isinstance(table, (list, tuple)) else [table]
+    limit = top_n * overfetch
+    rerank_candidates = rerank_candidates or 2 * top_n
+
+    with tracer.start_as_current_span("knowledgestore.search.hybrid") as span:
+        span.set_attributes(
+            {
+                "search.top_n": top_n,
+                "search.limit": limit,
+                "search.shards": len(tables),
+            }
+        )
+        embedding = asyncio.create_task(embed(query))
+
+        async def fts_shard(table):
+            q = table.query().nearest_to_text(query).select(columns)
+            if filter:
+                q = q.where(filter)
+            return await q.limit(limit).to_list()
+
+        async def vector_shard(table):
+            q = table.query().nearest_to(await embedding).select(columns)
+            if filter:
+                q = q.where(filter)
+            if refine_factor:
+                q = q.refine_factor(refine_factor)
+            return await q.limit(limit).to_list()
+
+        async def fts_leg():
+            results = await gather_tasks(*[fts_shard(t) for t in tables])
+            return merge_ranked(results, "_score", descending=True, limit=limit)
+
+        async def vector_leg():
+            results = await gather_tasks(*[vector_shard(t) for t in tables])
+            return merge_ranked(results, "_distance", descending=False, limit=limit)
+
+        try:
+            fts_results, vector_results = await gather_tasks(fts_leg(), vector_leg())
+        finally:
+            if not embedding.done():
+                embedding.cancel()
+
+        # near-duplicates share a vector and crowd out the other results
+        fused = collapse_duplicates(reciprocal_rank_fusion(vector_results, fts_results))
+        span.set_attributes(
+            {
+                "search.vector_results": len(vector_results),
+                "search.fts_results": len(fts_results),
+                "search.fused_results": len(fused),
+            }
+        )
+
+    candidates, rest = fused[:rerank_candidates], fused[rerank_candidates:]
+    results = await rerank(reranker, query, candidates, timeout=rerank_timeout)
+    return (results + rest)[:top_n]
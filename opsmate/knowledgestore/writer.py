@@ -0,0 +1,249 @@
+from typing import Dict, Iterable, List, Sequence
+from datetime import datetime
+from functools import lru_cache
+from lancedb.embeddings import EmbeddingFunctionConfig, EmbeddingFunctionRegistry
+from lancedb.table import AsyncTable
+from opentelemetry import trace
+import numpy as np
+import pyarrow as pa
+import asyncio
+import os
+import uuid
+import structlog
+
+logger = structlog.get_logger(__name__)
+tracer = trace.get_tracer(__name__)
+
+# the knowledge store columns written by the ingestions, the vector column
+# is typed after the table it is written to
+KNOWLEDGE_SCHEMA = pa.schema(
+    [
+        pa.field("uuid", pa.string()),
+        pa.field("id", pa.int64()),
+        pa.field("categories", pa.list_(pa.string())),
+        pa.field("data_source_provider", pa.string()),
+        pa.field("data_source", pa.string()),
+        pa.field("metadata", pa.string()),
+        pa.field("path", pa.string()),
+        pa.field("content", pa.string()),
+        pa.field("created_at", pa.timestamp("us")),
+        pa.field("canonical_uuid", pa.string()),
+    ]
+)
+
+_HEX = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+# the positions of the 32 hex digits in the 36 characters of a uuid
+_HEX_POSITIONS = np.array([i for i in range(36) if i not in (8, 13, 18, 23)])
+
+
+def uuid4_array(n: int) -> pa.StringArray:
+    """
+    Generate n random uuid4 strings at once.
+    """
+    raw = np.frombuffer(os.urandom(16 * n), dtype=np.uint8).reshape(n, 16).copy()
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40  # version 4
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80  # RFC 4122 variant
+
+    digits = np.empty((n, 32), dtype=np.uint8)
+    digits[:, 0::2] = _HEX[raw >> 4]
+    digits[:, 1::2] = _HEX[raw & 0x0F]
+    chars = np.full((n, 36), ord("-"), dtype=np.uint8)
+    chars[:, _HEX_POSITIONS] = digits
+
+    offsets = np.arange(0, 36 * (n + 1), 36, dtype=np.int32)
+    return pa.StringArray.from_buffers(
+        n, pa.py_buffer(offsets), pa.py_buffer(chars.tobytes())
+    )
+
+
+# the namespace of the uuids of the ingested chunks
+CHUNK_NAMESPACE = uuid.UUID("5b0c6f0e-3d8a-4c1e-9f2a-7e4d2b1a9c60")
+
+
+def chunk_uuids(ingestion_id: int, path: str, ids: Iterable[int]) -> pa.StringArray:
+    """
+    The uuids of the chunks of a document, derived from the ingestion, the
+    path and the chunk ids. A re-ingested document keeps the uuids of its
+    chunks, so that the `canonical_uuid` of their near-duplicates in the other
+    documents still point at them.
+    """
+    return pa.array(
+        [str(uuid.uuid5(CHUNK_NAMESPACE, f"{ingestion_id}:{path}:{id}")) for id in ids],
+        type=pa.string(),
+    )
+
+
+def repeat_array(value, n: int, type: pa.DataType) -> pa.Array:
+    """
+    An array of n times the same value.
+    """
+    return pa.array([value], type=type).take(np.zeros(n, dtype=np.int32))
+
+
+def knowledge_batch(
+    contents: Sequence[str],
+    *,
+    data_source_provider: str,
+    data_source: str,
+    path: str | Sequence[str],
+    metadata: Sequence[str],
+    ids: Sequence[int] | None = None,
+    uuids: pa.StringArray | None = None,
+    categories: Sequence[List[str]] | None = None,
+    created_at: datetime | None = None,
+) -> pa.RecordBatch:
+    """
+    Build the knowledge store rows of the chunks column-wise.
+
+    `metadata` are the json encoded metadata of the chunks, and the chunks are
+    numbered in order unless `ids` are given. The chunks get random uuids
+    unless `uuids` are given. `path` is either the path of all
+    the chunks or the path of each chunk. The chunks of the batch share the
+    same `created_at`.
+    """
+    n = len(contents)
+    created_at = created_at or datetime.now()
+    columns = {
+        "uuid": uuid4_array(n) if uuids is None else uuids,
+        "id": pa.array(np.arange(n) if ids is None else ids, type=pa.int64()),
+        "categories": (
+            pa.array(categories, type=pa.list_(pa.string()))
+            if categories is not None
+            else repeat_array([], n, pa.list_(pa.string()))
+        ),
+        "data_source_provider": repeat_array(data_source_provider, n, pa.string()),
+        "data_source": repeat_array(data_source, n, pa.string()),
+        "metadata": pa.array(metadata, type=pa.string()),
+        "path": (
+            repeat_array(path, n, pa.string())
+            if isinstance(path, str)
+            else pa.array(path, type=pa.string())
+        ),
+        "content": pa.array(contents, type=pa.string()),
+        "created_at": repeat_array(created_at, n, pa.timestamp("us")),
+        "canonical_uuid": repeat_array("", n, pa.string()),
+    }
+    return pa.RecordBatch.from_arrays(list(columns.values()), schema=KNOWLEDGE_SCHEMA)
+
+
+def set_column(batch: pa.RecordBatch, name: str, values: pa.Array) -> pa.RecordBatch:
+    """
+    Replace or append the column of the record batch.
+    """
+    idx = batch.schema.get_field_index(name)
+    if idx == -1:
+        return batch.append_column(name, values)
+    return batch.set_column(idx, name, values)
+
+
+@lru_cache(maxsize=8)
+def _embedding_functions(metadata: bytes) -> Dict[str, EmbeddingFunctionConfig]:
+    # cached by the serialised config, the embedding functions hold their models
+    return EmbeddingFunctionRegistry.get_instance().parse_functions(
+        {b"embedding_functions": metadata}
+    )
+
+
+def embedding_functions(schema: pa.Schema) -> Dict[str, EmbeddingFunctionConfig]:
+    """
+    The embedding functions of the table schema, keyed by vector column.
+    """
+    metadata = (schema.metadata or {}).get(b"embedding_functions")
+    if metadata is None:
+        return {}
+    return _embedding_functions(metadata)
+
+
+def vector_array(
+    vectors: np.ndarray | Sequence[Sequence[float] | None], type: pa.DataType
+) -> pa.FixedSizeListArray:
+    """
+    Build a vector column of the fixed size list type, None vectors are null.
+    """
+    value_type, dims = type.value_type, type.list_size
+    if isinstance(vectors, np.ndarray):
+        return pa.FixedSizeListArray.from_arrays(
+            pa.array(vectors.astype(value_type.to_pandas_dtype()).ravel()), dims
+        )
+
+    mask = np.array([vector is None for vector in vectors], dtype=bool)
+    values = np.zeros((len(vectors), dims), dtype=value_type.to_pandas_dtype())
+    for idx, vector in enumerate(vectors):
+        if vector is not None:
+            values[idx] = vector
+    return pa.FixedSizeListArray.from_arrays(
+        pa.array(values.ravel()), dims, mask=pa.array(mask) if mask.any() else None
+    )
+
+
+async def embed_batch(batch: pa.RecordBatch, table_schema: pa.Schema) -> pa.RecordBatch:
+    """
+    Pre-compute the vector columns of the batch with the embedding functions
+    of the table. Only the rows without a vector are embedded, in one call per
+    batch off the event loop, so that the table does not embed them on `add`.
+    """
+    for vector_column, conf in embedding_functions(table_schema).items():
+        vector_type = table_schema.field(vector_column).type
+        if vector_column in batch.schema.names:
+            existing = batch.column(vector_column)
+        else:
+            existing = pa.nulls(batch.num_rows, type=vector_type)
+        missing = np.flatnonzero(existing.is_null().to_numpy(zero_copy_only=False))
+        if len(missing) == 0:
+            continue
+
+        with tracer.start_as_current_span("knowledgestore.embed_batch") as span:
+            span.set_attribute("embed.rows", len(missing))
+            sources = batch.column(conf.source_column).take(missing)
+            embeddings = await asyncio.to_thread(
+                conf.function.compute_source_embeddings_with_retry, sources
+            )
+
+        if len(missing) == batch.num_rows:
+            vectors = vector_array(np.asarray(embeddings), vector_type)
+        else:
+            values = existing.to_pylist()
+            for idx, embedding in zip(missing, embeddings):
+                values[idx] = embedding
+            vectors = vector_array(values, vector_type)
+        batch = set_column(batch, vector_column, vectors.cast(vector_type))
+    return batch
+
+
+def concat_batches(batches: Sequence[pa.RecordBatch]) -> pa.RecordBatch:
+    """
+    Concatenate the record batches into one, unifying their schemas.
+    """
+    table = pa.concat_tables(
+        [pa.Table.from_batches([batch]) for batch in batches],
+        promote_options="default",
+    ).combine_chunks()
+    if table.num_rows == 0:
+        return pa.RecordBatch.from_pylist([], schema=table.schema)
+    return table.to_batches()[0]
+
+
+async def write_batches(
+    table: AsyncTable,
+    batches: Iterable[pa.RecordBatch],
+    merge_on: List[str] | None = None,
+):
+    """
+    Embed the record batches and write them into the table in one commit,
+    appended or upserted on the `merge_on` columns.
+    """
+    batches = [batch for batch in batches if batch.num_rows]
+    if not batches:
+        return
+
+    data = await embed_batch(concat_batches(batches), await table.schema())
+    if merge_on is None:
+        await table.add(data)
+    else:
+        await (
+            table.merge_insert(on=merge_on)
+            .when_matched_update_all()
+            .when_not_matched_insert_all()
+            .execute(data)
+        )
+    logger.info("record batches written", rows=data.num_rows, merge_on=merge_on)
@@ -0,0 +1,34 @@
+"""add chunk categories cache
+
+Revision ID: 4f2c9a1d7e35
+Revises: b86047adede9
+Create Date: 2026-10-19 10:12:31.418207
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = "4f2c9a1d7e35"
+down_revision: Union[str, None] = "b86047adede9"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "chunk_categories",
+        sa.Column("content_sha", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("categories", sa.JSON(), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("content_sha"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("chunk_categories")
@@ -0,0 +1,31 @@
+"""add file stat to documents
+
+Revision ID: a7d3e5c1b9f2
+Revises: 4f2c9a1d7e35
+Create Date: 2026-10-19 11:02:47.530118
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a7d3e5c1b9f2"
+down_revision: Union[str, None] = "4f2c9a1d7e35"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("documents", sa.Column("size", sa.BigInteger(), nullable=True))
+    op.add_column("documents", sa.Column("mtime_ns", sa.BigInteger(), nullable=True))
+    op.add_column("documents", sa.Column("inode", sa.BigInteger(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("documents", "inode")
+    op.drop_column("documents", "mtime_ns")
+    op.drop_column("documents", "size")
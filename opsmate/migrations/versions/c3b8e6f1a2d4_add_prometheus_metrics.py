@@ -0,0 +1,36 @@
+"""add prometheus metrics fingerprints
+
+Revision ID: c3b8e6f1a2d4
+Revises: a7d3e5c1b9f2
+Create Date: 2026-10-19 12:41:09.261733
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c3b8e6f1a2d4"
+down_revision: Union[str, None] = "a7d3e5c1b9f2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "prometheus_metrics",
+        sa.Column("endpoint", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("metric_name", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("fingerprint", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("deleted_at", sa.DateTime(), nullable=True),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("endpoint", "metric_name"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("prometheus_metrics")
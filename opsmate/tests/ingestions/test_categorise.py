@@ -0,0 +1,86 @@
+import pytest
+from unittest.mock import patch
+from sqlmodel import create_engine, Session
+from opsmate.ingestions.models import SQLModel as IngestionSQLModel
+from opsmate.ingestions.categorise import (
+    categorise_contents,
+    BatchCategories,
+    ChunkCategories,
+)
+from opsmate.knowledgestore.models import Category
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite:///:memory:")
+    IngestionSQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+class FakeCategorizer:
+    def __init__(self):
+        self.batches = []
+
+    async def __call__(self, chunks):
+        self.batches.append(chunks)
+        return BatchCategories(
+            chunks=[
+                ChunkCategories(
+                    id=id,
+                    categories=(
+                        [Category.SECURITY]
+                        if "security" in content
+                        else [Category.PERFORMANCE]
+                    ),
+                )
+                for id, content in chunks.items()
+            ]
+        )
+
+
+async def test_categorise_in_batches(session):
+    categorizer = FakeCategorizer()
+    with patch("opsmate.ingestions.categorise.categorize_batch", categorizer):
+        result = await categorise_contents(
+            ["security a", "perf b", "perf c", "security a"],
+            session=session,
+            batch_size=2,
+        )
+
+    assert result == [
+        ["security"],
+        ["performance"],
+        ["performance"],
+        ["security"],
+    ]
+    # the duplicated chunk is categorised once
+    assert sorted(len(batch) for batch in categorizer.batches) == [1, 2]
+
+
+async def test_cached_chunks_are_not_categorised_again(session):
+    categorizer = FakeCategorizer()
+    with patch("opsmate.ingestions.categorise.categorize_batch", categorizer):
+        await categorise_contents(["security a", "perf b"], session=session)
+        assert len(categorizer.batches) == 1
+
+        result = await categorise_contents(["perf b", "security a"], session=session)
+        assert len(categorizer.batches) == 1
+        assert result == [["performance"], ["security"]]
+
+        await categorise_contents(["perf b", "perf new"], session=session)
+        assert categorizer.batches[-1] == {0: "perf new"}
+
+
+async def test_chunks_missing_from_the_result_are_not_cached(session):
+    async def categorizer(chunks):
+        return BatchCategories(chunks=[])
+
+    with patch("opsmate.ingestions.categorise.categorize_batch", categorizer):
+        result = await categorise_contents(["security a"], session=session)
+    assert result[0] == []
+
+    categorizer = FakeCategorizer()
+    with patch("opsmate.ingestions.categorise.categorize_batch", categorizer):
+        result = await categorise_contents(["security a"], session=session)
+    assert result[0] == ["security"]
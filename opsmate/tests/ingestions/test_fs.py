@@ -3,7 +3,14 @@ from opsmate.tests.base import BaseTestCase
 from opsmate.ingestions.fs import FsIngestion
 from opsmate.textsplitters.markdown_header import MarkdownHeaderTextSplitter
 from opsmate.ingestions.chunk import chunk_document
+from opsmate.ingestions.models import (
+    SQLModel as IngestionSQLModel,
+    IngestionRecord,
+    DocumentRecord,
+)
+from sqlmodel import create_engine, Session
 from os import path
+from hashlib import sha256
 
 
 class TestFsIngestion(BaseTestCase):
@@ -88,6 +95,114 @@ class TestFsIngestion(BaseTestCase):
         assert "This is a test 2" in chunks[5].content
         assert chunks[5].metadata["path"].endswith("/nested/TEST2.md")
 
+    @pytest.mark.asyncio
+    async def test_incremental_load(self, tmp_path):
+        (tmp_path / "a.md").write_text("# a")
+        (tmp_path / "b.md").write_text("# b")
+
+        ingestion = FsIngestion(local_path=str(tmp_path), glob_pattern="*.md")
+        docs = [doc async for doc in ingestion.load()]
+        assert [doc.metadata["name"] for doc in docs] == ["a.md", "b.md"]
+
+        # the manifest as recorded by the ingest job
+        manifest = {
+            doc.metadata["path"]: {**doc.metadata["stat"], "sha": doc.metadata["sha"]}
+            for doc in docs
+        }
+        ingestion = FsIngestion(
+            local_path=str(tmp_path), glob_pattern="*.md", manifest=manifest
+        )
+        assert [doc async for doc in ingestion.load()] == []
+
+        (tmp_path / "a.md").write_text("# a changed")
+        (tmp_path / "b.md").unlink()
+        (tmp_path / "c.md").write_text("# c")
+
+        docs = [doc async for doc in ingestion.load()]
+        assert [(doc.metadata["name"], doc.deleted) for doc in docs] == [
+            ("a.md", False),
+            ("c.md", False),
+            ("b.md", True),
+        ]
+        assert docs[0].content == "# a changed"
+
+    @pytest.mark.asyncio
+    async def test_skip_binary_and_oversized_files(self, tmp_path):
+        (tmp_path / "text.md").write_text("hello")
+        (tmp_path / "binary.md").write_bytes(b"\x89PNG\r\n\x1a\n\x00\x00")
+        (tmp_path / "latin1.md").write_bytes("caf\xe9".encode("latin-1"))
+        (tmp_path / "large.md").write_text("x" * 100)
+
+        ingestion = FsIngestion(
+            local_path=str(tmp_path), glob_pattern="*.md", max_file_size=50
+        )
+        docs = [doc async for doc in ingestion.load()]
+
+        assert [doc.metadata["name"] for doc in docs] == ["text.md"]
+
+    @pytest.mark.asyncio
+    async def test_load_paths_deletes_the_files_no_longer_ingestible(self, tmp_path):
+        (tmp_path / "text.md").write_text("hello")
+        (tmp_path / "binary.md").write_bytes(b"\x89PNG\r\n\x1a\n\x00\x00")
+        (tmp_path / "large.md").write_text("x" * 100)
+
+        ingestion = FsIngestion(
+            local_path=str(tmp_path), glob_pattern="*.md", max_file_size=50
+        )
+        docs = [
+            doc
+            async for doc in ingestion.load_paths(
+                str(tmp_path / name)
+                for name in ("text.md", "binary.md", "large.md", "gone.md")
+            )
+        ]
+
+        assert [(doc.metadata["name"], doc.deleted) for doc in docs] == [
+            ("binary.md", True),
+            ("gone.md", True),
+            ("large.md", True),
+            ("text.md", False),
+        ]
+
+    @pytest.mark.asyncio
+    async def test_newlines_are_normalised(self, tmp_path):
+        (tmp_path / "crlf.md").write_bytes(b"# title\r\nbody\rend\n")
+
+        ingestion = FsIngestion(local_path=str(tmp_path), glob_pattern="*.md")
+        docs = [doc async for doc in ingestion.load()]
+
+        # same content and sha as the text mode reads of the earlier versions
+        with open(tmp_path / "crlf.md", "r") as f:
+            content = f.read()
+        assert docs[0].content == content == "# title\nbody\nend\n"
+        assert docs[0].metadata["sha"] == sha256(content.encode("utf-8")).hexdigest()
+
+    @pytest.mark.asyncio
+    async def test_document_manifest(self):
+        engine = create_engine("sqlite:///:memory:")
+        IngestionSQLModel.metadata.create_all(engine)
+        with Session(engine) as session:
+            record = await IngestionRecord.find_or_create(
+                session, "fs", {"local_path": "/tmp", "glob_pattern": "*.md"}
+            )
+            stat = {"size": 1, "mtime_ns": 2, "inode": 3}
+            await DocumentRecord.find_or_create(
+                session, record.id, "/tmp/a.md", "sha-a", {"splitter": "a"}, stat=stat
+            )
+            await DocumentRecord.find_or_create(
+                session, record.id, "/tmp/b.md", "sha-b", {"splitter": "b"}, stat=stat
+            )
+
+            manifest = await DocumentRecord.find_manifest_by_ingestion_id(
+                session, record.id, {"splitter": "a"}
+            )
+
+        assert manifest == {
+            "/tmp/a.md": {"sha": "sha-a", **stat},
+            # chunked with another config, so the stat never matches
+            "/tmp/b.md": {"sha": "sha-b"},
+        }
+
     def test_from_config(self):
         config = {
             "/tmp/foo": "*.md",
@@ -1,7 +1,19 @@
 import pytest
 import httpx
 from unittest.mock import AsyncMock, Mock
-from opsmate.ingestions.github import GithubIngestion
+from opsmate.ingestions.github import (
+    ETagCache,
+    GithubIngestion,
+    github_client,
+)
+from opsmate.tools.http_clients import http_client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import asyncio
+from contextlib import aclosing
+import tarfile
+import io
+import json
 import os
 import base64
 
@@ -51,6 +63,7 @@ async def test_validate_github_token():
 @pytest.mark.asyncio
 async def test_get_files(github_ingestion, mock_client):
     mock_response = Mock(spec=httpx.Response)
+    mock_response.headers = httpx.Headers()
     mock_response.json.return_value = {
         "tree": [
             {"type": "blob", "path": "file1.txt"},
@@ -74,6 +87,7 @@ async def test_get_files(github_ingestion, mock_client):
 async def test_get_files_with_glob(github_ingestion, mock_client):
     github_ingestion.glob = "*.py"
     mock_response = Mock(spec=httpx.Response)
+    mock_response.headers = httpx.Headers()
     mock_response.json.return_value = {
         "tree": [
             {"type": "blob", "path": "file1.txt"},
@@ -98,6 +112,8 @@ async def test_get_file_with_metadata(github_ingestion, mock_client):
     encoded_content = base64.b64encode(content.encode()).decode()
 
     mock_response = Mock(spec=httpx.Response)
+
+    mock_response.headers = httpx.Headers()
     mock_response.json.return_value = {
         "content": encoded_content,
         "html_url": "https://github.com/owner/repo/blob/main/test.txt",
@@ -118,6 +134,7 @@ async def test_get_file_with_metadata(github_ingestion, mock_client):
 async def test_load(github_ingestion):
     # Mock get_files
     tree_query_response = Mock(spec=httpx.Response)
+    tree_query_response.headers = httpx.Headers()
     tree_query_response.json.return_value = {
         "tree": [
             {"type": "blob", "path": "file1.txt"},
@@ -128,6 +145,8 @@ async def test_load(github_ingestion):
     tree_query_response.raise_for_status.return_value = None
 
     file_1_content_response = Mock(spec=httpx.Response)
+
+    file_1_content_response.headers = httpx.Headers()
     file_1_content_response.json.return_value = {
         "content": base64.b64encode("content1".encode()).decode(),
         "html_url": "https://github.com/owner/repo/blob/main/file1.txt",
@@ -136,6 +155,8 @@ async def test_load(github_ingestion):
     file_1_content_response.raise_for_status.return_value = None
 
     file_2_content_response = Mock(spec=httpx.Response)
+
+    file_2_content_response.headers = httpx.Headers()
     file_2_content_response.json.return_value = {
         "content": base64.b64encode("content2".encode()).decode(),
         "html_url": "https://github.com/owner/repo/blob/main/file2.py",
@@ -183,6 +204,268 @@ async def test_load(github_ingestion):
     assert documents[1].data_source == "owner/repo"
 
 
+class FakeGithub:
+    """
+    A local stand-in of the GitHub trees and contents API.
+    """
+
+    def __init__(self):
+        self.files = {
+            "README.md": ("readme", "sha-readme"),
+            "docs/guide.md": ("guide", "sha-guide"),
+        }
+        self.requests = []
+        self.rate_limit_remaining = 5000
+        self.rate_limit_reset = 60
+        self.archive_status = 302
+
+        github = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                github.requests.append((self.path, self.headers.get("If-None-Match")))
+                if "/tarball/" in self.path:
+                    # github redirects the archive downloads to codeload
+                    self.send_response(github.archive_status)
+                    self.send_header("Location", "/codeload/owner/repo/tar.gz/main")
+                    self.end_headers()
+                    return
+                if self.path.startswith("/codeload/"):
+                    payload = github.tarball()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-gzip")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+                if "/git/trees/" in self.path:
+                    etag = '"' + "-".join(sha for _, sha in github.files.values()) + '"'
+                    body = {
+                        "tree": [
+                            {"type": "blob", "path": path, "sha": sha}
+                            for path, (_, sha) in github.files.items()
+                        ]
+                    }
+                else:
+                    path = self.path.split("/contents/", 1)[1]
+                    content, sha = github.files[path]
+                    etag = f'"{sha}"'
+                    body = {
+                        "content": base64.b64encode(content.encode()).decode(),
+                        "html_url": f"https://github.com/owner/repo/blob/main/{path}",
+                        "sha": sha,
+                    }
+
+                status = 304 if self.headers.get("If-None-Match") == etag else 200
+                self.send_response(status)
+                self.send_header("ETag", etag)
+                self.send_header(
+                    "X-RateLimit-Remaining", str(github.rate_limit_remaining)
+                )
+                self.send_header("X-RateLimit-Reset", str(github.rate_limit_reset))
+                if status == 304:
+                    self.end_headers()
+                    return
+                payload = json.dumps(body).encode()
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tarball(self):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+            tar.addfile(tarfile.TarInfo("owner-repo-abc123"))
+            for path, (content, _) in self.files.items():
+                info = tarfile.TarInfo(f"owner-repo-abc123/{path}")
+                info.size = len(content.encode())
+                tar.addfile(info, io.BytesIO(content.encode()))
+            info = tarfile.TarInfo("owner-repo-abc123/image.png")
+            info.size = 3
+            tar.addfile(info, io.BytesIO(b"\x89PN"))
+        return buf.getvalue()
+
+    def content_requests(self):
+        return [path for path, _ in self.requests if "/contents/" in path]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake_github():
+    github = FakeGithub()
+    yield github
+    github.close()
+
+
+def local_ingestion(fake_github, **kwargs):
+    return GithubIngestion(
+        repo="owner/repo",
+        github_token="fake-token",
+        github_api_url=fake_github.url,
+        client=httpx.AsyncClient(),
+        **kwargs,
+    )
+
+
+@pytest.mark.asyncio
+async def test_load_only_fetches_changed_blobs(fake_github):
+    ingestion = local_ingestion(
+        fake_github,
+        known_shas={"README.md": "sha-readme", "docs/guide.md": "sha-old"},
+    )
+
+    docs = [doc async for doc in ingestion.load()]
+
+    assert [doc.metadata["path"] for doc in docs] == ["docs/guide.md"]
+    assert docs[0].content == "guide"
+    assert fake_github.content_requests() == [
+        "/repos/owner/repo/contents/docs/guide.md"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_load_uses_conditional_requests(fake_github):
+    docs = [doc async for doc in local_ingestion(fake_github).load()]
+    assert sorted(doc.content for doc in docs) == ["guide", "readme"]
+    assert all(etag is None for _, etag in fake_github.requests)
+
+    fake_github.requests.clear()
+    docs = [doc async for doc in local_ingestion(fake_github).load()]
+
+    # the tree is served from the etag cache on 304 Not Modified, the file
+    # contents are not cached
+    assert sorted(doc.content for doc in docs) == ["guide", "readme"]
+    assert len(fake_github.requests) == 3
+    assert [
+        etag is not None for path, etag in fake_github.requests if "/git/trees/" in path
+    ] == [True]
+    assert all(
+        etag is None for path, etag in fake_github.requests if "/contents/" in path
+    )
+
+
+def test_etag_cache_is_bounded_by_bytes():
+    cache = ETagCache(max_bytes=10)
+    cache.set("a", '"a"', {"tree": []}, 4)
+    cache.set("b", '"b"', {"tree": []}, 4)
+    assert cache.get("a") == ('"a"', {"tree": []})
+    # b is the least recently used
+    cache.set("c", '"c"', {"tree": []}, 4)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.size == 8
+    # larger than the whole cache
+    cache.set("d", '"d"', {"tree": []}, 11)
+    assert cache.get("d") is None
+
+
+@pytest.mark.asyncio
+async def test_waits_for_rate_limit_reset(fake_github, monkeypatch):
+    fake_github.rate_limit_remaining = 0
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr("opsmate.ingestions.github.time.time", lambda: 0)
+    monkeypatch.setattr("opsmate.ingestions.github.asyncio.sleep", sleep)
+    ingestion = local_ingestion(fake_github, concurrency=1, max_rate_limit_wait=30)
+
+    docs = [doc async for doc in ingestion.load()]
+
+    assert len(docs) == 2
+    # waited before each request following the exhausted one, capped by max_rate_limit_wait
+    assert sleeps == [30, 30]
+
+
+@pytest.mark.asyncio
+async def test_load_is_bounded_by_the_consumer(fake_github):
+    fake_github.files = {f"doc{i}.md": (f"doc {i}", f"sha-{i}") for i in range(50)}
+    ingestion = GithubIngestion(
+        repo="owner/repo",
+        github_token="fake-token",
+        github_api_url=fake_github.url,
+        concurrency=2,
+    )
+    # the pooled client is shared by the ingestions
+    assert ingestion.http_client is github_client(fake_github.url)
+    assert ingestion.http_client is http_client(fake_github.url)
+
+    async with aclosing(ingestion.load()) as docs:
+        await anext(docs)
+        await asyncio.sleep(0.5)
+        # 1 yielded, 2 waiting in the queue and 2 held by the blocked fetchers
+        assert len(fake_github.content_requests()) <= 5
+
+        remaining = [doc async for doc in docs]
+    assert len(remaining) == 49
+
+
+@pytest.mark.asyncio
+async def test_load_archive(fake_github):
+    ingestion = local_ingestion(fake_github, fetch_mode="archive", glob="**/*.md")
+
+    docs = sorted(
+        [doc async for doc in ingestion.load()], key=lambda doc: doc.metadata["path"]
+    )
+
+    assert [doc.content for doc in docs] == ["readme", "guide"]
+    assert docs[0].metadata == {
+        "path": "README.md",
+        "repo": "owner/repo",
+        "branch": "main",
+        "source": f"{fake_github.url}/owner/repo/blob/main/README.md",
+        # same as `git hash-object`
+        "sha": "ea786ff2cf69cdc0e487ad1cea3b8bd361eb66a3",
+    }
+    assert fake_github.content_requests() == []
+
+
+@pytest.mark.asyncio
+async def test_load_archive_skips_known_shas(fake_github):
+    ingestion = local_ingestion(
+        fake_github,
+        fetch_mode="archive",
+        known_shas={"README.md": "ea786ff2cf69cdc0e487ad1cea3b8bd361eb66a3"},
+    )
+
+    docs = [doc async for doc in ingestion.load()]
+
+    # the binary file is skipped too
+    assert [doc.metadata["path"] for doc in docs] == ["docs/guide.md"]
+
+
+@pytest.mark.asyncio
+async def test_load_archive_stops_early(fake_github):
+    ingestion = local_ingestion(fake_github, fetch_mode="archive")
+
+    async with aclosing(ingestion.load()) as docs:
+        async for doc in docs:
+            break
+
+    assert doc.metadata["path"] == "README.md"
+
+
+@pytest.mark.asyncio
+async def test_load_archive_error(fake_github):
+    ingestion = local_ingestion(fake_github, fetch_mode="archive")
+    fake_github.archive_status = 404
+
+    with pytest.raises(httpx.HTTPStatusError):
+        [doc async for doc in ingestion.load()]
+
+
 @pytest.mark.skipif(os.getenv("GITHUB_TOKEN") is None, reason="GITHUB_TOKEN is not set")
 @pytest.mark.asyncio
 async def test_integration():
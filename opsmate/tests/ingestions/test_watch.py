@@ -0,0 +1,121 @@
+import asyncio
+import pytest
+from sqlmodel import create_engine, Session, select
+from sqlalchemy.pool import StaticPool
+from opsmate.dbq.dbq import SQLModel as DBQSQLModel, TaskItem
+from opsmate.ingestions.models import SQLModel as IngestionSQLModel, IngestionRecord
+from opsmate.ingestions.fs import FsIngestion
+from opsmate.ingestions.watch import watch_ingestions, enqueue_changes
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    IngestionSQLModel.metadata.create_all(engine)
+    DBQSQLModel.metadata.create_all(engine)
+    return engine
+
+
+def tasks(engine):
+    with Session(engine) as session:
+        return [
+            (task.func.rsplit(".", 1)[-1], task.kwargs.get("doc", {}).get("metadata"))
+            for task in session.exec(select(TaskItem).order_by(TaskItem.id)).all()
+        ]
+
+
+def test_match(tmp_path):
+    ingestion = FsIngestion(local_path=str(tmp_path), glob_pattern="**/*.md")
+    assert ingestion.match(str(tmp_path / "a.md"))
+    assert ingestion.match(str(tmp_path / "nested" / "b.md"))
+    assert not ingestion.match(str(tmp_path / "a.txt"))
+    assert not ingestion.match("/elsewhere/a.md")
+
+    ingestion = FsIngestion(local_path=str(tmp_path), glob_pattern="./README.md")
+    assert ingestion.match(str(tmp_path / "README.md"))
+    assert not ingestion.match(str(tmp_path / "nested" / "README.md"))
+
+    # `*` does not match across directories, unlike fnmatch
+    ingestion = FsIngestion(local_path=str(tmp_path), glob_pattern="*.md")
+    assert ingestion.match(str(tmp_path / "a.md"))
+    assert not ingestion.match(str(tmp_path / "sub" / "deep" / "b.md"))
+
+    # the hidden files are not globbed
+    ingestion = FsIngestion(local_path=str(tmp_path), glob_pattern="**/*.md")
+    assert not ingestion.match(str(tmp_path / ".git" / "a.md"))
+    assert not ingestion.match(str(tmp_path / ".a.md"))
+
+
+async def test_enqueue_changes(engine, tmp_path):
+    (tmp_path / "changed.md").write_text("# changed")
+    (tmp_path / "ignored.txt").write_text("ignored")
+    ingestion = FsIngestion(local_path=str(tmp_path), glob_pattern="**/*.md")
+
+    with Session(engine) as session:
+        count = await enqueue_changes(
+            session,
+            ingestion,
+            1,
+            {
+                str(tmp_path / "changed.md"),
+                str(tmp_path / "removed.md"),
+                str(tmp_path / "ignored.txt"),
+            },
+        )
+
+    assert count == 2
+    (changed_task, changed), (removed_task, removed) = tasks(engine)
+    assert changed_task == "chunk_and_store"
+    assert changed["path"] == str(tmp_path / "changed.md")
+    assert "sha" in changed and "stat" in changed
+    assert removed_task == "delete_document"
+    assert removed["path"] == str(tmp_path / "removed.md")
+
+
+async def test_watch_ingestions(engine, tmp_path):
+    ingestion = FsIngestion(local_path=str(tmp_path), glob_pattern="**/*.md")
+    stop_event = asyncio.Event()
+    watcher = asyncio.create_task(
+        watch_ingestions(
+            engine,
+            [ingestion],
+            debounce_ms=100,
+            stop_event=stop_event,
+            initial_ingest=False,
+        )
+    )
+
+    async def wait_for_tasks(n: int):
+        for _ in range(100):
+            if len(tasks(engine)) >= n:
+                return tasks(engine)
+            await asyncio.sleep(0.1)
+        raise TimeoutError(f"expected {n} tasks, got {tasks(engine)}")
+
+    try:
+        await asyncio.sleep(0.5)
+        # a burst of writes to the same file is enqueued once
+        for i in range(5):
+            (tmp_path / "runbook.md").write_text(f"# runbook {i}")
+        (tmp_path / "notes.txt").write_text("not matched")
+
+        enqueued = await wait_for_tasks(1)
+        assert enqueued == [
+            ("chunk_and_store", enqueued[0][1]),
+        ]
+        assert enqueued[0][1]["path"] == str(tmp_path / "runbook.md")
+
+        (tmp_path / "runbook.md").unlink()
+        enqueued = await wait_for_tasks(2)
+        assert enqueued[1][0] == "delete_document"
+    finally:
+        stop_event.set()
+        await asyncio.wait_for(watcher, timeout=5)
+
+    with Session(engine) as session:
+        records = session.exec(select(IngestionRecord)).all()
+        assert [r.data_source for r in records] == [str(tmp_path)]
@@ -0,0 +1,131 @@
+import asyncio
+import lancedb
+import pyarrow as pa
+
+from opsmate.knowledgestore.buffer import WriteBehindBuffer
+from opsmate.knowledgestore.models import scope_filter
+
+schema = pa.schema(
+    [
+        pa.field("path", pa.string()),
+        pa.field("content", pa.string()),
+    ]
+)
+
+
+async def create_table(path):
+    db = await lancedb.connect_async(path)
+    return await db.create_table("knowledge_store", schema=schema)
+
+
+def rows(path: str, n: int):
+    return [{"path": path, "content": f"{path}-{i}"} for i in range(n)]
+
+
+async def contents(table):
+    result = await table.query().select(["content"]).to_list()
+    return sorted(r["content"] for r in result)
+
+
+class FailingTable:
+    async def delete(self, predicate: str):
+        raise RuntimeError("boom")
+
+
+async def test_concurrent_writes_are_coalesced(tmp_path):
+    table = await create_table(tmp_path)
+
+    async def open_table():
+        return table
+
+    buffer = WriteBehindBuffer(open_table, max_rows=100, max_delay=0.05)
+    await buffer.replace(scope_filter(path="a"), rows("a", 1))
+    version = await table.version()
+
+    await asyncio.gather(
+        buffer.replace(scope_filter(path="a"), rows("a", 2)),
+        buffer.replace(scope_filter(path="b"), rows("b", 2)),
+        buffer.replace(scope_filter(path="c"), rows("c", 1)),
+    )
+
+    assert await contents(table) == ["a-0", "a-1", "b-0", "b-1", "c-0"]
+    # one delete and one add for all the three writes
+    assert await table.version() == version + 2
+    assert buffer.pending_rows == 0
+
+
+async def test_latest_replace_of_the_same_scope_wins(tmp_path):
+    table = await create_table(tmp_path)
+
+    async def open_table():
+        return table
+
+    buffer = WriteBehindBuffer(open_table, max_rows=100, max_delay=0.05)
+    await asyncio.gather(
+        buffer.replace(scope_filter(path="a"), rows("a", 3)),
+        buffer.replace(scope_filter(path="a"), rows("a", 1)),
+    )
+
+    assert await contents(table) == ["a-0"]
+
+
+async def test_max_rows_triggers_flush(tmp_path):
+    table = await create_table(tmp_path)
+
+    async def open_table():
+        return table
+
+    buffer = WriteBehindBuffer(open_table, max_rows=2, max_delay=60)
+    await asyncio.wait_for(
+        buffer.replace(scope_filter(path="a"), rows("a", 2)), timeout=5
+    )
+
+    assert await contents(table) == ["a-0", "a-1"]
+
+
+async def test_flush_failure_is_propagated_to_all_writers():
+    async def open_table():
+        return FailingTable()
+
+    buffer = WriteBehindBuffer(open_table, max_rows=100, max_delay=0.05)
+    results = await asyncio.gather(
+        buffer.replace(scope_filter(path="a"), rows("a", 1)),
+        buffer.replace(scope_filter(path="b"), rows("b", 1)),
+        return_exceptions=True,
+    )
+
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+async def test_scope_filter():
+    assert (
+        scope_filter(data_source_provider="fs", path="/tmp/it's.md")
+        == "data_source_provider = 'fs' AND path = '/tmp/it''s.md'"
+    )
+
+
+class RecordingTable:
+    def __init__(self):
+        self.added = []
+
+    async def delete(self, predicate: str):
+        pass
+
+    async def add(self, rows):
+        self.added.append([row["path"] for row in rows])
+
+
+async def test_rows_with_vectors_are_added_apart():
+    table = RecordingTable()
+
+    async def open_table():
+        return table
+
+    buffer = WriteBehindBuffer(open_table, max_rows=100, max_delay=0.05)
+    await asyncio.gather(
+        buffer.replace(scope_filter(path="a"), rows("a", 1)),
+        buffer.replace(
+            scope_filter(path="b"), [{**row, "vector": [1.0]} for row in rows("b", 2)]
+        ),
+    )
+    assert table.added == [["b", "b"], ["a"]]
@@ -0,0 +1,60 @@
+from unittest.mock import patch
+
+from opsmate.config import config
+from opsmate.knowledgestore.cache import RetrievalCache, cache_key
+
+
+def test_cache_key_normalizes_query():
+    assert cache_key("How to  restart Nginx?") == cache_key(" how to restart nginx? ")
+    assert cache_key("nginx", top_n=5) != cache_key("nginx", top_n=10)
+    assert cache_key("nginx", filter="path = 'a'") != cache_key("nginx")
+    assert cache_key("nginx", reranker="rrf") != cache_key("nginx")
+
+
+def test_cache_key_is_scoped_to_the_knowledge_store():
+    key = cache_key("nginx")
+    with patch.object(config, "embeddings_db_path", "/tmp/other-db"):
+        assert cache_key("nginx") != key
+    with patch.object(config, "embedding_model_name", "other-model"):
+        assert cache_key("nginx") != key
+    with patch.object(config, "embedding_registry_name", "sentence-transformers"):
+        assert cache_key("nginx") != key
+    assert cache_key("nginx") == key
+
+
+def test_lru_eviction():
+    cache = RetrievalCache(max_entries=2)
+    cache.set("a", "hits", 1, ["a"])
+    cache.set("b", "hits", 1, ["b"])
+    # touch a so that b is the least recently used
+    assert cache.get("a", "hits", 1) == ["a"]
+    cache.set("c", "hits", 1, ["c"])
+
+    assert cache.get("a", "hits", 1) == ["a"]
+    assert cache.get("b", "hits", 1) is None
+    assert cache.get("c", "hits", 1) == ["c"]
+
+
+def test_invalidated_when_version_advances():
+    cache = RetrievalCache()
+    cache.set("a", "hits", 1, ["a"])
+    cache.set("a", "summary", 1, {"found": False, "result": {}})
+
+    assert cache.get("a", "hits", 2) is None
+    assert len(cache) == 0
+
+    cache.set("a", "hits", 2, ["a2"])
+    assert cache.get("a", "hits", 2) == ["a2"]
+
+
+def test_disk_tier(tmp_path):
+    cache = RetrievalCache(cache_dir=str(tmp_path))
+    cache.set("a", "hits", 1, [{"content": "hello", "path": "a.md"}])
+
+    # a fresh process reads the entry from the disk
+    other = RetrievalCache(cache_dir=str(tmp_path))
+    assert other.get("a", "hits", 1) == [{"content": "hello", "path": "a.md"}]
+
+    other.set("b", "hits", 2, ["b"])
+    assert sorted(p.name for p in tmp_path.glob("*.json")) == ["2-b-hits.json"]
+    assert RetrievalCache(cache_dir=str(tmp_path)).get("a", "hits", 1) is None
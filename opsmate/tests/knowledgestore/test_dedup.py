@@ -0,0 +1,224 @@
+import lancedb
+import pyarrow as pa
+from unittest.mock import patch
+
+from opsmate.config import config
+
+from opsmate.knowledgestore.dedup import (
+    SIGNATURES_SCHEMA,
+    dedup_batch,
+    lsh_bands,
+    minhash,
+    open_signatures_table,
+    optimize_signatures,
+    release_duplicates,
+    rewritten_chunks,
+    similarity,
+)
+from opsmate.knowledgestore.models import handles, scope_filter, add_missing_columns
+
+schema = pa.schema(
+    [
+        pa.field("uuid", pa.string()),
+        pa.field("data_source_provider", pa.string()),
+        pa.field("data_source", pa.string()),
+        pa.field("path", pa.string()),
+        pa.field("content", pa.string()),
+        pa.field("vector", pa.list_(pa.float32(), 2)),
+    ]
+)
+
+runbook = " ".join(
+    f"step {i}: check the nginx error log and restart the pod if it is crashlooping."
+    for i in range(20)
+)
+copied_runbook = runbook.replace("step 19", "step nineteen")
+other = " ".join(
+    f"postgres replication lag item {i} of the dashboard" for i in range(20)
+)
+
+
+def kbs(path: str, *contents: str):
+    return pa.RecordBatch.from_pylist(
+        [
+            {
+                "uuid": f"{path}-{idx}",
+                "data_source_provider": "fs",
+                "data_source": "/docs",
+                "path": path,
+                "content": content,
+            }
+            for idx, content in enumerate(contents)
+        ]
+    )
+
+
+def scope(path: str):
+    return scope_filter(data_source_provider="fs", data_source="/docs", path=path)
+
+
+def test_minhash_similarity():
+    assert similarity(minhash(runbook), minhash(runbook)) == 1.0
+    assert similarity(minhash(runbook), minhash(copied_runbook)) > 0.8
+    assert similarity(minhash(runbook), minhash(other)) < 0.1
+    # whitespace and case insensitive
+    assert similarity(minhash(runbook), minhash(runbook.upper() + "\n")) == 1.0
+
+
+def test_near_duplicates_share_lsh_bands():
+    bands = set(lsh_bands(minhash(runbook)))
+    assert bands & set(lsh_bands(minhash(copied_runbook)))
+    assert not bands & set(lsh_bands(minhash(other)))
+
+
+async def test_dedup_batch(tmp_path):
+    db = await lancedb.connect_async(tmp_path)
+    knowledge_store = await db.create_table("knowledge_store", schema=schema)
+    signatures = await db.create_table("chunk_signatures", schema=SIGNATURES_SCHEMA)
+
+    stored = kbs("a.md", runbook, other)
+    await knowledge_store.add(
+        stored.append_column(
+            "vector", pa.array([[1.0, 0.0], [0.0, 1.0]], type=pa.list_(pa.float32(), 2))
+        )
+    )
+    stored, rows = await dedup_batch(
+        stored, scope("a.md"), 0.8, signatures, knowledge_store=knowledge_store
+    )
+    assert stored.column("canonical_uuid").to_pylist() == ["", ""]
+    assert rows.schema == SIGNATURES_SCHEMA
+    assert rows.column("uuid").to_pylist() == ["a.md-0", "a.md-1"]
+    await signatures.add(rows)
+
+    new, _ = await dedup_batch(
+        kbs("b.md", copied_runbook, "something else entirely"),
+        scope("b.md"),
+        0.8,
+        signatures,
+        knowledge_store,
+    )
+    assert new.column("canonical_uuid").to_pylist() == ["a.md-0", ""]
+    # the duplicate reuses the canonical vector, the other one is left to embed
+    assert new.column("vector").to_pylist() == [[1.0, 0.0], None]
+
+    # the chunks being replaced are not their own canonical
+    replaced, _ = await dedup_batch(
+        kbs("a.md", runbook), scope("a.md"), 0.8, signatures, knowledge_store
+    )
+    assert replaced.column("canonical_uuid").to_pylist() == [""]
+
+    # the canonical chunk is gone from the knowledge store
+    await knowledge_store.delete(scope_filter(path="a.md"))
+    new, _ = await dedup_batch(
+        kbs("c.md", copied_runbook), scope("c.md"), 0.8, signatures, knowledge_store
+    )
+    assert new.column("canonical_uuid").to_pylist() == [""]
+
+
+async def test_reingesting_an_edited_canonical_document(tmp_path):
+    db = await lancedb.connect_async(tmp_path)
+    knowledge_store = await db.create_table(
+        "knowledge_store",
+        schema=schema.append(pa.field("canonical_uuid", pa.string())),
+    )
+    signatures = await db.create_table("chunk_signatures", schema=SIGNATURES_SCHEMA)
+
+    async def store(path, vectors, *contents):
+        batch, rows = await dedup_batch(
+            kbs(path, *contents), scope(path), 0.8, signatures, knowledge_store
+        )
+        rewritten = await rewritten_chunks(signatures, scope(path), rows, 0.8)
+        vectors = pa.array(vectors, type=pa.list_(pa.float32(), 2))
+        batch = batch.set_column(
+            batch.schema.get_field_index("vector"), "vector", vectors
+        )
+        for table, new in ((knowledge_store, batch), (signatures, rows)):
+            await table.delete(scope(path))
+            await table.add(new)
+        await release_duplicates(rewritten, knowledge_store, signatures)
+        return batch, rewritten
+
+    await store("a.md", [[1.0, 0.0]], runbook)
+    b, _ = await store("b.md", [[1.0, 0.0]], copied_runbook)
+    assert b.column("canonical_uuid").to_pylist() == ["a.md-0"]
+
+    # the unchanged document keeps its near-duplicates
+    _, rewritten = await store("a.md", [[1.0, 0.0]], runbook)
+    assert rewritten == set()
+
+    # the canonical chunk keeps its uuid but its content changes
+    _, rewritten = await store("a.md", [[0.0, 1.0]], other)
+    assert rewritten == {"a.md-0"}
+    rows = await knowledge_store.query().where(scope("b.md")).to_list()
+    assert [row["canonical_uuid"] for row in rows] == [""]
+
+    # a new duplicate points at the chunk it matched, with its vector
+    c, _ = await dedup_batch(
+        kbs("c.md", copied_runbook), scope("c.md"), 0.8, signatures, knowledge_store
+    )
+    assert c.column("canonical_uuid").to_pylist() == ["b.md-0"]
+    assert c.column("vector").to_pylist() == [[1.0, 0.0]]
+
+    # deleting the document releases the chunks pointing at it
+    assert await rewritten_chunks(signatures, scope("b.md"), None, 0.8) == {"b.md-0"}
+
+
+def signature_rows(path: str, content: str):
+    signature = minhash(content)
+    return pa.RecordBatch.from_pylist(
+        [
+            {
+                "uuid": f"{path}-0",
+                "canonical_uuid": "",
+                "data_source_provider": "fs",
+                "data_source": "/docs",
+                "path": path,
+                "bands": lsh_bands(signature),
+                "signature": signature.tolist(),
+            }
+        ],
+        schema=SIGNATURES_SCHEMA,
+    )
+
+
+async def test_optimize_signatures(tmp_path):
+    with patch.object(config, "embeddings_db_path", str(tmp_path)):
+        try:
+            signatures = await open_signatures_table()
+            for path in ("a.md", "b.md"):
+                await signatures.delete(scope(path))
+                await signatures.add(signature_rows(path, runbook))
+            await signatures.add(signature_rows("c.md", other))
+            # the first delete on the empty table dropped the indexes
+            assert await signatures.index_stats("bands_idx") is None
+
+            await optimize_signatures()
+            stats = await signatures.index_stats("bands_idx")
+            assert stats.num_indexed_rows == 3
+            assert stats.num_unindexed_rows == 0
+
+            await signatures.delete(scope("c.md"))
+            await signatures.add(signature_rows("c.md", other))
+            assert (await signatures.index_stats("bands_idx")).num_unindexed_rows == 1
+            await optimize_signatures()
+            assert (await signatures.index_stats("bands_idx")).num_unindexed_rows == 0
+
+            # unchanged since, not optimized again
+            version = await signatures.version()
+            await optimize_signatures()
+            assert await signatures.version() == version
+        finally:
+            handles.close()
+
+
+async def test_add_missing_columns(tmp_path):
+    db = await lancedb.connect_async(tmp_path)
+    table = await db.create_table(
+        "knowledge_store", data=[{"uuid": "a", "content": "old row"}]
+    )
+    await add_missing_columns(table)
+    await add_missing_columns(table)
+
+    assert await table.query().to_list() == [
+        {"uuid": "a", "content": "old row", "canonical_uuid": ""}
+    ]
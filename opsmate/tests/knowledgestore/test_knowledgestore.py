@@ -13,6 +13,10 @@ from opsmate.knowledgestore.models import (
     aconn,
     conn,
     init_table,
+    knowledge_filter,
+    open_table,
+    handles,
+    SCALAR_INDEXES,
     reindex_table,
     schedule_reindex_table,
     ReindexTableTask,
@@ -57,6 +61,37 @@ class TestKnowledgeStore(BaseTestCase):
         results = await table.query().select(["content"]).limit(5).to_arrow()
         assert len(results) == 1
 
+    @pytest.mark.asyncio
+    async def test_scalar_indexes(self):
+        table = await init_table()
+        indexed = {
+            column for index in await table.list_indices() for column in index.columns
+        }
+        assert set(SCALAR_INDEXES.keys()).issubset(indexed)
+        assert "content" in indexed
+
+        # idempotent
+        table = await init_table()
+        assert len(await table.list_indices()) == len(indexed)
+
+    def test_knowledge_filter(self):
+        assert knowledge_filter() is None
+
+        assert (
+            knowledge_filter(
+                categories=[Category.PROMETHEUS, "security"],
+                data_sources=["opsmate-ai/opsmate"],
+                data_source_providers=["github", "fs"],
+                created_after=datetime(2025, 1, 1),
+                created_before=datetime(2025, 2, 1, 12, 30),
+            )
+            == "array_has_any(categories, ['prometheus', 'security'])"
+            " AND data_source IN ('opsmate-ai/opsmate')"
+            " AND data_source_provider IN ('github', 'fs')"
+            " AND created_at >= timestamp '2025-01-01 00:00:00.000000'"
+            " AND created_at < timestamp '2025-02-01 12:30:00.000000'"
+        )
+
     @pytest.mark.asyncio
     async def test_connection_functions(self):
         # Test async connection
@@ -74,6 +109,20 @@ class TestKnowledgeStore(BaseTestCase):
         sync_table = sync_db.open_table("knowledge_store")
         assert sync_table is not None
 
+    @pytest.mark.asyncio
+    async def test_handles_are_shared(self):
+        assert await aconn() is await aconn()
+
+        table = await open_table()
+        assert table is await open_table()
+        assert table is await init_table()
+
+        # concurrent opens share the same handle
+        handles.evict("knowledge_store")
+        tables = await asyncio.gather(*[open_table() for _ in range(5)])
+        assert all(t is tables[0] for t in tables)
+        assert tables[0] is not table
+
     @pytest.mark.asyncio
     async def test_embedding_client_configuration(self):
         # Test with the current configuration
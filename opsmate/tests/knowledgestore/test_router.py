@@ -0,0 +1,49 @@
+import lancedb
+import pyarrow as pa
+from unittest.mock import patch
+
+from opsmate.config import config
+from opsmate.knowledgestore.models import handles, list_shards, shard_name
+from opsmate.knowledgestore.router import route_tables, shard_tables, shards_version
+
+schema = pa.schema([pa.field("path", pa.string())])
+
+
+def test_shard_name():
+    with patch.object(config, "embeddings_sharding", "none"):
+        assert shard_name("github") == "knowledge_store"
+    with patch.object(config, "embeddings_sharding", "provider"):
+        assert shard_name("github") == "knowledge_store__github"
+        assert shard_name("My-Provider") == "knowledge_store__my_provider"
+
+
+async def test_shard_tables(tmp_path):
+    db = await lancedb.connect_async(tmp_path)
+    for name in ["knowledge_store__fs", "knowledge_store__github", "chunk_signatures"]:
+        await db.create_table(name, schema=schema)
+
+    with (
+        patch.object(config, "embeddings_db_path", str(tmp_path)),
+        patch.object(config, "embeddings_sharding", "provider"),
+    ):
+        try:
+            assert await list_shards() == [
+                "knowledge_store__fs",
+                "knowledge_store__github",
+            ]
+            tables = await shard_tables()
+            assert [t.name for t in tables] == [
+                "knowledge_store__fs",
+                "knowledge_store__github",
+            ]
+            assert [t.name for t in await shard_tables(["github"])] == [
+                "knowledge_store__github"
+            ]
+            assert await shard_tables(["prometheus"]) == []
+            assert route_tables(tables, []) == tables
+
+            version = await shards_version(tables)
+            await tables[0].add([{"path": "a.md"}])
+            assert await shards_version(tables) == version + 1
+        finally:
+            handles.close()
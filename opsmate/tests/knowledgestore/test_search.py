@@ -0,0 +1,248 @@
+import asyncio
+import time
+import lancedb
+import pyarrow as pa
+from lancedb.index import FTS
+from lancedb.rerankers import Reranker, RRFReranker
+
+from opsmate.knowledgestore.search import (
+    collapse_duplicates,
+    hybrid_search,
+    merge_ranked,
+    reciprocal_rank_fusion,
+    rerank,
+)
+
+schema = pa.schema(
+    [
+        pa.field("uuid", pa.string()),
+        pa.field("content", pa.string()),
+        pa.field("data_source", pa.string()),
+        pa.field("path", pa.string()),
+        pa.field("metadata", pa.string()),
+        pa.field("vector", pa.list_(pa.float32(), 2)),
+    ]
+)
+
+docs = [
+    ("1", "how to restart the nginx server", [1.0, 0.0]),
+    ("2", "postgres replication lag runbook", [0.0, 1.0]),
+    ("3", "nginx returns 502 bad gateway", [0.9, 0.1]),
+    ("4", "disk pressure on kubernetes nodes", [0.1, 0.9]),
+]
+
+
+async def create_table(path, name="knowledge_store", docs=docs):
+    db = await lancedb.connect_async(path)
+    table = await db.create_table(
+        name,
+        data=[
+            {
+                "uuid": id,
+                "content": content,
+                "data_source": "fs",
+                "path": f"{id}.md",
+                "metadata": "{}",
+                "vector": vector,
+            }
+            for id, content, vector in docs
+        ],
+        schema=schema,
+    )
+    await table.create_index("content", config=FTS())
+    return table
+
+
+async def embed_nginx(query: str):
+    return [1.0, 0.0]
+
+
+class FtsOnlyReranker(Reranker):
+    def rerank_hybrid(self, query, vector_results, fts_results):
+        raise NotImplementedError
+
+
+class ReverseReranker(FtsOnlyReranker):
+    def rerank_fts(self, query: str, fts_results: pa.Table):
+        fts_results = fts_results.drop_columns(["_score"])
+        return fts_results.append_column(
+            "_relevance_score",
+            pa.array(range(fts_results.num_rows), type=pa.float32()),
+        )
+
+
+class SlowReranker(FtsOnlyReranker):
+    def rerank_fts(self, query: str, fts_results: pa.Table):
+        time.sleep(1)
+        return fts_results
+
+
+def test_reciprocal_rank_fusion():
+    vector = [{"uuid": "a", "_distance": 0.1}, {"uuid": "b", "_distance": 0.2}]
+    fts = [{"uuid": "b", "_score": 3.0}, {"uuid": "c", "_score": 1.0}]
+
+    fused = reciprocal_rank_fusion(vector, fts, k=60)
+
+    assert [r["uuid"] for r in fused] == ["b", "a", "c"]
+    assert fused[0]["_relevance_score"] == 1 / 62 + 1 / 61
+    assert "_distance" not in fused[1] and "_score" not in fused[0]
+
+
+async def test_hybrid_search(tmp_path):
+    table = await create_table(tmp_path)
+
+    results = await hybrid_search(table, "nginx", embed=embed_nginx, top_n=2)
+
+    assert [r["uuid"] for r in results] == ["1", "3"]
+    assert set(results[0]) == {
+        "uuid",
+        "content",
+        "data_source",
+        "path",
+        "metadata",
+        "_relevance_score",
+    }
+
+
+async def test_hybrid_search_across_shards(tmp_path):
+    shards = [
+        await create_table(tmp_path, "knowledge_store__fs", docs[:2]),
+        await create_table(tmp_path, "knowledge_store__github", docs[2:]),
+    ]
+
+    results = await hybrid_search(shards, "nginx", embed=embed_nginx, top_n=2)
+
+    assert [r["uuid"] for r in results] == ["1", "3"]
+
+
+def test_merge_ranked():
+    shards = [
+        [{"uuid": "a", "_distance": 0.1}, {"uuid": "b", "_distance": 0.4}],
+        [{"uuid": "c", "_distance": 0.2}],
+    ]
+    merged = merge_ranked(shards, "_distance", descending=False, limit=2)
+    assert [r["uuid"] for r in merged] == ["a", "c"]
+
+
+async def test_hybrid_search_with_filter(tmp_path):
+    table = await create_table(tmp_path)
+
+    results = await hybrid_search(
+        table, "nginx", embed=embed_nginx, filter="path != '1.md'", top_n=2
+    )
+
+    assert results[0]["uuid"] == "3"
+    assert all(r["uuid"] != "1" for r in results)
+
+
+async def test_fts_starts_before_the_embedding_completes(tmp_path):
+    table = await create_table(tmp_path)
+    fts_done = asyncio.Event()
+
+    async def embed(query: str):
+        # would deadlock if the fts leg waited for the embedding
+        await asyncio.wait_for(fts_done.wait(), timeout=5)
+        return [1.0, 0.0]
+
+    class Table:
+        def query(self):
+            return Query(table.query())
+
+    class Query:
+        def __init__(self, q):
+            self.q = q
+
+        def __getattr__(self, name):
+            attr = getattr(self.q, name)
+
+            def wrapped(*args, **kwargs):
+                result = attr(*args, **kwargs)
+                if name == "to_list":
+                    return self.track(result)
+                return Query(result)
+
+            return wrapped
+
+        async def track(self, result):
+            result = await result
+            if isinstance(self.q, lancedb.query.AsyncFTSQuery):
+                fts_done.set()
+            return result
+
+    results = await hybrid_search(Table(), "nginx", embed=embed, top_n=2)
+    assert [r["uuid"] for r in results] == ["1", "3"]
+
+
+async def test_failed_leg_cancels_the_in_flight_queries():
+    started, cancelled = asyncio.Event(), asyncio.Event()
+
+    class Table:
+        def query(self):
+            return Query()
+
+    class Query:
+        vector = False
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: self
+
+        def nearest_to(self, vector):
+            self.vector = True
+            return self
+
+        async def to_list(self):
+            if not self.vector:
+                await started.wait()
+                raise RuntimeError("fts index is broken")
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+    try:
+        await hybrid_search(Table(), "nginx", embed=embed_nginx, top_n=2)
+    except RuntimeError as e:
+        assert str(e) == "fts index is broken"
+    else:
+        raise AssertionError("the fts error is not raised")
+    # the vector query is cancelled rather than left running
+    assert cancelled.is_set()
+
+
+async def test_rerank_bounded_candidates(tmp_path):
+    table = await create_table(tmp_path)
+
+    results = await hybrid_search(
+        table,
+        "nginx",
+        embed=embed_nginx,
+        top_n=3,
+        reranker=ReverseReranker(),
+        rerank_candidates=2,
+    )
+
+    # the first two candidates are reversed, the rest is kept in the fused order
+    assert [r["uuid"] for r in results[:2]] == ["3", "1"]
+    assert len(results) == 3
+
+
+async def test_rerank_falls_back_on_timeout():
+    candidates = [{"uuid": "a", "content": "a", "_relevance_score": 1.0}]
+
+    results = await rerank(SlowReranker(), "q", candidates, timeout=0.05)
+    assert results == candidates
+
+    assert await rerank(RRFReranker(), "q", candidates) == candidates
+
+
+def test_collapse_duplicates():
+    rows = [
+        {"uuid": "b", "canonical_uuid": "a"},
+        {"uuid": "c", "canonical_uuid": ""},
+        {"uuid": "a", "canonical_uuid": ""},
+        {"uuid": "d", "canonical_uuid": "a"},
+        {"uuid": "e"},
+    ]
+    assert [row["uuid"] for row in collapse_duplicates(rows)] == ["b", "c", "e"]
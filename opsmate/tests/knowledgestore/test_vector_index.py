@@ -0,0 +1,80 @@
+import lancedb
+import numpy as np
+import pyarrow as pa
+
+from opsmate.knowledgestore.models import (
+    VECTOR_PRECISIONS,
+    check_vector_field,
+    create_vector_index,
+)
+
+
+async def create_table(path, rows: int, precision: str = "float32"):
+    vectors = np.random.default_rng(42).normal(size=(rows, 32)).astype(np.float32)
+    db = await lancedb.connect_async(path)
+    value_type = VECTOR_PRECISIONS[precision]
+    return await db.create_table(
+        "knowledge_store",
+        data=pa.table(
+            {
+                "id": pa.array(np.arange(rows)),
+                "vector": pa.FixedSizeListArray.from_arrays(
+                    pa.array(vectors.ravel(), type=value_type), 32
+                ),
+            }
+        ),
+    )
+
+
+async def vector_indexes(table):
+    return [
+        index.index_type
+        for index in await table.list_indices()
+        if "vector" in index.columns
+    ]
+
+
+async def test_flat_creates_no_index(tmp_path):
+    table = await create_table(tmp_path, 300)
+    assert not await create_vector_index(table, kind="flat", min_rows=0)
+    assert await vector_indexes(table) == []
+
+
+async def test_index_is_only_trained_from_min_rows(tmp_path):
+    table = await create_table(tmp_path, 300)
+    assert not await create_vector_index(table, kind="ivf_pq", min_rows=1000)
+    assert await vector_indexes(table) == []
+
+    assert await create_vector_index(table, kind="ivf_pq", min_rows=300)
+    assert await vector_indexes(table) == ["IvfPq"]
+    # already indexed
+    assert not await create_vector_index(table, kind="ivf_pq", min_rows=300)
+
+
+async def test_index_kind_change_replaces_the_index(tmp_path):
+    table = await create_table(tmp_path, 300)
+    assert await create_vector_index(table, kind="ivf_pq", min_rows=0)
+    assert await create_vector_index(table, kind="hnsw_sq", min_rows=0)
+    assert await vector_indexes(table) == ["IvfHnswSq"]
+
+    query = np.ones(32, dtype=np.float32)
+    rows = await table.query().nearest_to(query).refine_factor(4).limit(5).to_list()
+    assert len(rows) == 5
+
+
+async def test_float16_vectors(tmp_path):
+    table = await create_table(tmp_path, 300, "float16")
+    assert await create_vector_index(table, kind="ivf_pq", min_rows=0)
+    assert await vector_indexes(table) == ["IvfPq"]
+
+    query = np.ones(32, dtype=np.float32)
+    rows = await table.query().nearest_to(query).refine_factor(4).limit(5).to_list()
+    assert len(rows) == 5
+
+
+def test_check_vector_field(capsys):
+    schema = pa.schema([pa.field("vector", pa.list_(pa.float32(), 8))])
+    check_vector_field(schema, pa.float32(), 8)
+    assert "do not match" not in capsys.readouterr().out
+    check_vector_field(schema, pa.float16(), 8)
+    assert "do not match" in capsys.readouterr().out
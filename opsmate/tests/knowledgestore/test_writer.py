@@ -0,0 +1,167 @@
+import asyncio
+import uuid
+import json
+import lancedb
+import numpy as np
+import pyarrow as pa
+from lancedb.embeddings import TextEmbeddingFunction, get_registry
+from lancedb.embeddings.registry import register
+from lancedb.pydantic import LanceModel, Vector
+from datetime import datetime
+
+from opsmate.knowledgestore.buffer import WriteBehindBuffer
+from opsmate.knowledgestore.models import scope_filter
+from opsmate.knowledgestore.writer import (
+    KNOWLEDGE_SCHEMA,
+    chunk_uuids,
+    embed_batch,
+    knowledge_batch,
+    uuid4_array,
+    write_batches,
+)
+
+# the texts of each embedding call
+calls = []
+
+
+@register("writer-test")
+class LengthEmbeddings(TextEmbeddingFunction):
+    def ndims(self):
+        return 2
+
+    def generate_embeddings(self, texts):
+        calls.append(list(texts))
+        return [np.array([len(text), 1.0]) for text in texts]
+
+
+embeddings = get_registry().get("writer-test").create()
+
+
+class Knowledge(LanceModel):
+    uuid: str
+    id: int
+    categories: list[str]
+    data_source_provider: str
+    data_source: str
+    metadata: str
+    path: str
+    content: str = embeddings.SourceField()
+    vector: Vector(2) = embeddings.VectorField()
+    created_at: datetime
+    canonical_uuid: str
+
+
+def batch(path: str, *contents: str):
+    return knowledge_batch(
+        list(contents),
+        metadata=[json.dumps({"n": idx}) for idx in range(len(contents))],
+        data_source_provider="fs",
+        data_source="/docs",
+        path=path,
+    )
+
+
+def test_uuid4_array():
+    uuids = uuid4_array(1000).to_pylist()
+    assert len(set(uuids)) == 1000
+    assert all(uuid.UUID(value).version == 4 for value in uuids)
+    assert all(str(uuid.UUID(value)) == value for value in uuids)
+    assert uuid4_array(0).to_pylist() == []
+
+
+def test_chunk_uuids():
+    uuids = chunk_uuids(1, "docs/a.md", [0, 1, 2]).to_pylist()
+    assert len(set(uuids)) == 3
+    assert chunk_uuids(1, "docs/a.md", [0, 1, 2]).to_pylist() == uuids
+    assert chunk_uuids(1, "docs/b.md", [0])[0].as_py() not in uuids
+    assert chunk_uuids(2, "docs/a.md", [0])[0].as_py() not in uuids
+
+    kb = knowledge_batch(
+        ["a", "b", "c"],
+        data_source_provider="fs",
+        data_source="docs",
+        path="docs/a.md",
+        metadata=["{}"] * 3,
+        uuids=chunk_uuids(1, "docs/a.md", [0, 1, 2]),
+    )
+    assert kb.column("uuid").to_pylist() == uuids
+
+
+def test_knowledge_batch():
+    kbs = batch("a.md", "hello", "world")
+    assert kbs.schema == KNOWLEDGE_SCHEMA
+    rows = kbs.to_pylist()
+    assert [row["id"] for row in rows] == [0, 1]
+    assert [row["path"] for row in rows] == ["a.md", "a.md"]
+    assert [row["categories"] for row in rows] == [[], []]
+    assert rows[1]["metadata"] == '{"n": 1}'
+    assert rows[0]["created_at"] == rows[1]["created_at"]
+
+    kbs = knowledge_batch(
+        ["up"],
+        metadata=["{}"],
+        ids=[7],
+        categories=[["prometheus"]],
+        data_source_provider="prometheus",
+        data_source="http://prom",
+        path=["up"],
+    )
+    assert kbs.to_pylist()[0]["categories"] == ["prometheus"]
+    assert kbs.to_pylist()[0]["id"] == 7
+
+
+async def test_embed_batch_only_embeds_missing_vectors(tmp_path):
+    db = await lancedb.connect_async(tmp_path)
+    table = await db.create_table("knowledge_store", schema=Knowledge)
+    table_schema = await table.schema()
+
+    calls.clear()
+    kbs = await embed_batch(batch("a.md", "a", "bb"), table_schema)
+    assert calls == [["a", "bb"]]
+    assert kbs.column("vector").to_pylist() == [[1.0, 1.0], [2.0, 1.0]]
+
+    calls.clear()
+    kbs = batch("b.md", "ccc", "dddd").append_column(
+        "vector", pa.array([[9.0, 9.0], None], type=pa.list_(pa.float32(), 2))
+    )
+    kbs = await embed_batch(kbs, table_schema)
+    assert calls == [["dddd"]]
+    assert kbs.column("vector").to_pylist() == [[9.0, 9.0], [4.0, 1.0]]
+
+
+async def test_write_batches(tmp_path):
+    db = await lancedb.connect_async(tmp_path)
+    table = await db.create_table("knowledge_store", schema=Knowledge)
+
+    await write_batches(table, [batch("a.md", "a"), batch("b.md", "bb")])
+    await write_batches(table, [batch("a.md", "aaa")], merge_on=["path", "data_source"])
+    rows = await table.query().select(["path", "content", "vector"]).to_list()
+    assert sorted(
+        (row["path"], row["content"], list(row["vector"])) for row in rows
+    ) == [
+        ("a.md", "aaa", [3.0, 1.0]),
+        ("b.md", "bb", [2.0, 1.0]),
+    ]
+
+
+async def test_buffer_embeds_record_batches_in_one_call(tmp_path):
+    db = await lancedb.connect_async(tmp_path)
+    table = await db.create_table("knowledge_store", schema=Knowledge)
+
+    async def open_table():
+        return table
+
+    calls.clear()
+    buffer = WriteBehindBuffer(open_table, max_rows=100, max_delay=0.05)
+    await asyncio.gather(
+        buffer.replace(scope_filter(path="a.md"), batch("a.md", "a", "bb")),
+        buffer.replace(scope_filter(path="b.md"), batch("b.md", "ccc")),
+    )
+
+    assert calls == [["a", "bb", "ccc"]]
+    rows = await table.query().select(["content", "vector"]).to_list()
+    assert sorted((row["content"], list(row["vector"])) for row in rows) == [
+        ("a", [1.0, 1.0]),
+        ("bb", [2.0, 1.0]),
+        ("ccc", [3.0, 1.0]),
+    ]
@@ -0,0 +1,317 @@
+import pytest
+import random
+from typing import List, Tuple, Dict
+from opsmate.textsplitters.base import TextSplitter, Chunk
+from opsmate.textsplitters.markdown_header import (
+    MarkdownHeaderTextSplitter,
+    LineType,
+    HeaderType,
+    iter_lines,
+)
+
+
+def test_iter_lines():
+    for text in ["", "a", "a\n", "\n\na\nb\n\n"]:
+        assert list(iter_lines(text)) == text.split("\n")
+
+
+def random_markdown(rng: random.Random, lines: int) -> str:
+    choices = [
+        "# Title",
+        "## Section",
+        "### Subsection",
+        "#### Deep",
+        "##NoSpace",
+        "#",
+        "",
+        "",
+        "plain text line",
+        "  indented text  ",
+        "```python",
+        "```",
+        "~~~",
+        "inline ```code``` span",
+        "text\twith\x00control",
+        "- list item",
+    ]
+    return "\n".join(
+        rng.choice(choices) + (f" {i}" if rng.random() < 0.5 else "")
+        for i in range(lines)
+    )
+
+
+@pytest.mark.parametrize("return_each_line", [False, True])
+@pytest.mark.parametrize("strip_headers", [True, False])
+def test_split_text_matches_legacy(return_each_line, strip_headers):
+    headers = [("#", "h1"), ("##", "h2"), ("###", "h3"), ("####", None)]
+    splitter = MarkdownHeaderTextSplitter(
+        headers_to_split_on=headers,
+        return_each_line=return_each_line,
+        strip_headers=strip_headers,
+    )
+    legacy = LegacyMarkdownHeaderTextSplitter(
+        headers_to_split_on=headers,
+        return_each_line=return_each_line,
+        strip_headers=strip_headers,
+    )
+
+    rng = random.Random(int(return_each_line) * 2 + int(strip_headers))
+    for lines in [0, 1, 5, 50, 500] * 4:
+        text = random_markdown(rng, lines)
+        assert splitter.split_text(text) == legacy.split_text(text)
+
+
+def test_split_lines_from_file(tmp_path):
+    text = random_markdown(random.Random(42), 1000)
+    (tmp_path / "doc.md").write_text(text)
+    splitter = MarkdownHeaderTextSplitter(
+        headers_to_split_on=[("#", "h1"), ("##", "h2")]
+    )
+
+    with open(tmp_path / "doc.md") as f:
+        chunks = list(splitter.split_lines(f))
+    assert chunks == splitter.split_text(text)
+
+
+def test_split_lines_yields_sections_as_they_close():
+    consumed = []
+
+    def lines():
+        for line in ["# A", "a", "", "a2", "# B", "b", "# C", "c"]:
+            consumed.append(line)
+            yield line
+
+    splitter = MarkdownHeaderTextSplitter(headers_to_split_on=[("#", "h1")])
+    chunks = splitter.split_lines(lines())
+
+    first = next(chunks)
+    assert first == Chunk(content="a  \na2", metadata={"h1": "A"})
+    # section A is yielded once the first block of section B is read
+    assert consumed == ["# A", "a", "", "a2", "# B", "b", "# C"]
+    assert [chunk.content for chunk in chunks] == ["b", "c"]
+
+
+class LegacyMarkdownHeaderTextSplitter(TextSplitter):
+    """
+    The whole-text implementation the streaming splitter is checked against.
+    """
+
+    def __init__(
+        self,
+        headers_to_split_on: List[Tuple[str, str]],
+        return_each_line: bool = False,
+        strip_headers: bool = True,
+        chunk_size: int | None = None,
+        chunk_overlap: int = 0,
+        tokenizer: str | None = None,
+    ):
+        """Create a new MarkdownHeaderTextSplitter.
+
+        Args:
+            headers_to_split_on: Headers we want to track
+            return_each_line: Return each line w/ associated headers
+            strip_headers: Strip split headers from the content of the chunk
+            chunk_size: Split the sections larger than this further, unbounded if not set
+            chunk_overlap: The overlap between the chunks of a section split further
+            tokenizer: The tiktoken encoding to measure the chunk size in tokens, e.g. cl100k_base
+        """
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.tokenizer = tokenizer
+        # Output line-by-line or aggregated into chunks w/ common headers
+        self.return_each_line = return_each_line
+        # Given the headers we want to split on,
+        # (e.g., "#, ##, etc") order by length
+        self.headers_to_split_on = sorted(
+            headers_to_split_on, key=lambda split: len(split[0]), reverse=True
+        )
+        # Strip headers split headers from the content of the chunk
+        self.strip_headers = strip_headers
+
+    def aggregate_lines_to_chunks(self, lines: List[LineType]) -> List[Chunk]:
+        """Combine lines with common metadata into chunks
+        Args:
+            lines: Line of text / associated header metadata
+        """
+        aggregated_chunks: List[LineType] = []
+
+        for line in lines:
+            if (
+                aggregated_chunks
+                and aggregated_chunks[-1]["metadata"] == line["metadata"]
+            ):
+                # If the last line in the aggregated list
+                # has the same metadata as the current line,
+                # append the current content to the last lines's content
+                aggregated_chunks[-1]["content"] += "  \n" + line["content"]
+            elif (
+                aggregated_chunks
+                and aggregated_chunks[-1]["metadata"] != line["metadata"]
+                # may be issues if other metadata is present
+                and len(aggregated_chunks[-1]["metadata"]) < len(line["metadata"])
+                and aggregated_chunks[-1]["content"].split("\n")[-1][0] == "#"
+                and not self.strip_headers
+            ):
+                # If the last line in the aggregated list
+                # has different metadata as the current line,
+                # and has shallower header level than the current line,
+                # and the last line is a header,
+                # and we are not stripping headers,
+                # append the current content to the last line's content
+                aggregated_chunks[-1]["content"] += "  \n" + line["content"]
+                # and update the last line's metadata
+                aggregated_chunks[-1]["metadata"] = line["metadata"]
+            else:
+                # Otherwise, append the current line to the aggregated list
+                aggregated_chunks.append(line)
+
+        return [
+            Chunk(content=chunk["content"], metadata=chunk["metadata"])
+            for chunk in aggregated_chunks
+        ]
+
+    def split_text(self, text: str) -> List[Chunk]:
+        """Split markdown file
+        Args:
+            text: Markdown file"""
+
+        # Split the input text by newline character ("\n").
+        lines = text.split("\n")
+        # Final output
+        lines_with_metadata: List[LineType] = []
+        # Content and metadata of the chunk currently being processed
+        current_content: List[str] = []
+        current_metadata: Dict[str, str] = {}
+        # Keep track of the nested header structure
+        # header_stack: List[Dict[str, Union[int, str]]] = []
+        header_stack: List[HeaderType] = []
+        initial_metadata: Dict[str, str] = {}
+
+        in_code_block = False
+        opening_fence = ""
+
+        for line in lines:
+            stripped_line = line.strip()
+            # Remove all non-printable characters from the string, keeping only visible
+            # text.
+            stripped_line = "".join(filter(str.isprintable, stripped_line))
+            if not in_code_block:
+                # Exclude inline code spans
+                if stripped_line.startswith("```") and stripped_line.count("```") == 1:
+                    in_code_block = True
+                    opening_fence = "```"
+                elif stripped_line.startswith("~~~"):
+                    in_code_block = True
+                    opening_fence = "~~~"
+            else:
+                if stripped_line.startswith(opening_fence):
+                    in_code_block = False
+                    opening_fence = ""
+
+            if in_code_block:
+                current_content.append(stripped_line)
+                continue
+
+            # Check each line against each of the header types (e.g., #, ##)
+            for sep, name in self.headers_to_split_on:
+                # Check if line starts with a header that we intend to split on
+                if stripped_line.startswith(sep) and (
+                    # Header with no text OR header is followed by space
+                    # Both are valid conditions that sep is being used a header
+                    len(stripped_line) == len(sep)
+                    or stripped_line[len(sep)] == " "
+                ):
+                    # Ensure we are tracking the header as metadata
+                    if name is not None:
+                        # Get the current header level
+                        current_header_level = sep.count("#")
+
+                        # Pop out headers of lower or same level from the stack
+                        while (
+                            header_stack
+                            and header_stack[-1]["level"] >= current_header_level
+                        ):
+                            # We have encountered a new header
+                            # at the same or higher level
+                            popped_header = header_stack.pop()
+                            # Clear the metadata for the
+                            # popped header in initial_metadata
+                            if popped_header["name"] in initial_metadata:
+                                initial_metadata.pop(popped_header["name"])
+
+                        # Push the current header to the stack
+                        header: HeaderType = {
+                            "level": current_header_level,
+                            "name": name,
+                            "data": stripped_line[len(sep) :].strip(),
+                        }
+                        header_stack.append(header)
+                        # Update initial_metadata with the current header
+                        initial_metadata[name] = header["data"]
+
+                    # Add the previous line to the lines_with_metadata
+                    # only if current_content is not empty
+                    if current_content:
+                        lines_with_metadata.append(
+                            {
+                                "content": "\n".join(current_content),
+                                "metadata": current_metadata.copy(),
+                            }
+                        )
+                        current_content.clear()
+
+                    if not self.strip_headers:
+                        current_content.append(stripped_line)
+
+                    break
+            else:
+                if stripped_line:
+                    current_content.append(stripped_line)
+                elif current_content:
+                    lines_with_metadata.append(
+                        {
+                            "content": "\n".join(current_content),
+                            "metadata": current_metadata.copy(),
+                        }
+                    )
+                    current_content.clear()
+
+            current_metadata = initial_metadata.copy()
+
+        if current_content:
+            lines_with_metadata.append(
+                {"content": "\n".join(current_content), "metadata": current_metadata}
+            )
+
+        # lines_with_metadata has each line with associated header metadata
+        # aggregate these into chunks based on common metadata
+        if not self.return_each_line:
+            chunks = self.aggregate_lines_to_chunks(lines_with_metadata)
+        else:
+            chunks = [
+                Chunk(content=chunk["content"], metadata=chunk["metadata"])
+                for chunk in lines_with_metadata
+            ]
+        return self.split_large_chunks(chunks)
+
+    def split_large_chunks(self, chunks: List[Chunk]) -> List[Chunk]:
+        """Split the chunks larger than chunk_size, keeping their header metadata
+        Args:
+            chunks: Chunks of the markdown sections
+        """
+        if self.chunk_size is None:
+            return chunks
+
+        splitter = RecursiveTextSplitter(
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            tokenizer=self.tokenizer,
+        )
+        result = []
+        for chunk in chunks:
+            # a section that fits comes back as a single chunk, measured once
+            for sub_chunk in splitter.split_text(chunk.content):
+                result.append(
+                    Chunk(content=sub_chunk.content, metadata=chunk.metadata.copy())
+                )
+        return result
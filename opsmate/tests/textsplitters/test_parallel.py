@@ -0,0 +1,79 @@
+import asyncio
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from opsmate.textsplitters import splitter_from_config
+from opsmate.textsplitters.parallel import ParallelSplitter, split_texts
+
+splitter_config = {
+    "splitter": "recursive",
+    "chunk_size": 200,
+    "chunk_overlap": 20,
+}
+
+
+def doc(i: int) -> str:
+    return "\n\n".join(
+        f"# Section {i}.{j}\n\n" + f"paragraph {i}.{j} " * 30 for j in range(5)
+    )
+
+
+def test_splitter_from_config_does_not_mutate_the_config():
+    config = dict(splitter_config)
+    splitter_from_config(config)
+    assert config == splitter_config
+
+
+async def test_split_inline_and_in_the_pool_are_the_same():
+    texts = [doc(i) for i in range(6)]
+    expected = [
+        [(chunk.content, chunk.metadata) for chunk in splitter.split_text(text)]
+        for splitter in [splitter_from_config(splitter_config)]
+        for text in texts
+    ]
+
+    inline = ParallelSplitter(executor=None)
+    assert [await inline.split(splitter_config, text) for text in texts] == expected
+
+    with ProcessPoolExecutor(
+        max_workers=2, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        pooled = ParallelSplitter(executor, inline_threshold=0)
+        results = await asyncio.gather(
+            *[pooled.split(splitter_config, text) for text in texts]
+        )
+    assert results == expected
+
+
+class RecordingExecutor(ProcessPoolExecutor):
+    def __init__(self):
+        super().__init__(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        self.batches = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.batches.append(len(args[1]))
+        return super().submit(fn, *args, **kwargs)
+
+
+async def test_concurrent_splits_are_batched():
+    with RecordingExecutor() as executor:
+        splitter = ParallelSplitter(
+            executor, inline_threshold=1000, batch_size=len(doc(0)) * 3
+        )
+        small = await splitter.split(splitter_config, "# tiny\n\ntiny")
+        assert (
+            small
+            == split_texts(
+                json.dumps(splitter_config, sort_keys=True),
+                ["# tiny\n\ntiny"],
+            )[0]
+        )
+        assert executor.batches == []
+
+        results = await asyncio.gather(
+            *[splitter.split(splitter_config, doc(i)) for i in range(4)]
+        )
+
+    assert all(results)
+    # three texts fill the batch, the fourth one is flushed after the delay
+    assert executor.batches == [3, 1]
@@ -1,5 +1,8 @@
 from opsmate.textsplitters.recursive import RecursiveTextSplitter
-from opsmate.textsplitters.base import Chunk
+from opsmate.textsplitters.base import TextSplitter, Chunk
+from typing import List
+import pytest
+import random
 
 
 def test_recursive_text_splitter():
@@ -44,3 +47,138 @@ def test_recursive_text_splitter():
         Chunk(content="text.", metadata={"seperator": " "}),
     ]
     assert output == expected_output
+
+
+class LegacyRecursiveTextSplitter(TextSplitter):
+    """
+    The string based implementation the offset based splitter is checked against.
+    """
+
+    def split_text(self, text: str) -> List[str]:
+        """
+        Split the text into chunks of size chunk_size with overlap chunk_overlap
+        """
+        splits = self._split_text(text, 0)
+        splits = self._merge_splits(splits)
+        return self._handle_overlap(splits)
+
+    def _split_text(self, text: str, separatorLevel: int) -> List[Chunk]:
+        if separatorLevel == len(self.separators):
+            return [
+                Chunk(
+                    content=text,
+                    metadata={"seperator": self.separators[-1]},
+                )
+            ]
+
+        if len(text) <= self.chunk_size:
+            return [
+                Chunk(
+                    content=text,
+                    metadata={"seperator": self.separators[separatorLevel - 1]},
+                )
+            ]
+
+        separator = self.separators[separatorLevel]
+        splits = text.split(separator)
+        splits = [split for split in splits if split]
+
+        result = []
+        for split in splits:
+            result.extend(self._split_text(split, separatorLevel + 1))
+
+        return result
+
+    def _merge_splits(self, splits: List[Chunk]) -> List[Chunk]:
+        result = []
+        idx = 0
+        while idx < len(splits):
+            sep1, add = splits[idx].metadata["seperator"], splits[idx].content
+            idx += 1
+            while idx < len(splits):
+                sep2, chunk = splits[idx].metadata["seperator"], splits[idx].content
+                if len(add) + len(sep2) + len(chunk) <= self.chunk_size:
+                    add += sep2 + chunk
+                    idx += 1
+                else:
+                    break
+            result.append(
+                Chunk(
+                    content=add,
+                    metadata={"seperator": sep1},
+                )
+            )
+        return result
+
+    def _handle_overlap(self, splits: List[Chunk]) -> List[Chunk]:
+        result = []
+        for idx, split in enumerate(splits):
+            sep1, add = split.metadata["seperator"], split.content
+            overlap_remain = self.chunk_overlap + self.chunk_size - len(add)
+
+            while overlap_remain > 0:
+                for idx2 in range(idx + 1, len(splits)):
+                    sep2, chunk = (
+                        splits[idx2].metadata["seperator"],
+                        splits[idx2].content,
+                    )
+                    if len(sep2) + len(chunk) <= overlap_remain:
+                        add += sep2 + chunk
+                        overlap_remain -= len(chunk) - len(sep2)
+                    else:
+                        break
+                break
+            result.append(
+                Chunk(
+                    content=add,
+                    metadata={"seperator": sep1},
+                )
+            )
+
+        return result
+
+
+def random_text(rng: random.Random, size: int) -> str:
+    tokens = ["alpha", "beta", "gamma", "x", "kubectl", "a" * 30, "é"]
+    separators = ["\n\n", "\n", ".", "?", "!", ";", ",", " ", "  ", "\n\n\n"]
+    parts = []
+    while sum(map(len, parts)) < size:
+        parts.append(rng.choice(tokens))
+        parts.append(rng.choice(separators))
+    return "".join(parts)
+
+
+@pytest.mark.parametrize(
+    "chunk_size,chunk_overlap,separators",
+    [
+        (1000, 0, []),
+        (100, 0, []),
+        (100, 30, []),
+        (40, 10, []),
+        (10, 5, []),
+        (50, 200, []),
+        (20, 0, [".", ","]),
+        (30, 15, ["\n\n", " "]),
+        (60, 20, ["\n\n", "\n", " ", ""]),
+    ],
+)
+def test_recursive_text_splitter_matches_legacy(chunk_size, chunk_overlap, separators):
+    rng = random.Random(chunk_size * 1000 + chunk_overlap)
+    texts = ["", " ", "\n\n", "short", "a" * 35 + " b"] + [
+        random_text(rng, size) for size in [10, 100, 1000, 5000] for _ in range(5)
+    ]
+    kwargs = dict(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, separators=separators
+    )
+    splitter = RecursiveTextSplitter(**kwargs)
+    legacy = LegacyRecursiveTextSplitter(**kwargs)
+
+    for text in texts:
+        try:
+            expected = legacy.split_text(text)
+        except ValueError as e:
+            # e.g. splitting on the empty separator
+            with pytest.raises(ValueError, match=str(e)):
+                splitter.split_text(text)
+            continue
+        assert splitter.split_text(text) == expected
@@ -0,0 +1,78 @@
+import re
+import sys
+import pytest
+from unittest.mock import patch
+from opsmate.textsplitters import (
+    RecursiveTextSplitter,
+    MarkdownHeaderTextSplitter,
+    splitter_from_config,
+)
+from opsmate.textsplitters.tokens import (
+    token_counter,
+    approximate_token_count,
+    length_function,
+)
+
+text = "\n\n".join(
+    f"Paragraph {i}. The pod kept restarting because it was OOMKilled, "
+    "so we raised the memory limit and the p99 latency dropped! " * 3
+    for i in range(20)
+)
+
+
+@pytest.fixture
+def no_tiktoken():
+    token_counter.cache_clear()
+    with patch.dict(sys.modules, {"tiktoken": None}):
+        yield
+    token_counter.cache_clear()
+
+
+def test_approximate_token_count():
+    assert approximate_token_count("") == 0
+    assert approximate_token_count("hello world") == 2
+    assert approximate_token_count("it's 12345 tokens!") == 6
+
+
+def test_length_function(no_tiktoken):
+    assert length_function() is len
+    assert length_function("cl100k_base") is approximate_token_count
+
+
+def test_recursive_splitter_in_tokens(no_tiktoken):
+    splitter = RecursiveTextSplitter(chunk_size=50, tokenizer="cl100k_base")
+    chunks = splitter.split_text(text)
+
+    assert len(chunks) > 1
+    assert all(splitter.length(chunk.content) <= 50 for chunk in chunks)
+    # chunks are far larger than 50 characters
+    assert all(len(chunk.content) > 50 for chunk in chunks[:-1])
+    # the separators at the chunk boundaries are dropped, the words are kept
+    words = re.findall(r"\w+", " ".join(chunk.content for chunk in chunks))
+    assert words == re.findall(r"\w+", text)
+
+
+def test_recursive_splitter_in_chars_is_unchanged():
+    chars = RecursiveTextSplitter(chunk_size=100, chunk_overlap=20)
+    assert all(len(chunk.content) <= 120 for chunk in chars.split_text(text))
+
+
+def test_markdown_header_splitter_in_tokens(no_tiktoken):
+    markdown = "## Runbook\n\n" + text + "\n\n## Short\n\nshort section"
+    splitter = splitter_from_config(
+        {
+            "splitter": "markdown_header",
+            "headers_to_split_on": [["##", "h2"]],
+            "chunk_size": 50,
+            "tokenizer": "cl100k_base",
+        }
+    )
+    assert isinstance(splitter, MarkdownHeaderTextSplitter)
+    chunks = splitter.split_text(markdown)
+
+    assert chunks[-1].content == "short section"
+    assert chunks[-1].metadata == {"h2": "Short"}
+    runbook = chunks[:-1]
+    assert len(runbook) > 1
+    assert all(chunk.metadata == {"h2": "Runbook"} for chunk in runbook)
+    assert all(approximate_token_count(chunk.content) <= 50 for chunk in runbook)
@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+from opsmate.tools.downsampling import (
+    change_points,
+    downsample,
+    format_value,
+    lttb,
+    matrix_result,
+    min_max,
+    series_stats,
+    stride,
+    top_k_series,
+)
+from opsmate.tools.prom import PromQuery
+from opsmate.tools.prom_frame import decode_matrix
+
+
+def spiky(size=200, spike=137):
+    x = np.arange(size, dtype=np.float64) * 15
+    y = np.ones(size)
+    y[spike] = 100.0
+    return x, y
+
+
+def matrix(series):
+    return [
+        {
+            "metric": {"pod": f"pod-{i}"},
+            "values": [[1700000000 + 15 * j, str(v)] for j, v in enumerate(values)],
+        }
+        for i, values in enumerate(series)
+    ]
+
+
+@pytest.mark.parametrize("strategy", [lttb, min_max, change_points])
+def test_strategies_keep_the_spike(strategy):
+    x, y = spiky()
+    indices = strategy(x, y, 20)
+    assert 137 in indices
+    assert indices[0] == 0 and indices[-1] == len(x) - 1
+    assert len(indices) <= 20
+    assert (np.diff(indices) > 0).all()
+
+
+def test_stride_drops_the_spike():
+    x, y = spiky()
+    assert 137 not in stride(x, y, 20)
+
+
+@pytest.mark.parametrize("strategy", [lttb, min_max, change_points, stride])
+def test_short_series_are_kept(strategy):
+    x, y = spiky(size=10, spike=3)
+    assert strategy(x, y, 20).tolist() == list(range(10))
+
+
+def test_lttb_ignores_nan():
+    x, y = spiky()
+    y[10:20] = np.nan
+    indices = lttb(x, y, 20)
+    assert len(indices) == 20
+    assert 137 in indices
+
+
+def test_downsample():
+    columns = decode_matrix(matrix([[1.0] * 100, [2.0] * 5]))
+    sampled = downsample(columns, 10, "minmax")
+    assert sampled.series == columns.series
+    assert len(sampled.samples(0)[0]) <= 10
+    assert sampled.samples(1)[1].tolist() == [2.0] * 5
+
+    with pytest.raises(ValueError):
+        downsample(columns, 10, "nope")
+
+
+def test_series_stats():
+    columns = decode_matrix(matrix([[1, 2, 3, "NaN"], [5], [2, 4]]))
+    stats = series_stats(columns)
+    assert stats["min"].tolist() == [1, 5, 2]
+    assert stats["max"].tolist() == [3, 5, 4]
+    assert stats["mean"].tolist() == [2, 5, 3]
+    assert stats["std"].tolist() == pytest.approx([np.std([1, 2, 3]), 0, 1])
+    assert np.isnan(stats["last"][0])
+    assert stats["last"][1:].tolist() == [5, 4]
+
+
+def test_top_k_series():
+    columns = decode_matrix(matrix([[1, 1, 1], [1, 10, 1], [1, 2, 1], [0, 50, 0]]))
+    assert top_k_series(columns, 2) == [1, 3]
+    assert top_k_series(columns, 10) == [0, 1, 2, 3]
+
+
+def test_matrix_result():
+    columns = decode_matrix(matrix([[1.5, "+Inf", "NaN", 1 / 3]]))
+    assert matrix_result(columns)[0]["values"] == [
+        [1700000000, "1.5"],
+        [1700000015, "+Inf"],
+        [1700000030, "NaN"],
+        [1700000045, "0.333333"],
+    ]
+    assert format_value(-np.inf) == "-Inf"
+
+
+def test_prom_query_sampled_output():
+    series = [[1.0] * 200 for _ in range(25)]
+    series[3][137] = 100.0
+    query = PromQuery(
+        query="up",
+        explanation="up",
+        start="2023-11-14T22:13:20Z",
+        end="2023-11-14T23:13:20Z",
+    )
+    query.output = {
+        "status": "success",
+        "data": {"resultType": "matrix", "result": matrix(series)},
+    }
+
+    output = query.sampled_output()
+    assert output["status"] == "success"
+    result = output["data"]["result"]
+    assert len(result) == query.max_series
+    assert all(len(r["values"]) <= query.sample_points for r in result)
+    # the varying series is kept, the series omitted are the last ones of the ties
+    assert [r["metric"]["pod"] for r in result][:5] == [f"pod-{i}" for i in range(5)]
+    assert [1700000000 + 15 * 137, "100"] in result[3]["values"]
+    assert output["data"]["omitted_series"]["count"] == 5
+    assert output["data"]["omitted_series"]["summaries"][0]["max"] == "1"
+    # the output itself is left untouched
+    assert len(query.output["data"]["result"]) == 25
@@ -0,0 +1,62 @@
+import asyncio
+
+from opsmate.config import config
+from opsmate.tools.http_clients import (
+    close_http_clients,
+    endpoint_key,
+    http2_available,
+    http_client,
+)
+
+
+def test_endpoint_key():
+    assert (
+        endpoint_key("http://prometheus:9090/api/v1/query") == "http://prometheus:9090"
+    )
+    assert endpoint_key("https://api.github.com") == "https://api.github.com"
+    assert endpoint_key("") == ""
+
+
+def test_http2_is_available():
+    # h2 comes with the declared httpx[http2] extra
+    assert http2_available()
+
+
+async def test_clients_are_shared_per_endpoint():
+    prometheus = http_client("http://prometheus:9090")
+    assert http_client("http://prometheus:9090/api/v1/query_range") is prometheus
+    assert http_client("http://loki:3100") is not prometheus
+
+    await close_http_clients()
+    assert prometheus.is_closed
+    assert http_client("http://prometheus:9090") is not prometheus
+    await close_http_clients()
+
+
+async def test_least_recently_used_clients_are_evicted(monkeypatch):
+    monkeypatch.setattr(config, "http_max_clients", 2)
+    prometheus = http_client("http://prometheus:9090")
+    loki = http_client("http://loki:3100")
+    assert http_client("http://prometheus:9090") is prometheus
+
+    github = http_client("https://api.github.com")
+    await asyncio.sleep(0)
+    # still usable by the callers holding it, but no longer shared
+    assert not loki.is_closed
+    assert http_client("http://loki:3100") is not loki
+
+    await close_http_clients()
+    assert prometheus.is_closed and github.is_closed and loki.is_closed
+
+
+def test_clients_are_bound_to_the_event_loop():
+    async def client():
+        try:
+            return http_client("http://prometheus:9090")
+        finally:
+            await close_http_clients()
+
+    first = asyncio.run(client())
+    second = asyncio.run(client())
+    assert first is not second
+    assert first.is_closed and second.is_closed
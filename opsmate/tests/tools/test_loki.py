@@ -70,6 +70,7 @@ async def test_loki_query():
         call_args = mock_post.call_args[1]
         assert "data" in call_args
         assert call_args["data"]["query"] == '{namespace="test"} | json'
+        assert call_args["timeout"] == query.timeout
 
         # Assert that the result is as expected
         assert len(result) == 1
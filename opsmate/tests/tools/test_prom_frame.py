@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+from opsmate.tools.prom import PromQuery
+from opsmate.tools.prom_frame import arrow_table, decode_matrix, wide_frame
+
+RESULT = [
+    {
+        "metric": {"job": "api", "code": "200"},
+        "values": [[1700000000, "1.5"], [1700000015, "2"], [1700000030, "NaN"]],
+    },
+    {
+        "metric": {"job": "api", "code": "500"},
+        "values": [[1700000015, "+Inf"], [1700000045, "0.25"]],
+    },
+]
+
+
+def merged_frame(result):
+    """
+    The frame built by merging a frame per series on the timestamp.
+    """
+    df = None
+    for series in result:
+        name = "-".join(series["metric"].values())
+        frame = pd.DataFrame(series["values"], columns=["timestamp", name])
+        frame[name] = frame[name].astype(float)
+        df = frame if df is None else df.merge(frame, on="timestamp", how="outer")
+    df = df.fillna(0.0)
+    df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s")
+    return df
+
+
+def test_decode_matrix():
+    columns = decode_matrix(RESULT)
+    assert columns.series == ["api-200", "api-500"]
+    assert columns.offsets.tolist() == [0, 3, 5]
+    timestamps, values = columns.samples(1)
+    assert timestamps.tolist() == [1700000015, 1700000045]
+    assert values.tolist() == [np.inf, 0.25]
+    assert columns.series_index().tolist() == [0, 0, 0, 1, 1]
+
+
+def test_wide_frame_matches_merged_frame():
+    pd.testing.assert_frame_equal(
+        wide_frame(decode_matrix(RESULT)), merged_frame(RESULT), check_dtype=False
+    )
+
+
+def test_arrow_table():
+    table = arrow_table(decode_matrix(RESULT))
+    assert table.num_rows == 5
+    assert table["series"].to_pylist() == ["api-200"] * 3 + ["api-500"] * 2
+    assert table["timestamp"][1].as_py() == pd.Timestamp(1700000015, unit="s")
+    assert table["value"].to_pylist()[3:] == [np.inf, 0.25]
+
+
+def test_prom_query_frames():
+    query = PromQuery(
+        query="sum(rate(http_requests_total[5m])) by (job, code)",
+        explanation="request rate",
+        start="2023-11-14T22:13:20Z",
+        end="2023-11-14T22:14:05Z",
+    )
+    query.output = {"data": {"resultType": "matrix", "result": RESULT}}
+    df = query.dataframe
+    assert df is query.dataframe
+    assert list(df.columns) == ["timestamp", "api-200", "api-500"]
+    assert df["api-500"].tolist() == [0.0, np.inf, 0.0, 0.25]
+    assert query.to_arrow().num_rows == 5
+
+    query = PromQuery(
+        query="up",
+        explanation="up",
+        start="2023-11-14T22:13:20Z",
+        end="2023-11-14T22:14:05Z",
+    )
+    query.output = {"data": {"resultType": "matrix", "result": []}}
+    assert query.dataframe is None
@@ -0,0 +1,272 @@
+import asyncio
+from collections import Counter
+from urllib.parse import parse_qs
+
+import httpx
+import pytest
+from sqlmodel import Session, create_engine
+
+from opsmate.ingestions.models import MetricRecord, SQLModel as IngestionSQLModel
+from opsmate.tools import prom
+from opsmate.tools.prom import PromQL
+from opsmate.tools.prom_harvest import (
+    MetricsHarvester,
+    PrometheusAPIError,
+    TTLCache,
+    metric_fingerprint,
+)
+
+SERIES = [
+    {"__name__": "up", "job": "api", "instance": "10.0.0.1:9090"},
+    {"__name__": "up", "job": "db", "instance": "10.0.0.2:9090"},
+    {
+        "__name__": "http_requests_total",
+        "job": "api",
+        "code": "200",
+        "pod": "api-1",
+    },
+    {
+        "__name__": "http_requests_total",
+        "job": "api",
+        "code": "500",
+        "pod": "api-2",
+    },
+    {"__name__": "go_goroutines", "job": "api"},
+]
+
+METADATA = {
+    "up": [{"type": "gauge", "help": "Whether the target is up.", "unit": ""}],
+    "http_requests_total": [
+        {"type": "counter", "help": "Total HTTP requests.", "unit": ""}
+    ],
+}
+
+
+class PrometheusStandIn:
+    """
+    A local stand-in of the prometheus http api, counting the requests per path.
+    """
+
+    def __init__(self, series=SERIES, metadata=METADATA):
+        self.series = series
+        self.metadata = metadata
+        self.requests = Counter()
+        self.matches = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        self.requests[path] += 1
+        if path == "/api/v1/label/__name__/values":
+            assert "start" in request.url.params and "end" in request.url.params
+            names = sorted({s["__name__"] for s in self.series})
+            return self.ok(names)
+        if path == "/api/v1/metadata":
+            if self.metadata is None:
+                return httpx.Response(404, json={"status": "error"})
+            return self.ok(self.metadata)
+        if path == "/api/v1/series":
+            form = parse_qs(request.content.decode())
+            assert "start" in form and "end" in form
+            self.matches.append(form["match[]"])
+            names = {m.split('"')[1] for m in form["match[]"]}
+            return self.ok([s for s in self.series if s["__name__"] in names])
+        return httpx.Response(404, json={"status": "error"})
+
+    def ok(self, data):
+        return httpx.Response(200, json={"status": "success", "data": data})
+
+
+def harvester(prometheus, **kwargs):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(prometheus))
+    return MetricsHarvester("http://prometheus", client, **kwargs)
+
+
+async def test_harvest_in_bulk():
+    prometheus = PrometheusStandIn()
+    metrics = await harvester(prometheus, match_batch_size=2).harvest(
+        label_blacklist=["pod"]
+    )
+
+    assert metrics == [
+        {
+            "metric_name": "go_goroutines",
+            "labels": {"job": "api"},
+            "label_cardinality": {"job": 1},
+        },
+        {
+            "metric_name": "http_requests_total",
+            "type": "counter",
+            "help": "Total HTTP requests.",
+            "labels": {"code": "200|500", "job": "api", "pod": ""},
+            "label_cardinality": {"job": 1, "code": 2, "pod": 2},
+        },
+        {
+            "metric_name": "up",
+            "type": "gauge",
+            "help": "Whether the target is up.",
+            "labels": {"instance": "10.0.0.1:9090|10.0.0.2:9090", "job": "api|db"},
+            "label_cardinality": {"job": 2, "instance": 2},
+        },
+    ]
+    # 3 metrics in match[] batches of 2, rather than a request per metric and label
+    assert prometheus.requests == {
+        "/api/v1/label/__name__/values": 1,
+        "/api/v1/metadata": 1,
+        "/api/v1/series": 2,
+    }
+    assert sorted(len(m) for m in prometheus.matches) == [1, 2]
+
+
+async def test_harvest_is_cached_with_ttl():
+    prometheus = PrometheusStandIn()
+    h = harvester(prometheus)
+
+    first, second = await asyncio.gather(h.harvest(), h.harvest())
+    assert first == second
+    await h.harvest()
+    assert prometheus.requests["/api/v1/series"] == 1
+
+    await h.harvest(force_reload=True)
+    assert prometheus.requests["/api/v1/series"] == 2
+
+    h.cache.ttl = 0
+    await h.harvest(force_reload=True)
+    await h.harvest()
+    assert prometheus.requests["/api/v1/series"] == 4
+
+
+async def test_harvest_without_metadata_endpoint():
+    prometheus = PrometheusStandIn(metadata=None)
+    metrics = await harvester(prometheus).harvest(with_labels=False)
+    assert metrics == [
+        {"metric_name": "go_goroutines"},
+        {"metric_name": "http_requests_total"},
+        {"metric_name": "up"},
+    ]
+    assert "/api/v1/series" not in prometheus.requests
+
+
+async def test_failed_loads_are_not_cached():
+    cache = TTLCache(ttl=60)
+    calls = 0
+
+    async def load():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise PrometheusAPIError("boom")
+        return "ok"
+
+    with pytest.raises(PrometheusAPIError):
+        await cache.get_or_load("key", load)
+    assert await cache.get_or_load("key", load) == "ok"
+    assert await cache.get_or_load("key", load) == "ok"
+    assert calls == 2
+
+
+async def test_promql_load_metrics():
+    prometheus = PrometheusStandIn()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(prometheus))
+    prom = PromQL(endpoint="http://prometheus", client=client)
+
+    metrics = await prom.load_metrics()
+    assert [m["metric_name"] for m in metrics] == [
+        "go_goroutines",
+        "http_requests_total",
+        "up",
+    ]
+    # the default blacklist hides the instance values
+    assert metrics[2]["labels"]["instance"] == ""
+    await prom.load_metrics()
+    assert prometheus.requests["/api/v1/series"] == 1
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite:///:memory:")
+    IngestionSQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+@pytest.fixture
+def enqueued(monkeypatch):
+    tasks = []
+
+    def enqueue_task(session, fn, *args, **kwargs):
+        tasks.append((fn.__name__, *args))
+
+    monkeypatch.setattr(prom, "enqueue_task", enqueue_task)
+    return tasks
+
+
+def test_metric_fingerprint_ignores_cardinality():
+    metric = {
+        "metric_name": "up",
+        "type": "gauge",
+        "labels": {"job": "api|db"},
+        "label_cardinality": {"job": 2},
+    }
+    churned = {**metric, "label_cardinality": {"job": 3}}
+    relabelled = {**metric, "labels": {"job": "api"}}
+    assert metric_fingerprint(metric) == metric_fingerprint(churned)
+    assert metric_fingerprint(metric) != metric_fingerprint(relabelled)
+
+
+async def test_incremental_metrics_sync(session, enqueued):
+    prometheus = PrometheusStandIn(series=list(SERIES))
+    client = httpx.AsyncClient(transport=httpx.MockTransport(prometheus))
+    promql = PromQL(endpoint="http://prometheus", client=client)
+
+    async def sync(**kwargs):
+        enqueued.clear()
+        await promql.ingest_metrics(session, **kwargs)
+        for name, *args in enqueued:
+            if name == "ingest_metrics":
+                metrics, endpoint = args
+                await MetricRecord.save_fingerprints(
+                    session,
+                    endpoint,
+                    {m["metric_name"]: metric_fingerprint(m) for m in metrics},
+                )
+            else:
+                metric_names, endpoint = args
+                await MetricRecord.tombstone(session, endpoint, metric_names)
+        return [
+            (
+                (name, sorted(m["metric_name"] for m in args[0]))
+                if name == "ingest_metrics"
+                else (name, args[0])
+            )
+            for name, *args in enqueued
+        ]
+
+    assert await sync() == [
+        ("ingest_metrics", ["go_goroutines", "http_requests_total", "up"])
+    ]
+    # nothing changed
+    assert await sync() == []
+
+    prometheus.series = [s for s in SERIES if s["__name__"] != "go_goroutines"] + [
+        {"__name__": "up", "job": "cache", "instance": "10.0.0.3:9090"},
+        {"__name__": "process_open_fds", "job": "api"},
+    ]
+    assert await sync() == [
+        ("ingest_metrics", ["process_open_fds", "up"]),
+        ("tombstone_metrics", ["go_goroutines"]),
+    ]
+    records = await MetricRecord.find_by_endpoint(session, "http://prometheus")
+    assert records["go_goroutines"].deleted_at is not None
+
+    # the tombstoned metric comes back
+    prometheus.series.append({"__name__": "go_goroutines", "job": "api"})
+    assert await sync() == [("ingest_metrics", ["go_goroutines"])]
+    records = await MetricRecord.find_by_endpoint(session, "http://prometheus")
+    assert records["go_goroutines"].deleted_at is None
+
+    assert await sync(incremental=False) == [
+        (
+            "ingest_metrics",
+            ["go_goroutines", "http_requests_total", "process_open_fds", "up"],
+        )
+    ]
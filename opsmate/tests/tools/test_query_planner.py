@@ -0,0 +1,238 @@
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, patch
+from urllib.parse import parse_qs
+
+import pytest
+from httpx import Response
+
+from opsmate.tools.loki import LogParser, LokiQuery
+from opsmate.tools.prom import PromQuery
+from opsmate.tools.query_planner import (
+    NANOSECONDS,
+    gather_bounded,
+    merge_matrix,
+    paginate_streams,
+    range_shards,
+    to_nanoseconds,
+)
+
+START = datetime(2025, 4, 23, 0, 0, 0)
+
+
+def test_range_shards():
+    shards = range_shards(START, START + timedelta(days=7), 3600, timedelta(days=2))
+    assert shards == [
+        (START, START + timedelta(days=2)),
+        (START + timedelta(days=2), START + timedelta(days=4)),
+        (START + timedelta(days=4), START + timedelta(days=6)),
+        (START + timedelta(days=6), START + timedelta(days=7)),
+    ]
+    assert range_shards(START, START + timedelta(hours=1), 15, timedelta(days=1)) == [
+        (START, START + timedelta(hours=1))
+    ]
+
+
+def test_range_shards_are_aligned_to_the_step():
+    # 7 steps of 1000s fit in a shard of 2 hours
+    shards = range_shards(START, START + timedelta(hours=5), 1000, timedelta(hours=2))
+    assert [(end - start).total_seconds() for start, end in shards] == [
+        7000,
+        7000,
+        4000,
+    ]
+
+
+def test_merge_matrix():
+    shards = [
+        [{"metric": {"job": "api"}, "values": [[0, "1"], [15, "2"]]}],
+        [
+            {"metric": {"job": "api"}, "values": [[15, "2"], [30, "3"]]},
+            {"metric": {"job": "db"}, "values": [[30, "5"]]},
+        ],
+    ]
+    assert merge_matrix(shards) == [
+        {"metric": {"job": "api"}, "values": [[0, "1"], [15, "2"], [30, "3"]]},
+        {"metric": {"job": "db"}, "values": [[30, "5"]]},
+    ]
+
+
+async def test_gather_bounded():
+    running = 0
+    peak = 0
+
+    async def work(i):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return i
+
+    assert await gather_bounded([work(i) for i in range(10)], 3) == list(range(10))
+    assert peak == 3
+
+
+async def test_gather_bounded_cancels_the_others_on_failure():
+    running = set()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("shard failed")
+
+    async def work(i):
+        running.add(i)
+        try:
+            await asyncio.sleep(10)
+        finally:
+            running.discard(i)
+
+    with pytest.raises(ValueError, match="shard failed"):
+        await gather_bounded([fail(), work(1), work(2)], 2)
+    # no shard is left running once the error is raised
+    assert running == set()
+
+
+class LokiStandIn:
+    """
+    A stand-in of the loki query_range api over a list of (ns, line) entries.
+    """
+
+    def __init__(self, entries, stream={"app": "api"}):
+        self.entries = entries
+        self.stream = stream
+        self.pages = []
+
+    async def __call__(self, start, end, limit, direction="forward"):
+        self.pages.append((start, end, limit))
+        entries = [e for e in self.entries if start <= e[0] < end]
+        entries.sort(key=lambda e: e[0], reverse=direction == "backward")
+        values = [[str(ts), line] for ts, line in entries[:limit]]
+        return [{"stream": self.stream, "values": values}] if values else []
+
+
+@pytest.mark.parametrize("direction", ["forward", "backward"])
+async def test_paginate_streams(direction):
+    # two entries share the timestamp at a page boundary
+    entries = [(ts, f"line {ts}") for ts in range(10)] + [(4, "line 4 again")]
+    loki = LokiStandIn(entries)
+
+    streams = await paginate_streams(
+        lambda start, end, limit: loki(start, end, limit, direction),
+        start=0,
+        end=100,
+        limit=100,
+        page_size=4,
+        direction=direction,
+    )
+    lines = sorted(line for _, line in streams[0]["values"])
+    assert lines == sorted(line for _, line in entries)
+    assert len(loki.pages) > 1
+
+
+async def test_paginate_streams_stops_at_the_limit():
+    loki = LokiStandIn([(ts, f"line {ts}") for ts in range(100)])
+    streams = await paginate_streams(
+        lambda start, end, limit: loki(start, end, limit),
+        start=0,
+        end=1000,
+        limit=10,
+        page_size=4,
+    )
+    assert [int(ts) for ts, _ in streams[0]["values"]] == list(range(10))
+    # the entry at the cursor is fetched again on the next page
+    assert [limit for _, _, limit in loki.pages] == [4, 4, 4]
+
+
+def test_to_nanoseconds():
+    assert to_nanoseconds(datetime(1970, 1, 1, 0, 0, 1)) == NANOSECONDS
+
+
+def prometheus_response(request_data):
+    form = {key: value[0] for key, value in parse_qs(request_data).items()}
+    start = datetime.strptime(form["start"], "%Y-%m-%dT%H:%M:%SZ")
+    end = datetime.strptime(form["end"], "%Y-%m-%dT%H:%M:%SZ")
+    step = int(form["step"].removesuffix("s"))
+    base = to_nanoseconds(start) // NANOSECONDS
+    count = int((end - start).total_seconds()) // step + 1
+    values = [[base + i * step, "1"] for i in range(count)]
+    return Response(
+        200,
+        json={
+            "status": "success",
+            "data": {
+                "resultType": "matrix",
+                "result": [{"metric": {"job": "api"}, "values": values}],
+            },
+        },
+    )
+
+
+async def test_prom_query_is_sharded(monkeypatch):
+    from opsmate.config import config
+
+    monkeypatch.setattr(config, "query_shard_duration", 2 * 24 * 60 * 60)
+
+    async def post(url, data, headers):
+        encoded = "&".join(f"{key}={value}" for key, value in data.items())
+        return prometheus_response(encoded)
+
+    with patch("httpx.AsyncClient.post", new_callable=AsyncMock) as mock_post:
+        mock_post.side_effect = post
+        query = PromQuery(
+            query="up",
+            explanation="up",
+            start="2025-04-16T00:00:00Z",
+            end="2025-04-23T00:00:00Z",
+            data_points_per_series=100,
+        )
+        output = await query.run(context={})
+
+    assert mock_post.call_count == 4
+    values = output["data"]["result"][0]["values"]
+    timestamps = [ts for ts, _ in values]
+    assert timestamps == sorted(set(timestamps))
+    step = int(query.step.removesuffix("s"))
+    assert all(b - a == step for a, b in zip(timestamps, timestamps[1:]))
+
+
+async def test_loki_query_paginates(monkeypatch):
+    from opsmate.config import config
+
+    monkeypatch.setattr(config, "loki_page_size", 2)
+
+    def page(*timestamps):
+        return Response(
+            200,
+            json={
+                "data": {
+                    "result": [
+                        {
+                            "stream": {"app": "api", "ts": str(ts)},
+                            "values": [[str(ts), "line"]],
+                        }
+                        for ts in timestamps
+                    ]
+                }
+            },
+        )
+
+    start = to_nanoseconds(datetime(2025, 4, 23, 10))
+    with patch("httpx.AsyncClient.post", new_callable=AsyncMock) as mock_post:
+        mock_post.side_effect = [page(start, start + 1), page(start + 1, start + 2)]
+        query = LokiQuery(
+            query='{app="api"}',
+            start="2025-04-23T10:00:00Z",
+            end="2025-04-23T11:00:00Z",
+            limit=3,
+            log_parser=LogParser.JSON,
+        )
+        result = await query(context={})
+
+    assert [stream["ts"] for stream in result] == [
+        str(start),
+        str(start + 1),
+        str(start + 2),
+    ]
+    assert [call[1]["data"]["limit"] for call in mock_post.call_args_list] == [2, 2]
+    assert mock_post.call_args_list[1][1]["data"]["start"] == start + 1
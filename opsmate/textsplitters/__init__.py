@@ -15,6 +15,8 @@ SPLITTERS = {
 
 
 def splitter_from_config(config: Dict[str, Any]) -> TextSplitter:
+    # the config is the chunk config recorded on the documents, leave it untouched
+    config = dict(config)
     name = config.pop("splitter", RECURSIVE_SPLITTER)
     if name not in SPLITTERS:
         raise ValueError(
@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
 from typing import List
 from pydantic import BaseModel, Field
+from .tokens import length_function
 
 
 class Chunk(BaseModel):
@@ -28,6 +29,7 @@ class TextSplitter(ABC):
         # practically, we don't want any overlap
         chunk_overlap: int = 0,
         separators: List[str] = [],
+        tokenizer: str | None = None,
     ):
         """
         Initialize the text splitter
@@ -35,9 +37,12 @@ class TextSplitter(ABC):
             chunk_size: The size of the chunks to split the text into
             chunk_overlap: The overlap between the chunks
             separator: The separators to use to split the text
+            tokenizer: The tiktoken encoding to measure the chunk size and overlap in tokens, e.g. cl100k_base. Measured in characters if not set
         """
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.tokenizer = tokenizer
+        self.length = length_function(tokenizer)
         if separators:
             self.separators = separators
         else:
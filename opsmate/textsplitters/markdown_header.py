@@ -2,9 +2,22 @@
 # The original code can be found at https://github.com/langchain-ai/langchain/blob/master/libs/text-splitters/langchain_text_splitters/markdown.py
 # License: MIT License
 
-from typing import List, Tuple, Dict, TypedDict
+from typing import List, Tuple, Dict, TypedDict, Iterable, Iterator
 from opsmate.textsplitters.base import Chunk
 from .base import TextSplitter
+from .recursive import RecursiveTextSplitter
+
+
+def iter_lines(text: str) -> Iterator[str]:
+    """Iterate over the lines of the text, same as text.split("\n") without the list."""
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        if end == -1:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
 
 
 class LineType(TypedDict):
@@ -30,6 +43,9 @@ class MarkdownHeaderTextSplitter(TextSplitter):
         headers_to_split_on: List[Tuple[str, str]],
         return_each_line: bool = False,
         strip_headers: bool = True,
+        chunk_size: int | None = None,
+        chunk_overlap: int = 0,
+        tokenizer: str | None = None,
     ):
         """Create a new MarkdownHeaderTextSplitter.
 
@@ -37,7 +53,13 @@ class MarkdownHeaderTextSplitter(TextSplitter):
             headers_to_split_on: Headers we want to track
             return_each_line: Return each line w/ associated headers
             strip_headers: Strip split headers from the content of the chunk
+            chunk_size: Split the sections larger than this further, unbounded if not set
+            chunk_overlap: The overlap between the chunks of a section split further
+            tokenizer: The tiktoken encoding to measure the chunk size in tokens, e.g. cl100k_base
         """
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.tokenizer = tokenizer
         # Output line-by-line or aggregated into chunks w/ common headers
         self.return_each_line = return_each_line
         # Given the headers we want to split on,
@@ -48,28 +70,34 @@ class MarkdownHeaderTextSplitter(TextSplitter):
         # Strip headers split headers from the content of the chunk
         self.strip_headers = strip_headers
 
-    def aggregate_lines_to_chunks(self, lines: List[LineType]) -> List[Chunk]:
+    def aggregate_lines_to_chunks(self, lines: Iterable[LineType]) -> List[Chunk]:
         """Combine lines with common metadata into chunks
         Args:
             lines: Line of text / associated header metadata
         """
-        aggregated_chunks: List[LineType] = []
+        return list(self._aggregate_lines(lines))
+
+    def _aggregate_lines(self, lines: Iterable[LineType]) -> Iterator[Chunk]:
+        """Combine lines with common metadata into chunks, yielding each chunk
+        as soon as the next line with different metadata starts a new one.
+        Args:
+            lines: Line of text / associated header metadata
+        """
+        # content blocks and metadata of the chunk being aggregated
+        contents: List[str] = []
+        metadata: Dict[str, str] = {}
 
         for line in lines:
-            if (
-                aggregated_chunks
-                and aggregated_chunks[-1]["metadata"] == line["metadata"]
-            ):
+            if contents and metadata == line["metadata"]:
                 # If the last line in the aggregated list
                 # has the same metadata as the current line,
                 # append the current content to the last lines's content
-                aggregated_chunks[-1]["content"] += "  \n" + line["content"]
+                contents.append(line["content"])
             elif (
-                aggregated_chunks
-                and aggregated_chunks[-1]["metadata"] != line["metadata"]
+                contents
                 # may be issues if other metadata is present
-                and len(aggregated_chunks[-1]["metadata"]) < len(line["metadata"])
-                and aggregated_chunks[-1]["content"].split("\n")[-1][0] == "#"
+                and len(metadata) < len(line["metadata"])
+                and contents[-1][contents[-1].rfind("\n") + 1 :].startswith("#")
                 and not self.strip_headers
             ):
                 # If the last line in the aggregated list
@@ -78,34 +106,54 @@ class MarkdownHeaderTextSplitter(TextSplitter):
                 # and the last line is a header,
                 # and we are not stripping headers,
                 # append the current content to the last line's content
-                aggregated_chunks[-1]["content"] += "  \n" + line["content"]
+                contents.append(line["content"])
                 # and update the last line's metadata
-                aggregated_chunks[-1]["metadata"] = line["metadata"]
+                metadata = line["metadata"]
             else:
-                # Otherwise, append the current line to the aggregated list
-                aggregated_chunks.append(line)
+                # Otherwise, the chunk is complete and the current line starts a new one
+                if contents:
+                    yield Chunk(content="  \n".join(contents), metadata=metadata)
+                contents = [line["content"]]
+                metadata = line["metadata"]
 
-        return [
-            Chunk(content=chunk["content"], metadata=chunk["metadata"])
-            for chunk in aggregated_chunks
-        ]
+        if contents:
+            yield Chunk(content="  \n".join(contents), metadata=metadata)
 
     def split_text(self, text: str) -> List[Chunk]:
         """Split markdown file
         Args:
             text: Markdown file"""
+        return list(self.split_lines(iter_lines(text)))
+
+    def split_lines(self, lines: Iterable[str]) -> Iterator[Chunk]:
+        """Split markdown file streamed line by line, e.g. from an open file.
+        Only the current section is held in memory, and its chunks are yielded
+        as soon as the section closes.
+        Args:
+            lines: Lines of the markdown file, with or without the line endings"""
+        blocks = self._iter_blocks(lines)
+        # aggregate the blocks into chunks based on common metadata
+        if not self.return_each_line:
+            chunks = self._aggregate_lines(blocks)
+        else:
+            chunks = (
+                Chunk(content=block["content"], metadata=block["metadata"])
+                for block in blocks
+            )
+        yield from self.split_large_chunks(chunks)
 
-        # Split the input text by newline character ("\n").
-        lines = text.split("\n")
-        # Final output
-        lines_with_metadata: List[LineType] = []
-        # Content and metadata of the chunk currently being processed
+    def _iter_blocks(self, lines: Iterable[str]) -> Iterator[LineType]:
+        """Group the lines into blocks of consecutive content lines with the
+        header metadata they are under.
+        Args:
+            lines: Lines of the markdown file"""
+
+        # Content of the block currently being processed
         current_content: List[str] = []
-        current_metadata: Dict[str, str] = {}
         # Keep track of the nested header structure
-        # header_stack: List[Dict[str, Union[int, str]]] = []
         header_stack: List[HeaderType] = []
-        initial_metadata: Dict[str, str] = {}
+        # The metadata of the headers the current line is under
+        metadata: Dict[str, str] = {}
 
         in_code_block = False
         opening_fence = ""
@@ -114,7 +162,8 @@ class MarkdownHeaderTextSplitter(TextSplitter):
             stripped_line = line.strip()
             # Remove all non-printable characters from the string, keeping only visible
             # text.
-            stripped_line = "".join(filter(str.isprintable, stripped_line))
+            if not stripped_line.isprintable():
+                stripped_line = "".join(filter(str.isprintable, stripped_line))
             if not in_code_block:
                 # Exclude inline code spans
                 if stripped_line.startswith("```") and stripped_line.count("```") == 1:
@@ -141,6 +190,14 @@ class MarkdownHeaderTextSplitter(TextSplitter):
                     len(stripped_line) == len(sep)
                     or stripped_line[len(sep)] == " "
                 ):
+                    # The previous block is under the headers before this one
+                    if current_content:
+                        yield {
+                            "content": "\n".join(current_content),
+                            "metadata": metadata.copy(),
+                        }
+                        current_content.clear()
+
                     # Ensure we are tracking the header as metadata
                     if name is not None:
                         # Get the current header level
@@ -154,10 +211,8 @@ class MarkdownHeaderTextSplitter(TextSplitter):
                             # We have encountered a new header
                             # at the same or higher level
                             popped_header = header_stack.pop()
-                            # Clear the metadata for the
-                            # popped header in initial_metadata
-                            if popped_header["name"] in initial_metadata:
-                                initial_metadata.pop(popped_header["name"])
+                            # Clear the metadata for the popped header
+                            metadata.pop(popped_header["name"], None)
 
                         # Push the current header to the stack
                         header: HeaderType = {
@@ -166,19 +221,8 @@ class MarkdownHeaderTextSplitter(TextSplitter):
                             "data": stripped_line[len(sep) :].strip(),
                         }
                         header_stack.append(header)
-                        # Update initial_metadata with the current header
-                        initial_metadata[name] = header["data"]
-
-                    # Add the previous line to the lines_with_metadata
-                    # only if current_content is not empty
-                    if current_content:
-                        lines_with_metadata.append(
-                            {
-                                "content": "\n".join(current_content),
-                                "metadata": current_metadata.copy(),
-                            }
-                        )
-                        current_content.clear()
+                        # Update the metadata with the current header
+                        metadata[name] = header["data"]
 
                     if not self.strip_headers:
                         current_content.append(stripped_line)
@@ -188,27 +232,30 @@ class MarkdownHeaderTextSplitter(TextSplitter):
                 if stripped_line:
                     current_content.append(stripped_line)
                 elif current_content:
-                    lines_with_metadata.append(
-                        {
-                            "content": "\n".join(current_content),
-                            "metadata": current_metadata.copy(),
-                        }
-                    )
+                    yield {
+                        "content": "\n".join(current_content),
+                        "metadata": metadata.copy(),
+                    }
                     current_content.clear()
 
-            current_metadata = initial_metadata.copy()
-
         if current_content:
-            lines_with_metadata.append(
-                {"content": "\n".join(current_content), "metadata": current_metadata}
-            )
+            yield {"content": "\n".join(current_content), "metadata": metadata}
 
-        # lines_with_metadata has each line with associated header metadata
-        # aggregate these into chunks based on common metadata
-        if not self.return_each_line:
-            return self.aggregate_lines_to_chunks(lines_with_metadata)
-        else:
-            return [
-                Chunk(content=chunk["content"], metadata=chunk["metadata"])
-                for chunk in lines_with_metadata
-            ]
+    def split_large_chunks(self, chunks: Iterable[Chunk]) -> Iterator[Chunk]:
+        """Split the chunks larger than chunk_size, keeping their header metadata
+        Args:
+            chunks: Chunks of the markdown sections
+        """
+        if self.chunk_size is None:
+            yield from chunks
+            return
+
+        splitter = RecursiveTextSplitter(
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            tokenizer=self.tokenizer,
+        )
+        for chunk in chunks:
+            # a section that fits comes back as a single chunk, measured once
+            for sub_chunk in splitter.split_text(chunk.content):
+                yield Chunk(content=sub_chunk.content, metadata=chunk.metadata.copy())
@@ -0,0 +1,163 @@
+from typing import List, Dict, Any, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from opsmate.textsplitters import splitter_from_config, TextSplitter
+import asyncio
+import json
+import multiprocessing
+import weakref
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+# (content, metadata) of a chunk
+ChunkTuple = Tuple[str, Dict[str, Any]]
+
+
+@lru_cache(maxsize=16)
+def _splitter(config_json: str) -> TextSplitter:
+    return splitter_from_config(json.loads(config_json))
+
+
+def split_texts(config_json: str, texts: List[str]) -> List[List[ChunkTuple]]:
+    """
+    Split the texts with the splitter built from the json encoded config.
+
+    This is the unit of work of the process pool: the arguments and the results
+    are plain picklable values rather than splitters and pydantic models.
+    """
+    splitter = _splitter(config_json)
+    return [
+        [(chunk.content, chunk.metadata) for chunk in splitter.split_text(text)]
+        for text in texts
+    ]
+
+
+@dataclass
+class _PendingBatch:
+    texts: List[str] = field(default_factory=list)
+    waiters: List[asyncio.Future] = field(default_factory=list)
+    size: int = 0
+
+
+class ParallelSplitter:
+    """
+    ParallelSplitter offloads the splitting of large texts to a process pool,
+    so that it does not block the event loop.
+
+    The texts smaller than `inline_threshold` characters are split inline, as
+    the IPC round trip would cost more than the split itself. The large texts
+    submitted by concurrent tasks within `max_delay` seconds are sent to the
+    pool together, per splitter config, in batches of up to `batch_size`
+    characters to keep the IPC overhead low.
+    """
+
+    def __init__(
+        self,
+        executor: ProcessPoolExecutor | None,
+        inline_threshold: int = 64 * 1024,
+        batch_size: int = 4 * 1024 * 1024,
+        max_delay: float = 0.01,
+    ):
+        self.executor = executor
+        self.inline_threshold = inline_threshold
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+
+        self._pending: Dict[str, _PendingBatch] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def split(
+        self, splitter_config: Dict[str, Any], text: str
+    ) -> List[ChunkTuple]:
+        """
+        Split the text into (content, metadata) tuples.
+        """
+        config_json = json.dumps(splitter_config, sort_keys=True)
+        if self.executor is None or len(text) < self.inline_threshold:
+            return split_texts(config_json, [text])[0]
+
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        batch = self._pending.setdefault(config_json, _PendingBatch())
+        batch.texts.append(text)
+        batch.waiters.append(waiter)
+        batch.size += len(text)
+
+        if batch.size >= self.batch_size:
+            self._submit(config_json)
+        elif config_json not in self._timers:
+            self._timers[config_json] = loop.call_later(
+                self.max_delay, self._submit, config_json
+            )
+
+        return await waiter
+
+    def _submit(self, config_json: str):
+        timer = self._timers.pop(config_json, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(config_json, None)
+        if batch is None:
+            return
+
+        task = asyncio.create_task(self._run(config_json, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, config_json: str, batch: _PendingBatch):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.executor, split_texts, config_json, batch.texts
+            )
+        except Exception as e:
+            logger.error("failed to split texts", texts=len(batch.texts), error=str(e))
+            for waiter in batch.waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            return
+
+        logger.info("split texts", texts=len(batch.texts), chars=batch.size)
+        for waiter, result in zip(batch.waiters, results):
+            if not waiter.done():
+                waiter.set_result(result)
+
+
+_executor: ProcessPoolExecutor | None = None
+# splitters are bound to the event loop they were created in
+_splitters = weakref.WeakKeyDictionary()
+
+
+def parallel_splitter() -> ParallelSplitter:
+    """
+    Get the parallel splitter of the current event loop, sharing one process pool.
+    """
+    from opsmate.config import config
+
+    global _executor
+    loop = asyncio.get_running_loop()
+    if loop not in _splitters:
+        if _executor is None and config.chunk_processes > 0:
+            # spawn rather than fork, the parent process runs threads
+            _executor = ProcessPoolExecutor(
+                max_workers=config.chunk_processes,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        _splitters[loop] = ParallelSplitter(
+            _executor, inline_threshold=config.chunk_inline_threshold
+        )
+    return _splitters[loop]
+
+
+def shutdown_parallel_splitter():
+    """
+    Shut down the process pool of the parallel splitters.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+    _splitters.clear()
@@ -1,86 +1,126 @@
-from typing import List
+from typing import List, Tuple
 from .base import TextSplitter, Chunk
 
+# (start, end, separator index, length) of a fragment of the original text
+Span = Tuple[int, int, int, int]
+
+# fragments longer than chunk_size * MAX_CHARS_PER_TOKEN characters cannot fit
+# in chunk_size tokens, and are split further without being tokenized
+MAX_CHARS_PER_TOKEN = 16
+
 
 class RecursiveTextSplitter(TextSplitter):
-    def split_text(self, text: str) -> List[str]:
+    def split_text(self, text: str) -> List[Chunk]:
         """
         Split the text into chunks of size chunk_size with overlap chunk_overlap
         """
-        splits = self._split_text(text, 0)
-        splits = self._merge_splits(splits)
-        return self._handle_overlap(splits)
+        spans: List[Span] = []
+        self._split_spans(text, 0, len(text), 0, spans)
+        merged = self._merge_spans(spans)
+        return self._handle_overlap(text, spans, merged)
 
-    def _split_text(self, text: str, separatorLevel: int) -> List[Chunk]:
-        if separatorLevel == len(self.separators):
-            return [
-                Chunk(
-                    content=text,
-                    metadata={"seperator": self.separators[-1]},
-                )
-            ]
+    def _split_spans(
+        self, text: str, start: int, end: int, level: int, spans: List[Span]
+    ):
+        """
+        Recursively split text[start:end] on the separators, appending the
+        fragments to `spans` as offsets into the original text.
+        """
+        if level == len(self.separators):
+            length = self._measure(text, start, end, bounded=False)
+            spans.append((start, end, len(self.separators) - 1, length))
+            return
 
-        if len(text) <= self.chunk_size:
-            return [
-                Chunk(
-                    content=text,
-                    metadata={"seperator": self.separators[separatorLevel - 1]},
-                )
-            ]
+        length = self._measure(text, start, end)
+        if length is not None and length <= self.chunk_size:
+            spans.append((start, end, (level - 1) % len(self.separators), length))
+            return
 
-        separator = self.separators[separatorLevel]
-        splits = text.split(separator)
-        splits = [split for split in splits if split]
+        separator = self.separators[level]
+        if not separator:
+            # same as str.split, an empty separator cannot split the text
+            raise ValueError("empty separator")
 
-        result = []
-        for split in splits:
-            result.extend(self._split_text(split, separatorLevel + 1))
+        pos = start
+        while pos <= end:
+            hit = text.find(separator, pos, end)
+            if hit == -1:
+                hit = end
+            # empty fragments are dropped
+            if hit > pos:
+                self._split_spans(text, pos, hit, level + 1, spans)
+            pos = hit + len(separator)
 
-        return result
+    def _measure(
+        self, text: str, start: int, end: int, bounded: bool = True
+    ) -> int | None:
+        """
+        Measure text[start:end] in characters or tokens. Each fragment is
+        tokenized once when it fits, and the merged chunks are measured by
+        adding up the lengths of their fragments rather than re-tokenizing.
+        Returns None if the bounded fragment is too long to be worth tokenizing.
+        """
+        if self.tokenizer is None:
+            return end - start
+        if bounded and end - start > self.chunk_size * MAX_CHARS_PER_TOKEN:
+            return None
+        return self.length(text[start:end])
 
-    def _merge_splits(self, splits: List[Chunk]) -> List[Chunk]:
-        result = []
+    def _merge_spans(self, spans: List[Span]) -> List[Tuple[int, int, int]]:
+        """
+        Greedily merge the consecutive fragments that fit in chunk_size.
+        Returns the (first, last, length) of the merged chunks, where
+        spans[first:last] are joined by the separators of the fragments.
+        """
+        separator_lens = [self.length(separator) for separator in self.separators]
+        merged = []
         idx = 0
-        while idx < len(splits):
-            sep1, add = splits[idx].metadata["seperator"], splits[idx].content
+        while idx < len(spans):
+            first = idx
+            length = spans[idx][3]
             idx += 1
-            while idx < len(splits):
-                sep2, chunk = splits[idx].metadata["seperator"], splits[idx].content
-                if len(add) + len(sep2) + len(chunk) <= self.chunk_size:
-                    add += sep2 + chunk
+            while idx < len(spans):
+                _, _, sep, span_length = spans[idx]
+                extra = separator_lens[sep] + span_length
+                if length + extra <= self.chunk_size:
+                    length += extra
                     idx += 1
                 else:
                     break
-            result.append(
-                Chunk(
-                    content=add,
-                    metadata={"seperator": sep1},
-                )
-            )
-        return result
+            merged.append((first, idx, length))
+        return merged
 
-    def _handle_overlap(self, splits: List[Chunk]) -> List[Chunk]:
+    def _handle_overlap(
+        self, text: str, spans: List[Span], merged: List[Tuple[int, int, int]]
+    ) -> List[Chunk]:
+        """
+        Extend each merged chunk with the following ones that fit in the
+        overlap, and materialise the chunks.
+        """
+        separator_lens = [self.length(separator) for separator in self.separators]
         result = []
-        for idx, split in enumerate(splits):
-            sep1, add = split.metadata["seperator"], split.content
-            overlap_remain = self.chunk_overlap + self.chunk_size - len(add)
-
-            while overlap_remain > 0:
-                for idx2 in range(idx + 1, len(splits)):
-                    sep2, chunk = (
-                        splits[idx2].metadata["seperator"],
-                        splits[idx2].content,
-                    )
-                    if len(sep2) + len(chunk) <= overlap_remain:
-                        add += sep2 + chunk
-                        overlap_remain -= len(chunk) - len(sep2)
+        for idx, (first, last, length) in enumerate(merged):
+            overlap_remain = self.chunk_overlap + self.chunk_size - length
+            if overlap_remain > 0:
+                for idx2 in range(idx + 1, len(merged)):
+                    first2, last2, length2 = merged[idx2]
+                    sep2 = separator_lens[spans[first2][2]]
+                    if sep2 + length2 <= overlap_remain:
+                        last = last2
+                        # keeps the historical accounting of the separator
+                        overlap_remain -= length2 - sep2
                     else:
                         break
-                break
+
+            start, end, sep, _ = spans[first]
+            parts = [text[start:end]]
+            for span_start, span_end, span_sep, _ in spans[first + 1 : last]:
+                parts.append(self.separators[span_sep])
+                parts.append(text[span_start:span_end])
             result.append(
                 Chunk(
-                    content=add,
-                    metadata={"seperator": sep1},
+                    content="".join(parts),
+                    metadata={"seperator": self.separators[sep]},
                 )
             )
 
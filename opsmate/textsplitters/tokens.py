@@ -0,0 +1,51 @@
+from functools import cache
+from typing import Callable
+import re
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+LengthFunction = Callable[[str], int]
+
+# the gpt pre-tokenization pattern, each match is roughly one token
+_PRETOKENIZE = re.compile(
+    r"'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+(?!\S)|\s+"
+)
+
+
+def approximate_token_count(text: str) -> int:
+    """
+    Approximate the token count of the text by the number of pre-tokenized
+    words, used when tiktoken is not installed.
+    """
+    return sum(1 for _ in _PRETOKENIZE.finditer(text))
+
+
+@cache
+def token_counter(encoding: str = "cl100k_base") -> LengthFunction:
+    """
+    Get the function counting the tokens of a text with the tiktoken encoding.
+    Falls back to an approximate count if tiktoken is not installed.
+    """
+    try:
+        import tiktoken
+
+        enc = tiktoken.get_encoding(encoding)
+    except ImportError:
+        logger.info("tiktoken not installed, approximating token counts")
+        return approximate_token_count
+
+    def count(text: str) -> int:
+        return len(enc.encode_ordinary(text))
+
+    return count
+
+
+def length_function(tokenizer: str | None = None) -> LengthFunction:
+    """
+    Get the function measuring the chunk sizes, in characters unless a
+    tokenizer encoding is given.
+    """
+    if tokenizer is None:
+        return len
+    return token_counter(tokenizer)
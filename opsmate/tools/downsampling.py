@@ -0,0 +1,228 @@
+from typing import Any, Callable, Dict, List
+from opsmate.tools.prom_frame import MatrixColumns, from_samples
+import numpy as np
+
+Strategy = Callable[[np.ndarray, np.ndarray, int], np.ndarray]
+
+
+def _bucket_edges(size: int, buckets: int) -> np.ndarray:
+    """
+    The edges of `buckets` buckets over the samples between the first and the
+    last sample.
+    """
+    return np.linspace(1, size - 1, buckets + 1).astype(np.int64)
+
+
+def stride(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    """
+    Keep every k-th sample.
+    """
+    if len(x) <= n:
+        return np.arange(len(x))
+    return np.arange(0, len(x), max(1, len(x) // n))
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: keep the first and last samples, and the
+    sample of every bucket forming the largest triangle with the previously
+    kept sample and the average of the next bucket.
+    """
+    size = len(x)
+    if size <= n or n < 3:
+        return stride(x, y, n)
+
+    y = np.nan_to_num(y, nan=0.0, posinf=0.0, neginf=0.0)
+    edges = _bucket_edges(size, n - 2)
+    starts, counts = edges[:-1], np.diff(edges)
+    # the average of every bucket, the point of the last one is the last sample
+    avg_x = np.append((np.add.reduceat(x[: edges[-1]], starts) / counts)[1:], x[-1])
+    avg_y = np.append((np.add.reduceat(y[: edges[-1]], starts) / counts)[1:], y[-1])
+
+    indices = np.empty(n, dtype=np.int64)
+    indices[0], indices[-1] = 0, size - 1
+    # the selection depends on the sample kept in the previous bucket
+    a = 0
+    for i in range(n - 2):
+        start, end = edges[i], edges[i + 1]
+        area = np.abs(
+            (x[a] - avg_x[i]) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y[i] - y[a])
+        )
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def _first_at(mask: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """
+    The index of the first sample of every bucket where `mask` is set.
+    """
+    return np.minimum.reduceat(np.where(mask, np.arange(len(mask)), len(mask)), starts)
+
+
+def min_max(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    """
+    Keep the first and last samples, and the minimum and maximum samples of
+    every bucket.
+    """
+    size = len(x)
+    if size <= n or n < 4:
+        return stride(x, y, n)
+
+    edges = _bucket_edges(size, (n - 2) // 2)
+    # the buckets are laid out over the samples between the first and the last
+    starts, counts = edges[:-1] - edges[0], np.diff(edges)
+    bucketed = y[edges[0] : edges[-1]]
+    # NaN samples are never picked as the minimum or maximum
+    low = np.where(np.isnan(bucketed), np.inf, bucketed)
+    high = np.where(np.isnan(bucketed), -np.inf, bucketed)
+    mins = _first_at(low == np.repeat(np.minimum.reduceat(low, starts), counts), starts)
+    maxs = _first_at(
+        high == np.repeat(np.maximum.reduceat(high, starts), counts), starts
+    )
+    return np.unique(np.concatenate(([0, size - 1], edges[0] + mins, edges[0] + maxs)))
+
+
+def change_points(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    """
+    Keep the first and last samples, and both sides of the largest jumps
+    between consecutive samples.
+    """
+    size = len(x)
+    if size <= n or n < 4:
+        return stride(x, y, n)
+
+    jumps = np.nan_to_num(np.abs(np.diff(y)), nan=0.0, posinf=np.finfo(float).max)
+    # the jump `i` is between the samples `i` and `i + 1`
+    largest = np.argsort(-jumps, kind="stable")[: (n - 2) // 2]
+    return np.unique(np.concatenate(([0, size - 1], largest, largest + 1)))
+
+
+STRATEGIES: Dict[str, Strategy] = {
+    "lttb": lttb,
+    "minmax": min_max,
+    "change_points": change_points,
+    "stride": stride,
+}
+
+
+def downsample(columns: MatrixColumns, n: int, strategy: str = "lttb"):
+    """
+    Downsample every series of the columns to about `n` samples.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(
+            f"unknown downsampling strategy {strategy}, "
+            f"expected one of {', '.join(STRATEGIES)}"
+        )
+    pick = STRATEGIES[strategy]
+    samples = []
+    for i in range(len(columns)):
+        x, y = columns.samples(i)
+        indices = pick(x, y, n)
+        samples.append((x[indices], y[indices]))
+    return from_samples(columns.metrics, samples)
+
+
+STAT_KEYS = ("min", "max", "mean", "std", "last")
+
+
+def series_stats(columns: MatrixColumns) -> Dict[str, np.ndarray]:
+    """
+    The min, max, mean, standard deviation and last value of every series,
+    computed over all the series at once. The NaN samples are ignored.
+    """
+    counts = np.diff(columns.offsets)
+    if len(columns) == 0 or not counts.all():
+        # reduceat does not support empty series
+        return _series_stats_by_series(columns)
+
+    starts = columns.offsets[:-1]
+    values = columns.values
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.0)
+    n = np.add.reduceat(valid.astype(np.int64), starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.add.reduceat(filled, starts) / n
+        deviation = np.where(valid, values - np.repeat(mean, counts), 0.0)
+        std = np.sqrt(np.add.reduceat(deviation**2, starts) / n)
+    return {
+        "min": np.fmin.reduceat(values, starts),
+        "max": np.fmax.reduceat(values, starts),
+        "mean": mean,
+        "std": std,
+        "last": values[columns.offsets[1:] - 1],
+    }
+
+
+def _series_stats_by_series(columns: MatrixColumns) -> Dict[str, np.ndarray]:
+    stats = {key: np.full(len(columns), np.nan) for key in STAT_KEYS}
+    for i in range(len(columns)):
+        _, y = columns.samples(i)
+        if len(y) == 0 or np.isnan(y).all():
+            continue
+        stats["min"][i] = np.nanmin(y)
+        stats["max"][i] = np.nanmax(y)
+        stats["mean"][i] = np.nanmean(y)
+        stats["std"][i] = np.nanstd(y)
+        stats["last"][i] = y[-1]
+    return stats
+
+
+def top_k_series(columns: MatrixColumns, k: int, by: str = "std") -> List[int]:
+    """
+    The indices of the `k` series with the largest statistic `by`, in their
+    original order. The most varying series are kept by default.
+    """
+    if len(columns) <= k:
+        return list(range(len(columns)))
+    score = np.nan_to_num(series_stats(columns)[by], nan=-np.inf)
+    return sorted(np.argsort(-score, kind="stable")[:k].tolist())
+
+
+def series_summaries(columns: MatrixColumns) -> List[Dict[str, Any]]:
+    """
+    The summary statistics of every series, in place of its samples.
+    """
+    stats = series_stats(columns)
+    return [
+        {
+            "metric": metric,
+            **{key: format_value(stats[key][i]) for key in STAT_KEYS},
+        }
+        for i, metric in enumerate(columns.metrics)
+    ]
+
+
+def format_value(value: float) -> str:
+    """
+    Format a sample value the way prometheus does, with fewer digits.
+    """
+    if np.isnan(value):
+        return "NaN"
+    if np.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return f"{value:.6g}"
+
+
+def format_timestamp(timestamp: float) -> int | float:
+    return int(timestamp) if float(timestamp).is_integer() else float(timestamp)
+
+
+def matrix_result(columns: MatrixColumns) -> List[Dict[str, Any]]:
+    """
+    Encode the columns back into a prometheus `matrix` result.
+    """
+    result = []
+    for i, metric in enumerate(columns.metrics):
+        x, y = columns.samples(i)
+        result.append(
+            {
+                "metric": metric,
+                "values": [
+                    [format_timestamp(t), format_value(v)] for t, v in zip(x, y)
+                ],
+            }
+        )
+    return result
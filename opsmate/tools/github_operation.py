@@ -5,7 +5,7 @@ import os
 import asyncio
 import structlog
 from pydantic import BaseModel
-import httpx
+from opsmate.tools.http_clients import http_client
 
 logger = structlog.get_logger(__name__)
 
@@ -118,7 +118,7 @@ class GithubRaisePR(ToolCall[Result], PresentationMixin):
             head=self.branch,
         )
         url = f"{self._github_api_url}/repos/{self.repo}/pulls"
-        response = await httpx.AsyncClient().post(
+        response = await http_client(self._github_api_url).post(
             url,
             headers=self.headers,
             json={
@@ -0,0 +1,89 @@
+from opsmate.config import config
+from collections import OrderedDict
+from functools import cache
+import asyncio
+import importlib.util
+import httpx
+import weakref
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+# clients are bound to the event loop they were created in
+_clients = weakref.WeakKeyDictionary()
+# the evicted clients still referenced by their callers, closed on shutdown
+_evicted = weakref.WeakKeyDictionary()
+
+
+def endpoint_key(endpoint: str) -> str:
+    """
+    The scheme, host and port of the endpoint, so that the paths of the same
+    server share a client.
+    """
+    url = httpx.URL(endpoint)
+    if not url.host:
+        return ""
+    port = f":{url.port}" if url.port else ""
+    return f"{url.scheme}://{url.host}{port}"
+
+
+@cache
+def http2_available() -> bool:
+    """
+    Whether the `h2` package of the `httpx[http2]` extra is installed.
+    """
+    if importlib.util.find_spec("h2") is None:
+        logger.warning("h2 is not installed, the http clients fall back to HTTP/1.1")
+        return False
+    return True
+
+
+def new_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=config.http2 and http2_available(),
+        limits=httpx.Limits(
+            max_connections=config.http_max_connections,
+            max_keepalive_connections=config.http_max_keepalive_connections,
+            keepalive_expiry=config.http_keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(config.http_timeout, connect=config.http_connect_timeout),
+    )
+
+
+def http_client(endpoint: str = "") -> httpx.AsyncClient:
+    """
+    Get the pooled keep-alive client of the endpoint for the current event loop.
+
+    The tools talking to the same server share the client and its connections
+    rather than paying the TCP and TLS setup on every call. HTTP/2 is used when
+    the `h2` package is installed. At most `http_max_clients` clients are kept,
+    the least recently used one is evicted beyond that. An evicted client is
+    not closed under its callers, it is released once they are done with it
+    or closed on shutdown.
+    """
+    loop = asyncio.get_running_loop()
+    clients = _clients.setdefault(loop, OrderedDict())
+    key = endpoint_key(endpoint)
+    client = clients.get(key)
+    if client is None or client.is_closed:
+        logger.debug("creating http client", endpoint=key)
+        client = clients[key] = new_http_client()
+    clients.move_to_end(key)
+
+    # the least recently used clients are evicted rather than piling up
+    while len(clients) > max(1, config.http_max_clients):
+        evicted, stale = clients.popitem(last=False)
+        logger.debug("evicting http client", endpoint=evicted)
+        _evicted.setdefault(loop, weakref.WeakSet()).add(stale)
+    return client
+
+
+async def close_http_clients():
+    """
+    Close all the http clients of the current event loop.
+    """
+    loop = asyncio.get_running_loop()
+    clients = list(_clients.pop(loop, {}).values())
+    clients.extend(_evicted.pop(loop, ()))
+    for client in clients:
+        await client.aclose()
@@ -6,11 +6,21 @@ from opsmate.dino.types import ToolCall, Message, PresentationMixin, register_to
 from opsmate.dino.dino import dino
 from pydantic import BaseModel
 from typing import Union
+import asyncio
 import structlog
 from jinja2 import Template
 import time
 from functools import wraps
-from opsmate.knowledgestore.models import get_embedding_client, get_reranker
+from opsmate.knowledgestore.models import (
+    get_embedding_client,
+    get_reranker,
+    knowledge_filter,
+)
+from opsmate.knowledgestore.cache import retrieval_cache, cache_key
+from opsmate.knowledgestore.search import hybrid_search, DEFAULT_COLUMNS
+from opsmate.knowledgestore.router import shard_tables, shards_version, route_tables
+from opsmate.config import config
+from datetime import datetime
 
 logger = structlog.get_logger(__name__)
 
@@ -65,6 +75,8 @@ class KnowledgeRetrieval(
         top_n = context.get("top_n", 10)
         llm_summary = context.get("llm_summary", True)
         with_reranking = context.get("with_reranking", True)
+        use_cache = context.get("use_cache", True)
+        filter = self.filter(context)
 
         logger.info(
             "running knowledge retrieval tool",
@@ -72,26 +84,56 @@ class KnowledgeRetrieval(
             categories=categories,
             top_n=top_n,
             llm_summary=llm_summary,
+            filter=filter,
         )
-        conn = await self.aconn()
-        table = await conn.open_table("knowledge_store")
-        query = table.query()
-
-        query = (
-            query.nearest_to(await self.embed(self.query))
-            .nearest_to_text(self.query)
-            .select(["content", "data_source", "path", "metadata"])
-        )
-        reranker = get_reranker()
-        if reranker and with_reranking:
-            query = query.rerank(reranker=reranker)
-        results = await query.limit(top_n).to_list()
+        tables = await shard_tables()
+        reranker = get_reranker() if with_reranking else None
 
-        logger.info("reranked results", length=len(results))
+        cache, key, version = None, None, None
+        if use_cache:
+            cache = retrieval_cache()
+            key = cache_key(
+                self.query,
+                filter=filter,
+                top_n=top_n,
+                reranker=config.reranker_name if reranker else None,
+            )
+            version = await shards_version(tables)
+
+        results = cache.get(key, "hits", version) if cache else None
+        if results is None:
+            # the query only fans out to the shards of the filtered providers
+            results = await self.search(
+                route_tables(tables, context.get("data_source_providers", [])),
+                filter,
+                reranker,
+                top_n,
+            )
+            if cache:
+                cache.set(key, "hits", version, results)
+        else:
+            logger.info("retrieval cache hit", kind="hits", version=version)
 
-        results = results[:top_n]
         if llm_summary:
-            return await self.summary(self.query, results)
+            summary = cache.get(key, "summary", version) if cache else None
+            if summary is not None:
+                logger.info("retrieval cache hit", kind="summary", version=version)
+                if summary["found"]:
+                    return RetrievalResult(**summary["result"])
+                return KnowledgeNotFound()
+
+            result = await self.summary(self.query, results)
+            if cache:
+                cache.set(
+                    key,
+                    "summary",
+                    version,
+                    {
+                        "found": isinstance(result, RetrievalResult),
+                        "result": result.model_dump(),
+                    },
+                )
+            return result
         else:
             result = RetrievalResult(
                 summary="\n".join([result["content"] for result in results]),
@@ -99,6 +141,57 @@ class KnowledgeRetrieval(
             )
             return result
 
+    async def search(self, tables, filter: str | None, reranker, top_n: int):
+        if not tables:
+            return []
+
+        columns = DEFAULT_COLUMNS
+        # near-duplicates are collapsed on their canonical chunk, the column is
+        # missing from the tables no init_table has migrated yet
+        schemas = await asyncio.gather(*[table.schema() for table in tables])
+        if all("canonical_uuid" in schema.names for schema in schemas):
+            columns = [*DEFAULT_COLUMNS, "canonical_uuid"]
+
+        results = await hybrid_search(
+            tables,
+            self.query,
+            embed=self.embed,
+            filter=filter,
+            top_n=top_n,
+            reranker=reranker,
+            columns=columns,
+            rerank_timeout=config.reranker_timeout,
+            refine_factor=(
+                config.embedding_refine_factor
+                if config.embedding_index != "flat"
+                else None
+            ),
+        )
+
+        logger.info("reranked results", length=len(results))
+
+        return results
+
+    @staticmethod
+    def filter(context: dict[str, Any] = {}):
+        """
+        Build the knowledge store pre-filter from the `categories`, `data_sources`,
+        `data_source_providers`, `created_after` and `created_before` context values.
+        """
+
+        def maybe_datetime(value):
+            if isinstance(value, str):
+                return datetime.fromisoformat(value)
+            return value
+
+        return knowledge_filter(
+            categories=context.get("categories", []),
+            data_sources=context.get("data_sources", []),
+            data_source_providers=context.get("data_source_providers", []),
+            created_after=maybe_datetime(context.get("created_after")),
+            created_before=maybe_datetime(context.get("created_before")),
+        )
+
     async def embed(self, query: str):
         return await get_embedding_client().embed(query)
 
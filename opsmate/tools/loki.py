@@ -1,7 +1,9 @@
 from opsmate.dino.types import ToolCall, PresentationMixin
 from pydantic import Field, PrivateAttr
 from typing import Literal, Any, Tuple, Dict, Union, List
-from httpx import AsyncClient
+from opsmate.config import config
+from opsmate.tools.http_clients import http_client
+from opsmate.tools.query_planner import QueryError, paginate_streams, to_nanoseconds
 import os
 import base64
 from opsmate.dino import dino
@@ -105,30 +107,39 @@ class LokiQuery(ToolCall[ResultType], DatetimeRange, PresentationMixin):
             if self.log_parser != LogParser.UNKNOWN:
                 self.query = f"{self.query} | {self.log_parser.value}"
 
-        response = await AsyncClient().post(
-            endpoint + path,
-            data={
-                "query": self.query,
-                "start": self.start,
-                "end": self.end,
-                "limit": self.limit,
-                "direction": self.direction,
-            },
-            headers=self.headers(context),
-        )
-
-        if response.status_code != 200:
-            logger.error(
-                "Failed to fetch logs from loki", response_json=response.json()
+        async def fetch_page(start: int, end: int, limit: int):
+            response = await http_client(endpoint).post(
+                endpoint + path,
+                data={
+                    "query": self.query,
+                    "start": start,
+                    "end": end,
+                    "limit": limit,
+                    "direction": self.direction,
+                },
+                headers=self.headers(context),
+                timeout=self.timeout,
             )
-            return [
-                {
-                    "error": "Failed to fetch logs from loki",
-                    "data": response.text,
-                }
-            ]
+            if response.status_code != 200:
+                logger.error(
+                    "Failed to fetch logs from loki",
+                    status_code=response.status_code,
+                    response=response.text[:500],
+                )
+                raise QueryError("Failed to fetch logs from loki", response.text)
+            return response.json()["data"]["result"]
 
-        result = response.json()["data"]["result"]
+        try:
+            result = await paginate_streams(
+                fetch_page,
+                start=to_nanoseconds(self.start_dt),
+                end=to_nanoseconds(self.end_dt),
+                limit=self.limit,
+                page_size=config.loki_page_size,
+                direction=self.direction,
+            )
+        except QueryError as e:
+            return [{"error": str(e), "data": e.data}]
 
         result = [item["stream"] for item in result]
 
@@ -138,7 +149,7 @@ class LokiQuery(ToolCall[ResultType], DatetimeRange, PresentationMixin):
         endpoint = context.get("LOKI_ENDPOINT", DEFAULT_ENDPOINT)
         path = context.get("LOKI_PATH", DEFAULT_PATH)
 
-        response = await AsyncClient().post(
+        response = await http_client(endpoint).post(
             endpoint + path,
             data={
                 "query": self.query,
@@ -148,6 +159,7 @@ class LokiQuery(ToolCall[ResultType], DatetimeRange, PresentationMixin):
                 "direction": self.direction,
             },
             headers=self.headers(context),
+            timeout=self.timeout,
         )
 
         if response.status_code != 200:
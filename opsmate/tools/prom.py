@@ -6,24 +6,45 @@ from opsmate.dino import dino
 from opsmate.dino.types import Message, register_tool
 from opsmate.tools.datetime import DatetimeRange, datetime_extraction
 from opsmate.tools.knowledge_retrieval import KnowledgeRetrieval
+from opsmate.tools.prom_harvest import MetricsHarvester, metric_fingerprint
+from opsmate.tools.http_clients import http_client
+from opsmate.tools.downsampling import (
+    downsample,
+    matrix_result,
+    series_summaries,
+    top_k_series,
+)
+from opsmate.tools.query_planner import (
+    QueryError,
+    gather_bounded,
+    merge_matrix,
+    range_shards,
+)
+from opsmate.tools.prom_frame import (
+    MatrixColumns,
+    arrow_table,
+    decode_matrix,
+    wide_frame,
+)
 import pandas as pd
+import pyarrow as pa
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import plotext
 from datetime import datetime
 import base64
-from functools import lru_cache
-from asyncio import Semaphore, create_task, gather
 import structlog
-from uuid import uuid4
 from opsmate.dbq.dbq import dbq_task, enqueue_task
 import json
 from datetime import UTC, timedelta
 import random
 from sqlmodel import Session
-from opsmate.knowledgestore.models import Category, aconn
+from opsmate.config import config
+from opsmate.knowledgestore.models import Category, scope_filter, sql_literal
+from opsmate.knowledgestore.router import shard_table, shard_tables
+from opsmate.ingestions.models import MetricRecord
+from opsmate.knowledgestore.writer import knowledge_batch, write_batches
 from copy import deepcopy
-import time
 import os
 import io
 from tenacity import retry, stop_after_attempt, wait_fixed
@@ -45,31 +66,56 @@ def backoff_func(retry_count: int):
     max_retries=10,
     back_off_func=backoff_func,
 )
-async def ingest_metrics(metrics: List[Dict[str, Any]], prom_endpoint: str):
-    kbs = []
-    for metric in metrics:
-        kbs.append(
-            {
-                "uuid": str(uuid4()),
-                "id": 1,  # doesn't matter
-                # "summary": chunk.metadata["summary"],
-                "categories": [
-                    Category.OBSERVABILITY.value,
-                    Category.PROMETHEUS.value,
-                ],
-                "data_source_provider": "prometheus",
-                "data_source": prom_endpoint,
-                "metadata": json.dumps({"metric": metric["metric_name"]}),
-                "path": metric["metric_name"],
-                "content": json.dumps(metric),
-                "created_at": datetime.now(),
-            }
+async def ingest_metrics(
+    metrics: List[Dict[str, Any]], prom_endpoint: str, ctx: Dict[str, Any] = {}
+):
+    kbs = knowledge_batch(
+        [json.dumps(metric) for metric in metrics],
+        metadata=[json.dumps({"metric": metric["metric_name"]}) for metric in metrics],
+        categories=[[Category.OBSERVABILITY.value, Category.PROMETHEUS.value]]
+        * len(metrics),
+        data_source_provider="prometheus",
+        data_source=prom_endpoint,
+        path=[metric["metric_name"] for metric in metrics],
+    )
+    await write_batches(
+        await shard_table("prometheus"),
+        [kbs],
+        merge_on=["path", "data_source", "data_source_provider"],
+    )
+
+    session = ctx.get("session")
+    if session is not None:
+        await MetricRecord.save_fingerprints(
+            session,
+            prom_endpoint,
+            {metric["metric_name"]: metric_fingerprint(metric) for metric in metrics},
         )
-    conn = await aconn()
-    table = await conn.open_table("knowledge_store")
-    await table.merge_insert(
-        on=["path", "data_source", "data_source_provider"]
-    ).when_matched_update_all().when_not_matched_insert_all().execute(kbs)
+
+
+@dbq_task(
+    retry_on=(Exception,),
+    max_retries=10,
+    back_off_func=backoff_func,
+)
+async def tombstone_metrics(
+    metric_names: List[str], prom_endpoint: str, ctx: Dict[str, Any] = {}
+):
+    """
+    Delete the knowledge of the metrics gone from the prometheus server, and
+    tombstone their fingerprints.
+    """
+    paths = ", ".join(sql_literal(name) for name in metric_names)
+    where = (
+        scope_filter(data_source_provider="prometheus", data_source=prom_endpoint)
+        + f" AND path IN ({paths})"
+    )
+    for table in await shard_tables(["prometheus"]):
+        await table.delete(where)
+
+    session = ctx.get("session")
+    if session is not None:
+        await MetricRecord.tombstone(session, prom_endpoint, metric_names)
 
 
 class PromQL:
@@ -93,12 +139,17 @@ class PromQL:
         endpoint: str,
         user_id: str | None = None,
         api_key: str | None = None,
-        client: AsyncClient = AsyncClient(),
+        client: AsyncClient | None = None,
     ):
         self.endpoint = endpoint
         self.user_id = user_id
         self.api_key = api_key
-        self.client = client
+        self._client = client
+        self.harvester = MetricsHarvester(endpoint, client, headers=self.headers)
+
+    @property
+    def client(self) -> AsyncClient:
+        return self._client or http_client(self.endpoint)
 
     async def load_metrics(
         self,
@@ -106,119 +157,82 @@ class PromQL:
         with_labels=True,
         label_blacklist=DEFAULT_LABEL_BLACKLIST,
     ):
-        if force_reload or not hasattr(self, "df"):
-            self.metrics = await self.fetch_metrics(
-                with_labels=with_labels, label_blacklist=label_blacklist
-            )
-            return self.metrics
-
+        self.metrics = await self.fetch_metrics(
+            with_labels=with_labels,
+            label_blacklist=label_blacklist,
+            force_reload=force_reload,
+        )
         return self.metrics
 
     async def fetch_metrics(
-        self, with_labels=True, label_blacklist=DEFAULT_LABEL_BLACKLIST
+        self,
+        with_labels=True,
+        label_blacklist=DEFAULT_LABEL_BLACKLIST,
+        force_reload=False,
     ):
-        response = await self.client.get(
-            self.endpoint + "/api/v1/label/__name__/values", headers=self.headers()
+        # deep copied as the harvests are cached
+        return deepcopy(
+            await self.harvester.harvest(
+                with_labels=with_labels,
+                label_blacklist=label_blacklist,
+                force_reload=force_reload,
+            )
         )
-        response_json = response.json()
 
-        if response.status_code != 200:
-            logger.error(
-                "Failed to fetch metrics from prometheus", response_json=response_json
+    async def ingest_metrics(
+        self, session: Session, incremental: bool = True, batch_size: int = 20
+    ):
+        """
+        Enqueue the ingestion of the metrics metadata into the knowledge base.
+
+        In incremental mode only the metrics that are new or whose fingerprint
+        changed since their last ingestion are enqueued, and the metrics that
+        are gone from the server are tombstoned.
+        """
+        await self.load_metrics(force_reload=True)
+
+        metrics = self.metrics
+        removed = []
+        if incremental:
+            records = await MetricRecord.find_by_endpoint(session, self.endpoint)
+            metrics = [
+                metric
+                for metric in self.metrics
+                if (record := records.get(metric["metric_name"])) is None
+                or record.deleted_at is not None
+                or record.fingerprint != metric_fingerprint(metric)
+            ]
+            current = {metric["metric_name"] for metric in self.metrics}
+            removed = sorted(
+                name
+                for name, record in records.items()
+                if record.deleted_at is None and name not in current
             )
-            raise Exception("Failed to fetch metrics from prometheus")
-
-        metrics_data = response_json["data"]
-
-        metrics = []
-        for metric in metrics_data:
-            metrics.append({"metric_name": metric})
-
-        semaphore = Semaphore(10)
-
-        async def _apply_labels(metric):
-            async with semaphore:
-                metric["labels"] = await self.get_metric_labels(
-                    metric["metric_name"], label_blacklist=label_blacklist
-                )
-                return metric
-
-        tasks = []
-        for metric in metrics:
-            tasks.append(create_task(_apply_labels(metric)))
 
-        await gather(*tasks)
-
-        return metrics
-
-    async def ingest_metrics(self, session: Session):
-        await self.load_metrics()
+        logger.info(
+            "syncing metrics",
+            total=len(self.metrics),
+            changed=len(metrics),
+            removed=len(removed),
+            incremental=incremental,
+        )
 
-        for i in range(0, len(self.metrics), 20):
-            start = time.time()
-            logger.info("ingesting metrics", batch_id=i, len=len(self.metrics))
-            # await ingest_metrics(self.metrics[i : i + 20], self.endpoint)
+        for i in range(0, len(metrics), batch_size):
             enqueue_task(
                 session,
                 ingest_metrics,
-                self.metrics[i : i + 20],
+                metrics[i : i + batch_size],
                 self.endpoint,
                 queue_name="lancedb-batch-ingest",
             )
-            end = time.time()
-            logger.info(
-                "ingested metrics",
-                batch_id=i,
-                len=len(self.metrics),
-                time=f"{end - start:.2f}s",
-            )
-
-    @lru_cache
-    async def get_metric_labels(
-        self, metric_name, label_blacklist=DEFAULT_LABEL_BLACKLIST
-    ):
-        response = await self.client.get(
-            self.endpoint + "/api/v1/labels",
-            params={"match[]": metric_name},
-            headers=self.headers(),
-        )
-        response_json = response.json()
-        if response.status_code != 200:
-            logger.error(
-                "Failed to fetch labels for metric: " + metric_name,
-                response_json=response_json,
-            )
-            return []
-        labels = response_json["data"]
-        labels.remove("__name__") if "__name__" in labels else None
-
-        result = {}
-        for label in labels:
-            if label in label_blacklist:
-                result[label] = ""
-                continue
-            response = await self.client.get(
-                self.endpoint + "/api/v1/label/" + label + "/values",
-                params={"match[]": metric_name},
-                headers=self.headers(),
+        for i in range(0, len(removed), batch_size):
+            enqueue_task(
+                session,
+                tombstone_metrics,
+                removed[i : i + batch_size],
+                self.endpoint,
+                queue_name="lancedb-batch-ingest",
             )
-            response_json = response.json()
-            if response.status_code != 200:
-                logger.error(
-                    "Failed to fetch values for label: " + label,
-                    response_json=response_json,
-                )
-                result[label] = ""
-                continue
-            values = response_json["data"]
-            # result[label] = str.join("|", values)
-            joint_values = "|".join(values)
-            if len(joint_values) > 100:
-                result[label] = joint_values[:100] + "..."
-            else:
-                result[label] = joint_values
-
-        return result
 
     def headers(self):
         h = {
@@ -263,6 +277,9 @@ class PromQuery(ToolCall[dict[str, Any]], DatetimeRange, PresentationMixin):
         ge=100,
     )
     sample_points: ClassVar[int] = 20
+    downsampling: ClassVar[str] = "lttb"
+    max_series: ClassVar[int] = 20
+    max_summarised_series: ClassVar[int] = 50
 
     @computed_field
     def step(self) -> str:
@@ -295,87 +312,119 @@ class PromQuery(ToolCall[dict[str, Any]], DatetimeRange, PresentationMixin):
         endpoint = context.get("PROMETHEUS_ENDPOINT", DEFAULT_ENDPOINT)
         path = context.get("PROMETHEUS_PATH", DEFAULT_PATH)
 
-        response = await AsyncClient().post(
-            endpoint + path,
-            data={
-                "query": self.query,
-                "start": self.start,
-                "end": self.end,
-                "step": self.step,
-            },
-            headers=self.headers(context),
+        shards = range_shards(
+            self.start_dt,
+            self.end_dt,
+            step=int(self.step.removesuffix("s")),
+            max_shard=timedelta(seconds=config.query_shard_duration),
         )
 
-        if response.status_code != 200:
-            logger.error(
-                "Failed to fetch metrics from prometheus", response_json=response.json()
+        async def fetch(start: datetime, end: datetime):
+            response = await http_client(endpoint).post(
+                endpoint + path,
+                data={
+                    "query": self.query,
+                    "start": start.strftime(self._FMT),
+                    "end": end.strftime(self._FMT),
+                    "step": self.step,
+                },
+                headers=self.headers(context),
             )
-            return {
-                "error": "Failed to fetch metrics from prometheus",
-                "data": response.text,
-            }
+            if response.status_code != 200:
+                logger.error(
+                    "Failed to fetch metrics from prometheus",
+                    status_code=response.status_code,
+                    response=response.text[:500],
+                )
+                raise QueryError(
+                    "Failed to fetch metrics from prometheus", response.text
+                )
+            return response.json()
 
-        return response.json()
+        try:
+            responses = await gather_bounded(
+                [fetch(start, end) for start, end in shards], config.query_concurrency
+            )
+        except QueryError as e:
+            return {"error": str(e), "data": e.data}
+
+        if len(responses) == 1:
+            return responses[0]
+        logger.info("merging sharded range query", query=self.query, shards=len(shards))
+        output = responses[0]
+        output["data"]["result"] = merge_matrix(
+            [response["data"]["result"] for response in responses]
+        )
+        return output
 
+    _columns: MatrixColumns | None = PrivateAttr(default=None)
     _dataframe: pd.DataFrame | None = PrivateAttr(default=None)
 
+    @property
+    def columns(self) -> MatrixColumns:
+        """
+        The samples of the result decoded into numpy columns.
+        """
+        if self._columns is None:
+            self._columns = decode_matrix(self.output["data"]["result"])
+        return self._columns
+
     @property
     def dataframe(self):
         if self._dataframe is not None:
             return self._dataframe
 
-        datapoints = deepcopy(self.output["data"]["result"])
-
-        if len(datapoints) == 0:
+        if len(self.columns) == 0:
             logger.warning("No datapoints found for query", query=self.query)
             return None
 
-        # Create DataFrame from all results
-        df_list: list[pd.DataFrame] = []
-        for result in datapoints:
-            metric_name = "-".join(result["metric"].values())
-            # Convert values to float during DataFrame creation
-            df = pd.DataFrame(result["values"], columns=["timestamp", metric_name])
-            df[metric_name] = df[metric_name].astype(float)  # Ensure values are float
-            df_list.append(df)
-
-        # Merge all dataframes on timestamp
-        if len(df_list) == 1:
-            df = df_list[0]
-        else:
-            # Progressively merge all dataframes
-            df = df_list[0]
-            for additional_df in df_list[1:]:
-                df = df.merge(additional_df, on="timestamp", how="outer")
+        self._dataframe = wide_frame(self.columns)
+        return self._dataframe
+
+    def to_arrow(self) -> pa.Table:
+        """
+        The samples of the result as an arrow table in long format, a row per
+        sample of `series`, `timestamp` and `value`.
+        """
+        return arrow_table(self.columns)
 
-        df = df.fillna(0.0)
-        df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s")
-        self._dataframe = df
-        return df
+    def to_polars(self):
+        """
+        The samples of the result as a polars dataframe in long format.
+        Requires the `polars` package.
+        """
+        import polars as pl
+
+        return pl.from_arrow(self.to_arrow())
 
     def sampled_output(self):
+        """
+        The output downsampled for the LLM. Every series is reduced to about
+        `sample_points` samples with the `downsampling` strategy, and beyond
+        `max_series` series only the most varying ones are kept, the others
+        are summarised by their statistics.
+        """
         if "error" in self.output:
             return self.output
 
-        output = deepcopy(self.output)
-        results = []
-        for result in output["data"]["result"]:
-            values = result["values"]
-            metric = result["metric"]
-
-            # Aim to sample around 10 points
-            if len(values) > self.sample_points:
-                step = max(1, len(values) // self.sample_points)
-                values = values[::step]
-
-            results.append(
-                {
-                    "metric": metric,
-                    "values": values,
-                }
-            )
-        output["data"]["result"] = results
-        return output
+        columns = self.columns
+        kept = top_k_series(columns, self.max_series)
+        data = {
+            **self.output["data"],
+            "result": matrix_result(
+                downsample(columns.select(kept), self.sample_points, self.downsampling)
+            ),
+        }
+        if len(kept) < len(columns):
+            omitted = sorted(set(range(len(columns))) - set(kept))
+            data["omitted_series"] = {
+                "count": len(omitted),
+                "summaries": series_summaries(
+                    columns.select(omitted[: self.max_summarised_series])
+                ),
+            }
+        # rather than deep copying the whole output, only the data is rebuilt
+        return {**self.output, "data": data}
 
     def markdown(self, context: dict[str, Any] = {}): ...
 
@@ -386,16 +435,18 @@ class PromQuery(ToolCall[dict[str, Any]], DatetimeRange, PresentationMixin):
         logger.info("plotting time series", query=self.query)
         plt.figure(figsize=(12, 6))
 
-        for result in self.output["data"]["result"]:
-            values = result["values"]
-            metric = result["metric"]
-            metric_name = "-".join(metric.values())
-            timestamps = [datetime.fromtimestamp(ts) for ts, _ in values]
-            measurements = [float(val) for _, val in values]
-            df = pd.DataFrame({"timestamp": timestamps, "measurement": measurements})
+        columns = self.columns
+        for i, metric_name in enumerate(columns.series):
+            timestamps, measurements = columns.samples(i)
+            # plotted in local time
+            timestamps = (
+                pd.to_datetime(timestamps, unit="s", utc=True)
+                .tz_convert(datetime.now().astimezone().tzinfo)
+                .tz_localize(None)
+            )
             if in_terminal:
-                df["timestamp"] = mdates.date2num(df["timestamp"])
-            plt.plot(df["timestamp"], df["measurement"], label=metric_name)
+                timestamps = mdates.date2num(timestamps)
+            plt.plot(timestamps, measurements, label=metric_name)
         plt.grid(True)
         plt.title(f"{self.title} - {self.query}")
         plt.xlabel(self.x_label)
@@ -0,0 +1,115 @@
+from typing import Any, Dict, List
+from dataclasses import dataclass
+from itertools import chain
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+@dataclass
+class MatrixColumns:
+    """
+    The samples of a prometheus `matrix` result as flat columns. The samples
+    of the series `i` are `timestamps[offsets[i]:offsets[i + 1]]` and
+    `values[offsets[i]:offsets[i + 1]]`.
+    """
+
+    series: List[str]
+    metrics: List[Dict[str, str]]
+    offsets: np.ndarray
+    timestamps: np.ndarray
+    values: np.ndarray
+
+    def __len__(self):
+        return len(self.series)
+
+    def samples(self, i: int) -> tuple[np.ndarray, np.ndarray]:
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.timestamps[start:end], self.values[start:end]
+
+    def series_index(self) -> np.ndarray:
+        """
+        The series of every sample.
+        """
+        return np.repeat(np.arange(len(self.series)), np.diff(self.offsets))
+
+    def select(self, indices: List[int]) -> "MatrixColumns":
+        """
+        The columns of the series at the indices, in that order.
+        """
+        return from_samples(
+            [self.metrics[i] for i in indices], [self.samples(i) for i in indices]
+        )
+
+
+def from_samples(
+    metrics: List[Dict[str, str]], samples: List[tuple[np.ndarray, np.ndarray]]
+) -> MatrixColumns:
+    """
+    Build the columns from the timestamps and values of every series.
+    """
+    counts = [len(timestamps) for timestamps, _ in samples]
+    return MatrixColumns(
+        series=[series_name(metric) for metric in metrics],
+        metrics=list(metrics),
+        offsets=np.concatenate(([0], np.cumsum(counts, dtype=np.int64))),
+        timestamps=np.concatenate(
+            [timestamps for timestamps, _ in samples] or [np.empty(0)]
+        ),
+        values=np.concatenate([values for _, values in samples] or [np.empty(0)]),
+    )
+
+
+def series_name(metric: Dict[str, str]) -> str:
+    return "-".join(metric.values())
+
+
+def decode_matrix(result: List[Dict[str, Any]]) -> MatrixColumns:
+    """
+    Decode the `[timestamp, "value"]` pairs of all the series in one pass,
+    rather than building a dataframe per series.
+    """
+    counts = [len(r["values"]) for r in result]
+    flat = list(chain.from_iterable(chain.from_iterable(r["values"] for r in result)))
+    return MatrixColumns(
+        series=[series_name(r["metric"]) for r in result],
+        metrics=[r["metric"] for r in result],
+        offsets=np.concatenate(([0], np.cumsum(counts, dtype=np.int64))),
+        timestamps=np.array(flat[0::2], dtype=np.float64),
+        # numpy parses the prometheus "NaN", "+Inf" and "-Inf" values
+        values=np.array(flat[1::2], dtype=np.float64),
+    )
+
+
+def wide_frame(columns: MatrixColumns) -> pd.DataFrame:
+    """
+    Pivot the samples into a frame with a `timestamp` column and a column per
+    series, sorted by timestamp. The missing samples are filled with 0.0.
+    """
+    timestamps, rows = np.unique(columns.timestamps, return_inverse=True)
+    grid = np.zeros((len(timestamps), len(columns)), dtype=np.float64)
+    grid[rows, columns.series_index()] = columns.values
+    grid[np.isnan(grid)] = 0.0
+
+    df = pd.DataFrame(grid, columns=columns.series)
+    df.insert(0, "timestamp", pd.to_datetime(timestamps, unit="s"))
+    return df
+
+
+def arrow_table(columns: MatrixColumns) -> pa.Table:
+    """
+    The samples in long format, a row per sample with the `series` name
+    dictionary encoded, the `timestamp` and the `value`.
+    """
+    return pa.table(
+        {
+            "series": pa.DictionaryArray.from_arrays(
+                pa.array(columns.series_index(), pa.int32()),
+                pa.array(columns.series, pa.string()),
+            ),
+            "timestamp": pa.array(
+                np.rint(columns.timestamps * 1000).astype(np.int64), pa.timestamp("ms")
+            ),
+            "value": pa.array(columns.values, pa.float64()),
+        }
+    )
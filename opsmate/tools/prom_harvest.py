@@ -0,0 +1,287 @@
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Tuple
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, UTC
+from httpx import AsyncClient
+from opsmate.tools.http_clients import http_client
+import asyncio
+import hashlib
+import json
+import time
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+# the label values of a metric are rendered up to this many characters
+MAX_LABEL_VALUES_CHARS = 100
+
+
+class TTLCache:
+    """
+    TTLCache caches the results of coroutines for `ttl` seconds.
+
+    Concurrent callers of the same key share one in-flight call rather than
+    issuing it again, and failed calls are not cached.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: Dict[Any, Tuple[float, Any]] = {}
+        self._inflight: Dict[Any, asyncio.Future] = {}
+
+    async def get_or_load(self, key: Any, load: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await load()
+        except BaseException as e:
+            future.set_exception(e)
+            # retrieve the exception so that it is not reported as unhandled
+            future.exception()
+            raise
+        else:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._inflight[key]
+
+    def invalidate(self, key: Any = None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+
+class PrometheusAPIError(Exception):
+    pass
+
+
+@dataclass
+class MetricSeries:
+    """
+    The label values of the series of a metric.
+    """
+
+    values: Dict[str, set] = field(default_factory=dict)
+    series: int = 0
+
+    def add(self, labels: Dict[str, str]):
+        self.series += 1
+        for label, value in labels.items():
+            if label != "__name__":
+                self.values.setdefault(label, set()).add(value)
+
+    def cardinality(self) -> Dict[str, int]:
+        return {label: len(values) for label, values in self.values.items()}
+
+
+class MetricsHarvester:
+    """
+    MetricsHarvester collects the metric names, metadata and label values of a
+    Prometheus server in bulk.
+
+    Rather than one `/api/v1/labels` request per metric and one
+    `/api/v1/label/<label>/values` request per label, the series of the
+    metrics are fetched from `/api/v1/series` with up to `match_batch_size`
+    `match[]` selectors per request, and the label values and cardinalities
+    are computed locally. The metric types and help texts come from a single
+    `/api/v1/metadata` request. Only the series seen over the last `lookback`
+    are harvested.
+
+    The harvests are cached for `ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        client: AsyncClient | None = None,
+        headers: Callable[[], Dict[str, str]] = dict,
+        match_batch_size: int = 50,
+        concurrency: int = 4,
+        lookback: timedelta = timedelta(hours=1),
+        ttl: float = 300,
+    ):
+        self.endpoint = endpoint
+        self._client = client
+        self.headers = headers
+        self.match_batch_size = match_batch_size
+        self.concurrency = concurrency
+        self.lookback = lookback
+        self.cache = TTLCache(ttl)
+
+    @property
+    def client(self) -> AsyncClient:
+        return self._client or http_client(self.endpoint)
+
+    async def _get(self, path: str, **params) -> Any:
+        response = await self.client.get(
+            self.endpoint + path, params=params, headers=self.headers()
+        )
+        return self._data(path, response)
+
+    async def _post(self, path: str, data: Dict[str, Any]) -> Any:
+        response = await self.client.post(
+            self.endpoint + path, data=data, headers=self.headers()
+        )
+        return self._data(path, response)
+
+    def _data(self, path: str, response) -> Any:
+        if response.status_code != 200:
+            logger.error(
+                "prometheus request failed",
+                path=path,
+                status_code=response.status_code,
+                response=response.text[:500],
+            )
+            raise PrometheusAPIError(
+                f"prometheus request to {path} failed with {response.status_code}"
+            )
+        return response.json()["data"]
+
+    def _window(self) -> Dict[str, str]:
+        end = datetime.now(UTC)
+        return {
+            "start": str((end - self.lookback).timestamp()),
+            "end": str(end.timestamp()),
+        }
+
+    async def metric_names(self) -> List[str]:
+        """
+        The names of the metrics seen over the last `lookback`, the same window
+        as their series, so that no metric is harvested without its labels.
+        """
+        return await self.cache.get_or_load(
+            "names",
+            lambda: self._get("/api/v1/label/__name__/values", **self._window()),
+        )
+
+    async def metadata(self) -> Dict[str, Dict[str, str]]:
+        """
+        The type, help and unit of the metrics, keyed by metric name.
+        """
+
+        async def load():
+            try:
+                data = await self._get("/api/v1/metadata")
+            except PrometheusAPIError:
+                # not every prometheus compatible server serves the metadata
+                return {}
+            return {metric: entries[0] for metric, entries in data.items() if entries}
+
+        return await self.cache.get_or_load("metadata", load)
+
+    async def series(self, metric_names: Iterable[str]) -> Dict[str, MetricSeries]:
+        """
+        The label values of the series of the metrics, keyed by metric name.
+        """
+        names = list(metric_names)
+        batches = [
+            names[i : i + self.match_batch_size]
+            for i in range(0, len(names), self.match_batch_size)
+        ]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(batch: List[str]):
+            async with semaphore:
+                return await self._post(
+                    "/api/v1/series",
+                    {
+                        "match[]": [name_selector(name) for name in batch],
+                        **self._window(),
+                    },
+                )
+
+        series: Dict[str, MetricSeries] = {name: MetricSeries() for name in names}
+        for result in await asyncio.gather(*[fetch(batch) for batch in batches]):
+            for labels in result:
+                series.setdefault(labels["__name__"], MetricSeries()).add(labels)
+
+        logger.info(
+            "harvested prometheus series",
+            metrics=len(names),
+            requests=len(batches),
+            series=sum(s.series for s in series.values()),
+        )
+        return series
+
+    async def harvest(
+        self,
+        with_labels: bool = True,
+        label_blacklist: Iterable[str] = (),
+        force_reload: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """
+        Harvest the metrics of the server, as dicts of the metric name, type,
+        help, the values of their labels and the number of values per label.
+        The values of the blacklisted labels are left empty.
+        """
+        label_blacklist = tuple(sorted(label_blacklist))
+        key = ("harvest", with_labels, label_blacklist)
+        if force_reload:
+            self.cache.invalidate()
+
+        async def load():
+            names, metadata = await asyncio.gather(self.metric_names(), self.metadata())
+            series = await self.series(names) if with_labels else {}
+
+            metrics = []
+            for name in names:
+                metric = {"metric_name": name}
+                if name in metadata:
+                    metric["type"] = metadata[name].get("type", "")
+                    metric["help"] = metadata[name].get("help", "")
+                if with_labels:
+                    metric_series = series.get(name, MetricSeries())
+                    metric["labels"] = render_labels(metric_series, label_blacklist)
+                    metric["label_cardinality"] = metric_series.cardinality()
+                metrics.append(metric)
+            return metrics
+
+        return await self.cache.get_or_load(key, load)
+
+
+def metric_fingerprint(metric: Dict[str, Any]) -> str:
+    """
+    Fingerprint the name, type, help and label values of a harvested metric.
+    The label cardinalities are left out, so that the churn of the series
+    alone does not count as a change of the metric.
+    """
+    identity = {
+        key: metric.get(key)
+        for key in ("metric_name", "type", "help", "labels")
+        if key in metric
+    }
+    return hashlib.sha256(
+        json.dumps(identity, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def name_selector(metric_name: str) -> str:
+    escaped = metric_name.replace("\\", "\\\\").replace('"', '\\"')
+    return f'{{__name__="{escaped}"}}'
+
+
+def render_labels(series: MetricSeries, label_blacklist: Iterable[str] = ()):
+    """
+    Render the label values of the metric series, joined by `|` and truncated.
+    """
+    label_blacklist = set(label_blacklist)
+    result = {}
+    for label in sorted(series.values):
+        if label in label_blacklist:
+            result[label] = ""
+            continue
+        joint_values = "|".join(sorted(series.values[label]))
+        if len(joint_values) > MAX_LABEL_VALUES_CHARS:
+            result[label] = joint_values[:MAX_LABEL_VALUES_CHARS] + "..."
+        else:
+            result[label] = joint_values
+    return result
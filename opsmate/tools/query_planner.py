@@ -0,0 +1,155 @@
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Literal, Tuple
+from datetime import datetime, timedelta
+import asyncio
+import structlog
+
+logger = structlog.get_logger(__name__)
+
+NANOSECONDS = 10**9
+
+
+class QueryError(Exception):
+    """
+    A shard or a page of a query failed, `data` is the response of the server.
+    """
+
+    def __init__(self, message: str, data: str = ""):
+        super().__init__(message)
+        self.data = data
+
+
+async def gather_bounded(aws: Iterable[Awaitable[Any]], concurrency: int) -> List:
+    """
+    Await all the awaitables with at most `concurrency` of them at a time,
+    returning their results in order. When one of them fails the others are
+    cancelled, and the first error is raised as is.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def bounded(aw: Awaitable[Any]):
+        async with semaphore:
+            return await aw
+
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(bounded(aw)) for aw in aws]
+    except BaseExceptionGroup as e:
+        raise e.exceptions[0]
+    return [task.result() for task in tasks]
+
+
+def range_shards(
+    start: datetime, end: datetime, step: int, max_shard: timedelta
+) -> List[Tuple[datetime, datetime]]:
+    """
+    Split a range query into shards of up to `max_shard`.
+
+    A range query is evaluated at `start + k * step`, so the shards start on
+    these evaluation times too and give the same samples as the whole range.
+    Consecutive shards share their boundary, the sample of which is dropped
+    from one of them when merging.
+    """
+    step = max(1, step)
+    steps_per_shard = max(1, int(max_shard.total_seconds()) // step)
+    shard = timedelta(seconds=steps_per_shard * step)
+
+    shards = []
+    shard_start = start
+    while True:
+        shard_end = min(shard_start + shard, end)
+        shards.append((shard_start, shard_end))
+        if shard_end >= end:
+            return shards
+        shard_start = shard_end
+
+
+def merge_matrix(results: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Merge the `matrix` results of the shards of a range query, given in time
+    order. The series are matched by their labels and the samples repeated
+    at the shard boundaries are dropped.
+    """
+    merged: Dict[frozenset, Dict[str, Any]] = {}
+    for result in results:
+        for series in result:
+            key = frozenset(series["metric"].items())
+            if key not in merged:
+                merged[key] = {"metric": series["metric"], "values": []}
+            values = merged[key]["values"]
+            last = values[-1][0] if values else None
+            values.extend(
+                value for value in series["values"] if last is None or value[0] > last
+            )
+    return list(merged.values())
+
+
+def to_nanoseconds(dt: datetime) -> int:
+    """
+    The unix time of the naive UTC datetime in nanoseconds.
+    """
+    return int((dt - datetime(1970, 1, 1)).total_seconds()) * NANOSECONDS
+
+
+FetchPage = Callable[[int, int, int], Awaitable[List[Dict[str, Any]]]]
+
+
+async def paginate_streams(
+    fetch_page: FetchPage,
+    start: int,
+    end: int,
+    limit: int,
+    page_size: int,
+    direction: Literal["forward", "backward"] = "forward",
+) -> List[Dict[str, Any]]:
+    """
+    Fetch up to `limit` log entries between the `start` and `end` unix
+    nanoseconds, in pages of `page_size` entries.
+
+    `fetch_page(start, end, limit)` returns the `streams` result of a page.
+    The next page starts from the timestamp of the last entry of the page,
+    the entries of that timestamp are fetched again and skipped. The
+    pagination stops at the limit, or when a page is not full.
+    """
+    streams: Dict[frozenset, Dict[str, Any]] = {}
+    seen = set()
+    entries = 0
+    # the entries of the previous page fetched again at the cursor
+    overlap = 0
+
+    while entries < limit and start < end:
+        page_limit = min(page_size, limit - entries + overlap)
+        page = await fetch_page(start, end, page_limit)
+
+        page_entries = 0
+        timestamps = []
+        for stream in page:
+            key = frozenset(stream["stream"].items())
+            if key not in streams:
+                streams[key] = {"stream": stream["stream"], "values": []}
+            for value in stream["values"]:
+                page_entries += 1
+                timestamps.append(int(value[0]))
+                if (key, value[0], value[1]) in seen or entries >= limit:
+                    continue
+                seen.add((key, value[0], value[1]))
+                streams[key]["values"].append(value)
+                entries += 1
+
+        logger.debug("fetched log page", entries=page_entries, total=entries)
+        if page_entries < page_limit or not timestamps:
+            break
+
+        # end is exclusive in loki, hence the boundary entries are fetched again
+        if direction == "forward":
+            cursor = max(timestamps)
+            if cursor <= start:
+                break
+            start = cursor
+        else:
+            cursor = min(timestamps)
+            if cursor + 1 >= end:
+                break
+            end = cursor + 1
+        overlap = timestamps.count(cursor)
+
+    return [stream for stream in streams.values() if stream["values"]]
@@ -1,5 +1,6 @@
 from opsmate.dino.types import ToolCall, PresentationMixin, register_tool
 import httpx
+from opsmate.tools.http_clients import http_client
 from typing import Dict, List, Any
 from pydantic import Field
 import json
@@ -19,12 +20,9 @@ class HttpBase(ToolCall[HttpResponse], PresentationMixin):
     """Base class for HTTP tools"""
 
     url: str = Field(description="The URL to interact with")
-    _client: httpx.AsyncClient = None
 
     def aconn(self) -> httpx.AsyncClient:
-        if not self._client:
-            self._client = httpx.AsyncClient()
-        return self._client
+        return http_client(self.url)
 
 
 @register_tool()